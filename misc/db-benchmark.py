@@ -0,0 +1,52 @@
+
+# Measure insert and commit throughput of the node database under each
+# durability profile (petmail.database.DB_PROFILES). Run it from the top of
+# the source tree, on the kind of disk the node will live on:
+#
+#  python misc/db-benchmark.py [COUNT]
+
+import os, sys, time, shutil, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from petmail import database
+
+def open_db(dbfile, profile):
+    db = database.get_db(dbfile)
+    db.execute("INSERT INTO node (webhost, webport, db_profile)"
+               " VALUES (?,?,?)", ("localhost", "tcp:0", profile))
+    db.commit()
+    db.close()
+    return database.get_db(dbfile) # now with the profile applied
+
+def insert(db, seqnum):
+    body = '{"body": "%s"}' % ("x"*200)
+    id = db.execute("INSERT INTO inbound_messages (cid, seqnum, payload_size)"
+                    " VALUES (?,?,?)", (1, seqnum, len(body))).lastrowid
+    db.execute("INSERT INTO message_bodies (message_id, payload_json)"
+               " VALUES (?,?)", (id, body))
+
+def run(profile, count, batch):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = open_db(os.path.join(tmpdir, "petmail.db"), profile)
+        start = time.time()
+        for i in range(count):
+            insert(db, i)
+            if (i+1) % batch == 0:
+                db.commit()
+        db.commit()
+        elapsed = time.time() - start
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return count / elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print "%-6s %22s %22s" % ("", "commit per insert", "commit per 100")
+    for profile in sorted(database.DB_PROFILES):
+        each = run(profile, count, 1)
+        batched = run(profile, count*10, 100)
+        print "%-6s %18d/s %18d/s" % (profile, each, batched)
+
+if __name__ == "__main__":
+    main()
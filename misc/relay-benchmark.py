@@ -0,0 +1,152 @@
+
+# Measure how many deliveries per second a relay accepts, with different
+# numbers of mailbox worker processes (petmail.mailbox.workers). Run it from
+# the top of the source tree, on the kind of machine the relay will run on:
+#
+#  python misc/relay-benchmark.py [COUNT [WORKERS..]]
+#
+# Each relay runs in a child process, so the sender (this process) doesn't
+# compete with its master for a reactor. The msgAs are built before the
+# clock starts. They are sent from many loopback addresses (127.0.0.N), in
+# several size classes, so the inlet rate limits (see
+# petmail.mailbox.ratelimit) stay out of the way: a '429' column that isn't
+# zero means the limits, not the relay, set the pace.
+
+import os, sys, json, time, shutil, tempfile, subprocess, urlparse
+from StringIO import StringIO
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from twisted.internet import reactor, defer
+from twisted.web import client, error
+from petmail import rrid
+from petmail.scripts import runner
+from petmail.scripts.create_node import create_relay
+from petmail.scripts.relay import add_transport
+from petmail.mailbox.delivery import createMsgA
+
+CONCURRENCY = 32
+SOURCES = 64
+SIZES = [200, 1000, 5000, 20000]
+
+RUN_RELAY = """
+import sys
+from twisted.internet import reactor
+from petmail.node import Node
+n = Node(sys.argv[1], sys.argv[1] + '/petmail.db')
+n.startService()
+reactor.addSystemEventTrigger('before', 'shutdown', n.stopService)
+def _ready(_):
+    sys.stdout.write('ready\\n')
+    sys.stdout.flush()
+d = n.web.port_service._waitingForPort
+if hasattr(n, 'worker_pool'):
+    d.addCallback(lambda _: n.worker_pool.when_ready())
+d.addCallback(_ready)
+reactor.run()
+"""
+
+def run_cli(func, options, args):
+    so = options()
+    so.parseOptions(args)
+    out, err = StringIO(), StringIO()
+    rc = func(so, out, err)
+    assert rc == 0, (rc, out.getvalue(), err.getvalue())
+    return out.getvalue()
+
+def make_relay(tmpdir, workers):
+    basedir = os.path.join(tmpdir, "relay-%d" % workers)
+    run_cli(create_relay, runner.CreateRelayOptions,
+            ["--webport", "tcp:0:interface=0.0.0.0",
+             "--workers", str(workers), basedir])
+    return basedir
+
+def start_relay(basedir):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([root] + sys.path[1:])
+    p = subprocess.Popen([sys.executable, "-c", RUN_RELAY, basedir],
+                         stdout=subprocess.PIPE, env=env)
+    assert p.stdout.readline().strip() == "ready"
+    return p
+
+def build_messages(desc, count):
+    trec = desc["sender"].copy()
+    TID_token0 = desc["retrieval"]["TID"].decode("hex")
+    msgAs = []
+    for i in range(count):
+        trec["STID"] = rrid.randomize(TID_token0).encode("hex")
+        msgC = "%d:" % i + "x" * SIZES[i % len(SIZES)]
+        msgAs.append(createMsgA(trec, msgC))
+    return msgAs
+
+def post(url, msgA, source):
+    u = urlparse.urlparse(url)
+    f = client.HTTPClientFactory(url, method="POST", postdata=msgA)
+    reactor.connectTCP(u.hostname, u.port, f, bindAddress=(source, 0))
+    return f.deferred
+
+@defer.inlineCallbacks
+def send_all(url, msgAs):
+    results = {"ok": 0, "429": 0, "other": 0}
+    todo = list(enumerate(msgAs))
+    def _one(_=None):
+        if not todo:
+            return
+        i, msgA = todo.pop()
+        d = post(url, msgA, "127.0.0.%d" % (2 + i % SOURCES))
+        def _ok(_):
+            results["ok"] += 1
+        def _err(f):
+            f.trap(error.Error)
+            if f.value.status == "429":
+                results["429"] += 1
+            else:
+                results["other"] += 1
+        d.addCallbacks(_ok, _err)
+        d.addCallback(_one)
+        return d
+    start = time.time()
+    yield defer.gatherResults([_one() for i in range(CONCURRENCY)])
+    defer.returnValue((time.time() - start, results))
+
+def setup(tmpdir, count, workers):
+    # before the reactor starts: start_relay() blocks
+    basedir = make_relay(tmpdir, workers)
+    p = start_relay(basedir) # which picks its port, for the descriptor
+    desc = json.loads(run_cli(add_transport, runner.AddTransportOptions,
+                              ["--basedir", basedir]))
+    return p, desc, build_messages(desc, count)
+
+@defer.inlineCallbacks
+def run(relays):
+    try:
+        print "%-8s %12s %8s %8s" % ("workers", "accepted", "429", "other")
+        for workers, (p, desc, msgAs) in relays:
+            url = str(desc["sender"]["url"]).replace("localhost",
+                                                     "127.0.0.1")
+            elapsed, results = yield send_all(url, msgAs)
+            p.terminate()
+            p.wait()
+            print "%-8d %10d/s %8d %8d" % (workers, results["ok"] / elapsed,
+                                           results["429"], results["other"])
+    finally:
+        reactor.stop()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    worker_counts = [int(w) for w in sys.argv[2:]] or [0, 1, 3]
+    tmpdir = tempfile.mkdtemp()
+    relays = []
+    try:
+        for workers in worker_counts:
+            relays.append((workers, setup(tmpdir, count, workers)))
+        reactor.callWhenRunning(run, relays)
+        reactor.run()
+    finally:
+        for workers, (p, desc, msgAs) in relays:
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
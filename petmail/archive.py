@@ -0,0 +1,215 @@
+
+# I keep the live database small. Inbound messages older than the node's
+# 'archive_after' are moved out of it, a batch at a time, into compressed
+# archive files:
+#
+#  ARCHIVEDIR/NUMBER.arc : blocks, append-only
+#
+# A block is zlib(json({message id: payload_json})) for one batch. Each
+# archived message leaves a row in the archived_messages table (its
+# metadata, and the segment, offset and length of its block), so the archive
+# can be listed and searched by contact or date without reading the files,
+# and any one body costs a single block to decompress.
+#
+# A batch is read, then appended (and fsynced) outside the database lock,
+# so the writer thread is free meanwhile, and then moved by a transaction
+# that commits after the block is durable. After a crash in between, the block is never referred
+# to, and the same messages go into a new block on the next pass: we waste
+# some space, but lose nothing. Like the spool's .log files, a segment is
+# appended to until it reaches segment_size.
+#
+# If the database is in auto_vacuum=INCREMENTAL mode (new ones are, older
+# ones once 'petmail compact-db' has converted them, see
+# database.enable_incremental_vacuum), after each batch we hand up to
+# VACUUM_PAGES of the pages freed by archiving back to the filesystem. That
+# PRAGMA would commit any open transaction, so it runs right behind the
+# batch's COMMIT, before anybody can start another.
+
+import os, json, time, zlib
+from twisted.application import service, internet
+from twisted.internet import defer, threads
+from twisted.python import log
+from .eventual import eventually
+
+DAY = 24*60*60
+DEFAULT_ARCHIVE_AFTER = 90*DAY
+DEFAULT_ARCHIVE_INTERVAL = 60*60
+DEFAULT_SEGMENT_SIZE = 16*1000*1000
+ARCHIVE_BATCH = 500 # messages per block, within database.MAX_FETCH_IDS
+VACUUM_PAGES = 1000 # per pass
+
+class ArchiveStore:
+    """I hold the archive files. Reading is safe from any thread, appending
+    is only done by the Archiver, one batch at a time."""
+    def __init__(self, archivedir, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.archivedir = archivedir
+        self.segment_size = segment_size
+        if not os.path.isdir(archivedir):
+            os.makedirs(archivedir)
+        segments = self.list_segments()
+        self.current = segments[-1] if segments else 0
+
+    def _fn(self, number):
+        return os.path.join(self.archivedir, "%d.arc" % number)
+
+    def list_segments(self):
+        numbers = []
+        for fn in os.listdir(self.archivedir):
+            if fn.endswith(".arc") and fn[:-len(".arc")].isdigit():
+                numbers.append(int(fn[:-len(".arc")]))
+        return sorted(numbers)
+
+    def append(self, bodies):
+        """Durably write a block holding 'bodies' ({id: payload_json}).
+        Returns (segment, offset, length)."""
+        block = zlib.compress(json.dumps(dict([(str(id), body) for (id, body)
+                                               in bodies.items()])))
+        fn = self._fn(self.current)
+        if (os.path.exists(fn)
+            and os.path.getsize(fn) + len(block) > self.segment_size):
+            self.current += 1
+            fn = self._fn(self.current)
+        with open(fn, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        return (self.current, offset, len(block))
+
+    def read_block(self, segment, offset, length):
+        """Return the {str(id): payload_json} of one block."""
+        with open(self._fn(segment), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return json.loads(zlib.decompress(data))
+
+    def get_body(self, row):
+        """Return the payload_json of the archived_messages row 'row'."""
+        block = self.read_block(row["segment"], row["offset"], row["length"])
+        return block[str(row["id"])]
+
+    def search(self, rows, text):
+        """Return those of the archived_messages 'rows' whose payload_json
+        contains 'text', reading each of their blocks once."""
+        needle = json.dumps(text)[1:-1] # as it appears in the JSON
+        blocks = {}
+        found = []
+        for row in rows:
+            where = (row["segment"], row["offset"], row["length"])
+            if where not in blocks:
+                blocks[where] = self.read_block(*where)
+            body = blocks[where][str(row["id"])]
+            if body is not None and needle in body:
+                found.append(row)
+        return found
+
+def select_batch(db, cutoff):
+    # runs on the database writer thread
+    return db.execute("SELECT inbound_messages.*,"
+                      "  message_bodies.payload_json"
+                      " FROM inbound_messages LEFT JOIN message_bodies"
+                      "  ON message_bodies.message_id = inbound_messages.id"
+                      " WHERE inbound_messages.received_at < ?"
+                      " ORDER BY inbound_messages.received_at,"
+                      "  inbound_messages.id"
+                      " LIMIT ?", (cutoff, ARCHIVE_BATCH)).fetchall()
+
+def move_batch(db, rows, (segment, offset, length)):
+    # runs on the database writer thread, once the block is durable. The
+    # messages are moved with plain execute(), so subscribers get no
+    # notices: they have not been deleted, and the archive still has them.
+    for row in rows:
+        db.execute("INSERT INTO archived_messages"
+                   " (id, cid, seqnum, payload_size, received_at,"
+                   "  segment, offset, length)"
+                   " VALUES (?,?,?,?,?,?,?,?)",
+                   (row["id"], row["cid"], row["seqnum"],
+                    row["payload_size"], row["received_at"],
+                    segment, offset, length))
+    ids = [row["id"] for row in rows]
+    marks = ",".join(["?"] * len(ids))
+    db.execute("DELETE FROM message_bodies WHERE message_id IN (%s)" % marks,
+               ids)
+    db.execute("DELETE FROM inbound_messages WHERE id IN (%s)" % marks, ids)
+    return len(rows)
+
+def vacuum(db, pages=VACUUM_PAGES):
+    # runs on the database writer thread, right after a commit (see
+    # AsyncDatabase.commit): a PRAGMA commits whatever is pending first
+    assert not db.in_transaction
+    free = db.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        db.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+    return free
+
+class Archiver(service.MultiService):
+    def __init__(self, adb, archivedir, archive_after=DEFAULT_ARCHIVE_AFTER,
+                 interval=DEFAULT_ARCHIVE_INTERVAL,
+                 segment_size=DEFAULT_SEGMENT_SIZE, clock=time.time):
+        service.MultiService.__init__(self)
+        self.adb = adb # database.AsyncDatabase
+        self.store = ArchiveStore(archivedir, segment_size)
+        self.archive_after = archive_after # seconds, 0 for never
+        self.clock = clock
+        self.busy = False
+        self.stopping = False
+        if archive_after:
+            t = internet.TimerService(interval, self.archive)
+            t.setServiceParent(self)
+
+    def stopService(self):
+        self.stopping = True
+        return service.MultiService.stopService(self)
+
+    def archive(self):
+        """Archive one batch of old messages, commit, then vacuum a little.
+        Fires with the number of messages archived. If that was a whole
+        batch, the next one is started on a later turn."""
+        if self.busy:
+            return defer.succeed(0)
+        self.busy = True
+        cutoff = int(self.clock()) - self.archive_after
+        d = self.adb.run(select_batch, cutoff)
+        # once we are stopping, so is the writer thread, and anything new we
+        # gave it would never finish (Node.stopService commits for us)
+        def _selected(rows):
+            if not rows or self.stopping:
+                return 0
+            bodies = dict([(row["id"], row["payload_json"]) for row in rows])
+            # the fsync happens here, holding nobody up
+            d2 = threads.deferToThread(self.store.append, bodies)
+            def _appended(where):
+                if self.stopping:
+                    return 0 # the block is never referred to
+                return self.adb.run(move_batch, rows, where)
+            d2.addCallback(_appended)
+            return d2
+        d.addCallback(_selected)
+        def _archived(count):
+            if self.stopping or not count:
+                return count
+            d2 = self.adb.commit(after=vacuum)
+            d2.addCallback(lambda _: count)
+            return d2
+        d.addCallback(_archived)
+        def _done(res):
+            self.busy = False
+            if res == ARCHIVE_BATCH and self.running:
+                eventually(self.archive)
+            return res
+        d.addBoth(_done)
+        # the TimerService stops for good if we fail
+        d.addErrback(log.err, "unable to archive old messages")
+        return d
+
+    def get_body(self, row):
+        """Like ArchiveStore.get_body, but in a thread, so the reactor isn't
+        kept waiting while the block is read and decompressed. Fires with
+        the payload_json."""
+        return threads.deferToThread(self.store.get_body, row)
+
+    def search(self, rows, text):
+        """Like ArchiveStore.search, but in a thread: it may have a lot of
+        blocks to read. Fires with the matching rows."""
+        return threads.deferToThread(self.store.search, rows, text)
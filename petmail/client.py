@@ -1,18 +1,42 @@
-import os.path, json
+import os.path, json, time
 from twisted.application import service
+from twisted.python import log
 from nacl.signing import SigningKey
 from nacl.encoding import HexEncoder as Hex
-from . import invitation, rrid
+from . import invitation, rrid, archive
+from .spool import InboundSpool
 from .rendezvous import localdir
-from .errors import CommandError
+from .errors import CommandError, ReplayError
 from .mailbox import channel, retrieval
 
 class Client(service.MultiService):
-    def __init__(self, db, basedir, mailbox_server):
+    def __init__(self, db, adb, basedir, mailbox_server):
         service.MultiService.__init__(self)
         self.db = db
+        self.adb = adb # database.AsyncDatabase, for the hot paths
         self.mailbox_server = mailbox_server
 
+        # retrieved messages are spooled to disk, then processed. Those
+        # which can be matched to their channel cheaply go first. Each batch
+        # is committed once (on the database's writer thread, after the
+        # batch's inserts), before the spool forgets it.
+        self.spool = InboundSpool(os.path.join(basedir, "inbound-spool"),
+                                  lambda tid, msgC:
+                                  self.msgC_received(tid, msgC),
+                                  lambda tid, msgC:
+                                  channel.identify_msgC(self.db, msgC),
+                                  self.adb.commit)
+        self.spool.setServiceParent(self)
+
+        # old messages move out of the database, into archive files
+        row = db.execute("SELECT archive_after FROM node").fetchone()
+        archive_after = row[0]
+        if archive_after is None:
+            archive_after = archive.DEFAULT_ARCHIVE_AFTER
+        self.archiver = archive.Archiver(adb, os.path.join(basedir, "archive"),
+                                         archive_after)
+        self.archiver.setServiceParent(self)
+
         self.local_server = None
         self.mailboxClients = set()
         c = self.db.execute("SELECT id, private_descriptor_json FROM mailboxes")
@@ -27,8 +51,9 @@ class Client(service.MultiService):
         self.im.addRendezvousService(rs_localdir)
         self.im.setServiceParent(self)
 
-    def subscribe(self, table, observer):
-        self.db.subscribe(table, observer)
+    def subscribe(self, table, observer, **kwargs):
+        # kwargs: batch, ids, where, actions (see database.Subscription)
+        self.db.subscribe(table, observer, **kwargs)
 
     def unsubscribe(self, table, observer):
         self.db.unsubscribe(table, observer)
@@ -46,13 +71,15 @@ class Client(service.MultiService):
         else:
             raise CommandError("unrecognized mailbox-retrieval protocol '%s'"
                                % retrieval_type)
-        def got_msgC(msgC):
-            self.msgC_received(tid, msgC)
-        rc = retrieval_class(private_descriptor, got_msgC, **extra_args)
+        def got_msgCs(msgCs):
+            self.spool.append(tid, msgCs)
+        rc = retrieval_class(private_descriptor, got_msgCs, **extra_args)
         return rc
 
     def subscribeToMailbox(self, rc):
         self.mailboxClients.add(rc)
+        # the spool slows retrieval down when processing falls behind
+        self.spool.registerProducer(rc)
         # the retrieval client gets to make network connections, etc, as soon
         # as it starts. If we are "running" when we add it as a service
         # child, that happens here.
@@ -91,16 +118,19 @@ class Client(service.MultiService):
 
     def msgC_received(self, tid, msgC):
         assert msgC.startswith("c0:")
-        cid, seqnum, payload_json = channel.process_msgC(self.db, msgC)
+        cid, seqnum, payload_json = channel.check_msgC(self.db, msgC)
         self.payload_received(cid, seqnum, payload_json)
 
     def payload_received(self, cid, seqnum, payload_json):
-        self.db.insert("INSERT INTO inbound_messages"
-                        " (cid, seqnum, payload_json)"
-                        " VALUES (?,?,?)",
-                        (cid, seqnum, payload_json),
-                       "inbound_messages")
-        self.db.commit()
+        # the new seqnum and the message are committed together, so a crash
+        # can't leave one without the other
+        d = self.adb.run(store_message, cid, seqnum, payload_json)
+        def _failed(f):
+            if f.check(ReplayError):
+                return # another copy of it was stored first
+            log.err(f, "unable to store inbound message")
+        d.addErrback(_failed)
+        self.adb.request_commit()
         #payload = json.loads(payload_json)
         #print "payload_received", cid, seqnum, payload
         #if payload.has_key("basic"):
@@ -119,7 +149,7 @@ class Client(service.MultiService):
         return "maybe sent"
 
     def send_message(self, cid, payload):
-        c = channel.OutboundChannel(self.db, cid)
+        c = channel.OutboundChannel(self.db, cid, self.adb)
         return c.send(payload)
 
     def get_transports(self):
@@ -142,29 +172,118 @@ class Client(service.MultiService):
             transports[tid] = t
         return transports
 
+    def command_spool_status(self):
+        return self.spool.get_status()
+
     def command_list_addressbook(self):
         resp = []
         for row in self.db.execute("SELECT * FROM addressbook").fetchall():
             entry = {}
             entry["cid"] = row["id"]
-            entry["their_verfkey"] = str(row["their_verfkey"])
+            entry["their_verfkey"] = row["their_verfkey"].encode("hex")
             entry["their_channel_record"] = json.loads(row["their_channel_record_json"])
             entry["petname"] = row["petname"]
             # TODO: filter out the long-term stuff
-            sk = SigningKey(row["my_signkey"].decode("hex"))
+            sk = SigningKey(row["my_signkey"])
             entry["my_verfkey"] = sk.verify_key.encode(Hex)
             entry["acked"] = bool(row["acked"])
             resp.append(entry)
         return resp
 
-    def command_fetch_all_messages(self):
-        c = self.db.execute("SELECT inbound_messages.*,addressbook.petname"
-                            " FROM inbound_messages,addressbook"
-                            " WHERE inbound_messages.cid = addressbook.id")
-        return [{ "id": row["id"],
-                  "petname": row["petname"],
-                  "cid": row["cid"],
-                  "seqnum": row["seqnum"],
-                  "payload": json.loads(row["payload_json"]),
-                  }
-                for row in c.fetchall()]
+    def command_fetch_all_messages(self, bodies=True):
+        # without bodies, this only reads the narrow inbound_messages table
+        if bodies:
+            d = self.adb.query("SELECT inbound_messages.*,"
+                               "  addressbook.petname,"
+                               "  message_bodies.payload_json"
+                               " FROM inbound_messages,addressbook,"
+                               "  message_bodies"
+                               " WHERE inbound_messages.cid = addressbook.id"
+                               "  AND message_bodies.message_id"
+                               "   = inbound_messages.id")
+        else:
+            d = self.adb.query("SELECT inbound_messages.*,addressbook.petname"
+                               " FROM inbound_messages,addressbook"
+                               " WHERE inbound_messages.cid = addressbook.id")
+        def _build(rows):
+            messages = []
+            for row in rows:
+                m = { "id": row["id"],
+                      "petname": row["petname"],
+                      "cid": row["cid"],
+                      "seqnum": row["seqnum"],
+                      "size": row["payload_size"],
+                      }
+                if bodies:
+                    m["payload"] = json.loads(row["payload_json"])
+                messages.append(m)
+            return messages
+        d.addCallback(_build)
+        return d
+
+    def command_fetch_message_body(self, id):
+        d = self.adb.query("SELECT payload_json FROM message_bodies"
+                           " WHERE message_id=?", (id,))
+        def _got(rows):
+            if rows:
+                return json.loads(rows[0]["payload_json"])
+            # perhaps it has been archived
+            d2 = self.adb.query("SELECT * FROM archived_messages WHERE id=?",
+                                (id,))
+            def _archived(rows):
+                if not rows:
+                    raise CommandError("no message with id %d" % id)
+                return self.archiver.get_body(rows[0])
+            d2.addCallback(_archived)
+            d2.addCallback(json.loads)
+            return d2
+        d.addCallback(_got)
+        return d
+
+    def command_search_archive(self, cid=None, since=None, until=None,
+                               text=None, limit=100):
+        # the archive index is searched by contact and date (received_at,
+        # in seconds). 'text' also reads the bodies, which is slower.
+        sql = ("SELECT archived_messages.*,addressbook.petname"
+               " FROM archived_messages,addressbook"
+               " WHERE archived_messages.cid = addressbook.id")
+        values = []
+        if cid is not None:
+            sql += " AND archived_messages.cid=?"
+            values.append(cid)
+        if since is not None:
+            sql += " AND archived_messages.received_at >= ?"
+            values.append(since)
+        if until is not None:
+            sql += " AND archived_messages.received_at < ?"
+            values.append(until)
+        sql += " ORDER BY archived_messages.id"
+        if text is None:
+            sql += " LIMIT ?"
+            values.append(limit)
+        d = self.adb.query(sql, values)
+        if text is not None:
+            d.addCallback(self.archiver.search, text)
+        def _build(rows):
+            return [{ "id": row["id"],
+                      "petname": row["petname"],
+                      "cid": row["cid"],
+                      "seqnum": row["seqnum"],
+                      "size": row["payload_size"],
+                      "received_at": row["received_at"],
+                      } for row in rows[:limit]]
+        d.addCallback(_build)
+        return d
+
+def store_message(db, cid, seqnum, payload_json):
+    # runs on the database writer thread. The body goes in a table of its
+    # own, keeping inbound_messages narrow.
+    channel.record_seqnum(db, cid, seqnum)
+    id = db.insert("INSERT INTO inbound_messages"
+                   " (cid, seqnum, payload_size, received_at)"
+                   " VALUES (?,?,?,?)",
+                   (cid, seqnum, len(payload_json), int(time.time())),
+                   "inbound_messages")
+    db.insert("INSERT INTO message_bodies (message_id, payload_json)"
+              " VALUES (?,?)", (id, payload_json))
+    return id
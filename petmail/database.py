@@ -1,7 +1,10 @@
 
-import os, sys
+import os, sys, re, threading
 from collections import defaultdict, namedtuple
 import sqlite3
+from twisted.application import service
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool, failure
 from .eventual import eventually
 
 Notice = namedtuple("Notice", ["table", "action", "id", "new_value"])
@@ -9,75 +12,571 @@ Notice = namedtuple("Notice", ["table", "action", "id", "new_value"])
 class DBError(Exception):
     pass
 
+# A new database is created from v1.sql, then brought up to date by the
+# same upgrade-to-vN.sql scripts that upgrade an existing one. Each script
+# runs in a transaction of its own, along with the new version number, so
+# a crash leaves the database at one version or the other. v1.sql is what
+# the first nodes were created with, so it must never change: new columns
+# and tables go in a new upgrade script.
+TARGET_VERSION = 7
+
+# Binary values (keys, tokens) live in BLOB columns. Bind them with blob():
+# a plain str would be stored as TEXT. They are read back as str.
+def blob(s):
+    if s is None:
+        return None
+    return sqlite3.Binary(s)
+
+sqlite3.register_converter("BLOB", str)
+
+def unhex(s):
+    # for upgrade-to-v3.sql
+    if s is None:
+        return None
+    return sqlite3.Binary(str(s).decode("hex"))
+
 def get_schema(version):
     schema_fn = os.path.join(os.path.dirname(__file__),
                              "db-schemas", "v%d.sql" % version)
     return open(schema_fn, "r").read()
 
+def get_upgrader(new_version):
+    fn = os.path.join(os.path.dirname(__file__),
+                      "db-schemas", "upgrade-to-v%d.sql" % new_version)
+    return open(fn, "r").read()
+
+def upgrade(db, version, target_version=TARGET_VERSION):
+    for v in range(version+1, target_version+1):
+        try:
+            db.executescript("BEGIN;\n%s\nUPDATE version SET version=%d;\n"
+                             "COMMIT;" % (get_upgrader(v), v))
+        except sqlite3.Error, e:
+            try:
+                db.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            raise DBError("Unable to upgrade db to version %d: %s" % (v, e))
+
+def enable_incremental_vacuum(db):
+    # Pages freed by deletes (petmail.archive) are normally kept for reuse,
+    # so the file never shrinks. With auto_vacuum=INCREMENTAL, 'PRAGMA
+    # incremental_vacuum(N)' gives N of them back to the filesystem. New
+    # databases start that way: older ones are rebuilt, once, by VACUUM.
+    # That rewrites the whole file, so it is left to 'petmail compact-db',
+    # with the node stopped. Returns True if it did anything.
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("VACUUM")
+    return True
+
+# statements which open a transaction, if one isn't open already
+DML_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+INSERT_RE = re.compile(r"^\s*INSERT INTO\s+`?(\w+)`?\s*\(([^)]*)\)"
+                       r"\s*VALUES\s*\(([^)]*)\)\s*$", re.I)
+MAX_FETCH_IDS = 500 # below SQLite's limit on parameters per statement
+
+class Subscription:
+    """I describe which of a table's notices an observer wants: those for
+    some row 'ids', those whose row matches 'where' (a dict mapping a
+    column to a value, or to a list of acceptable values), and those for
+    some 'actions' ("insert", "update", "delete"). Each left as None means
+    "any". A deleted row is matched by its last value."""
+    def __init__(self, observer, batch, ids, where, actions, number):
+        self.observer = observer
+        self.batch = batch
+        self.ids = frozenset(ids) if ids is not None else None
+        self.where = {}
+        for column, values in (where or {}).items():
+            if not isinstance(values, (list, tuple, set, frozenset)):
+                values = [values]
+            self.where[column] = frozenset(values)
+        self.actions = frozenset(actions) if actions is not None else None
+        self.number = number # subscription order, for delivery order
+
+    def index_keys(self):
+        # the (column, value) pairs under which SubscriptionIndex finds me,
+        # or None if I must see every notice
+        if self.ids is not None:
+            return [("id", id) for id in self.ids]
+        if self.where:
+            column = sorted(self.where)[0]
+            return [(column, value) for value in self.where[column]]
+        return None
+
+    def matches(self, notice, row):
+        if self.actions is not None and notice.action not in self.actions:
+            return False
+        if self.ids is not None and notice.id not in self.ids:
+            return False
+        for column, values in self.where.items():
+            if row is None or row[column] not in values:
+                return False
+        return True
+
+class SubscriptionIndex:
+    """I hold one table's subscriptions, indexed by the row id or column
+    value they are waiting for, so finding the interested ones costs a few
+    lookups per notice, however many others there are."""
+    def __init__(self):
+        self.subscriptions = []
+        self.unfiltered = []
+        self.by_key = defaultdict(list) # (column, value) -> [Subscription]
+        self.columns = set() # the columns used in by_key, besides "id"
+
+    def __nonzero__(self):
+        return bool(self.subscriptions)
+
+    def needs_old_rows(self):
+        return any([s.where for s in self.subscriptions])
+
+    def add(self, s):
+        self.subscriptions.append(s)
+        keys = s.index_keys()
+        if keys is None:
+            self.unfiltered.append(s)
+        for key in keys or []:
+            self.by_key[key].append(s)
+            if key[0] != "id":
+                self.columns.add(key[0])
+
+    def remove(self, observer):
+        for s in self.subscriptions:
+            if s.observer == observer:
+                break
+        else:
+            raise ValueError("%r is not subscribed" % (observer,))
+        self.subscriptions.remove(s)
+        keys = s.index_keys()
+        if keys is None:
+            self.unfiltered.remove(s)
+        for key in keys or []:
+            self.by_key[key].remove(s)
+            if not self.by_key[key]:
+                del self.by_key[key]
+        self.columns = set([k[0] for k in self.by_key if k[0] != "id"])
+
+    def find(self, notice, row):
+        candidates = list(self.unfiltered)
+        candidates.extend(self.by_key.get(("id", notice.id), []))
+        if row is not None:
+            for column in self.columns:
+                candidates.extend(self.by_key.get((column, row[column]), []))
+        found = set([s for s in candidates if s.matches(notice, row)])
+        return sorted(found, key=lambda s: s.number)
+
 class ObservableDatabase:
-    def __init__(self, connection):
+    """I wrap a sqlite3 connection, and tell observers about changes to the
+    tables they subscribe to, once the changes are committed.
+
+    A Notice carries the new value of the row. I only build them for tables
+    with observers, and only deliver them to the observers whose
+    subscriptions they match (see Subscription). An insert's row is built
+    from the inserted values when they cover every column, otherwise the
+    changed rows are fetched at commit(), with one SELECT per table.
+
+    Every COMMIT is an fsync. Callers which don't need their change to be
+    durable before they return should use request_commit() instead of
+    commit(): all the requests made in the same reactor turn (or within
+    'commit_window' seconds, if set) share a single COMMIT.
+
+    My connection may also be used by an AsyncDatabase's writer thread, so
+    everything that touches it (or my pending notices) holds self.lock."""
+    def __init__(self, connection, commit_window=0):
         self.conn = connection
-        self.observers = defaultdict(list)
+        self.lock = threading.RLock()
+        self.observers = defaultdict(SubscriptionIndex) # by table
+        self.subscriptions = 0
+        # each is [table, action, id, new_value or None, needs_fetch,
+        #          old_value (for filtering deletes) or None]
         self.pending_notifications = []
+        self.columns = {} # table -> [(name, is_pk, has_default)]
+        self.commit_window = commit_window
+        self.commit_waiters = []
+        self.commit_scheduled = False
+        self.commits = 0
+        self.commit_requests = 0
+        # like sqlite3's Connection.in_transaction, which python2 lacks
+        self.in_transaction = False
 
-    def subscribe(self, table, observer):
-        self.observers[table].append(observer)
+    def subscribe(self, table, observer, batch=False,
+                  ids=None, where=None, actions=None):
+        """Call observer(notice) for each committed change to 'table'. With
+        batch=True, call observer(notices) once per commit instead, with
+        the list of that commit's notices for 'table', in order. 'ids',
+        'where' and 'actions' limit the notices to those of interest, e.g.
+        where={"cid": [1,2]}: see Subscription."""
+        # sqlite3 commits any open transaction before a PRAGMA, so look up
+        # the columns now, rather than in the middle of somebody's insert
+        with self.lock:
+            columns = [c[0] for c in self._get_columns(table)]
+        for column in (where or {}):
+            if column not in columns:
+                raise ValueError("%s has no column '%s'" % (table, column))
+        self.subscriptions += 1
+        self.observers[table].add(Subscription(observer, batch, ids, where,
+                                               actions, self.subscriptions))
 
     def unsubscribe(self, table, observer):
         self.observers[table].remove(observer)
 
+    def is_observed(self, table):
+        return bool(table and self.observers.get(table))
+
     # database methods
 
+    def _track_transaction(self, sql):
+        # python2's sqlite3 opens a transaction before a DML statement, and
+        # commits any open one before anything else but a SELECT
+        words = sql.split(None, 1)
+        verb = words[0].upper() if words else ""
+        if verb in DML_VERBS:
+            self.in_transaction = True
+        elif verb != "SELECT":
+            self.in_transaction = False
+
     def execute(self, sql, values=None):
-        if values:
-            return self.conn.execute(sql, values)
-        return self.conn.execute(sql)
+        with self.lock:
+            self._track_transaction(sql)
+            if values:
+                return self.conn.execute(sql, values)
+            return self.conn.execute(sql)
 
     def insert(self, sql, values, table=None):
-        new_id = self.conn.execute(sql, values).lastrowid
-        if table:
-            c = self.conn.execute("SELECT * FROM `%s` WHERE id=?" % table,
-                                  (new_id,))
-            self.pending_notifications.append(Notice(table, "insert", new_id,
-                                                     c.fetchone()))
-        return new_id
+        with self.lock:
+            self.in_transaction = True
+            new_id = self.conn.execute(sql, values).lastrowid
+            if self.is_observed(table):
+                row = self._row_from_insert(table, sql, values, new_id)
+                self.pending_notifications.append([table, "insert", new_id,
+                                                   row, row is None, None])
+            return new_id
 
     def update(self, sql, values, table=None, id=None):
-        self.conn.execute(sql, values)
-        if table:
-            c = self.conn.execute("SELECT * FROM `%s` WHERE id=?" % table,
-                                  (id,))
-            self.pending_notifications.append(Notice(table, "update", id,
-                                                     c.fetchone()))
+        with self.lock:
+            self.in_transaction = True
+            self.conn.execute(sql, values)
+            if self.is_observed(table):
+                self.pending_notifications.append([table, "update", id, None,
+                                                   True, None])
 
     def delete(self, sql, values, table, id):
-        self.conn.execute(sql, values)
-        self.pending_notifications.append(Notice(table, "delete", id, None))
+        with self.lock:
+            self.in_transaction = True
+            old = None
+            if self.is_observed(table):
+                # earlier notices about this row need it while it still
+                # exists, and so do subscriptions filtered by its columns
+                self._fetch_rows(table, [id])
+                if self.observers[table].needs_old_rows():
+                    old = self.conn.execute("SELECT * FROM `%s` WHERE id=?"
+                                            % table, (id,)).fetchone()
+            self.conn.execute(sql, values)
+            if self.is_observed(table):
+                self.pending_notifications.append([table, "delete", id, None,
+                                                   False, old])
+
+    def _get_columns(self, table):
+        if table not in self.columns:
+            c = self.conn.execute("PRAGMA table_info(`%s`)" % table)
+            self.columns[table] = [(row[1], bool(row[5]), row[4] is not None)
+                                   for row in c.fetchall()]
+        return self.columns[table]
+
+    def _row_from_insert(self, table, sql, values, new_id):
+        # returns a dict shaped like the sqlite3.Row that 'SELECT *' would
+        # give us, or None if the statement doesn't tell us everything
+        mo = INSERT_RE.search(sql)
+        if not mo or mo.group(1) != table:
+            return None
+        names = [n.strip().strip("`") for n in mo.group(2).split(",")]
+        placeholders = [p.strip() for p in mo.group(3).split(",")]
+        if (len(names) != len(values)
+            or placeholders != ["?"]*len(names)):
+            return None
+        # as a SELECT would return them, i.e. BLOBs as str
+        written = dict([(n, str(v) if isinstance(v, buffer) else v)
+                        for (n, v) in zip(names, values)])
+        row = {}
+        for (name, is_pk, has_default) in self._get_columns(table):
+            if name in written:
+                row[name] = written[name]
+            elif is_pk and name == "id":
+                row[name] = new_id
+            elif has_default or is_pk:
+                return None
+            else:
+                row[name] = None
+        return row
+
+    def _fetch_rows(self, table, ids=None):
+        # fill in the pending notices for 'table' (and 'ids') that need the
+        # current value of their row
+        waiting = [n for n in self.pending_notifications
+                   if n[0] == table and n[4] and (ids is None or n[2] in ids)]
+        if not waiting:
+            return
+        wanted = sorted(set([n[2] for n in waiting]))
+        rows = {}
+        for i in range(0, len(wanted), MAX_FETCH_IDS):
+            chunk = wanted[i:i+MAX_FETCH_IDS]
+            c = self.conn.execute("SELECT * FROM `%s` WHERE id IN (%s)"
+                                  % (table, ",".join("?"*len(chunk))), chunk)
+            for row in c.fetchall():
+                rows[row["id"]] = row
+        for n in waiting:
+            n[3] = rows.get(n[2])
+            n[4] = False
 
     def commit(self):
-        self.conn.commit()
-        for event in self.pending_notifications:
-            for o in self.observers[event.table]:
-                eventually(o, event)
-        self.pending_notifications[:] = []
+        self._deliver(*self._commit())
+
+    def _commit(self):
+        # this half may run on a writer thread. It returns the notices and
+        # waiters for _deliver(), which must run on the reactor thread.
+        with self.lock:
+            for table in set([n[0] for n in self.pending_notifications
+                              if n[4]]):
+                self._fetch_rows(table)
+            self.conn.commit()
+            self.in_transaction = False
+            self.commits += 1
+            # (notice, the row to match subscriptions against)
+            notices = [(Notice(table, action, id, new_value),
+                        old_value if action == "delete" else new_value)
+                       for (table, action, id, new_value, _, old_value)
+                       in self.pending_notifications]
+            self.pending_notifications = []
+            # this COMMIT covered any requested ones, too
+            waiters, self.commit_waiters = self.commit_waiters, []
+        return notices, waiters
+
+    def _deliver(self, notices, waiters):
+        batches = {} # Subscription -> notices
+        for (event, row) in notices:
+            if event.table not in self.observers:
+                continue
+            for s in self.observers[event.table].find(event, row):
+                if s.batch:
+                    batches.setdefault(s, []).append(event)
+                else:
+                    eventually(s.observer, event)
+        for s in sorted(batches, key=lambda s: s.number):
+            eventually(s.observer, batches[s])
+        for d in waiters:
+            d.callback(None)
+
+    def request_commit(self):
+        """Commit soon, along with everybody else's changes. Returns a
+        Deferred that fires once the changes made so far are durable."""
+        d = defer.Deferred()
+        with self.lock:
+            self.commit_requests += 1
+            self.commit_waiters.append(d)
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            if self.commit_window:
+                reactor.callLater(self.commit_window, self._group_commit)
+            else:
+                eventually(self._group_commit)
+        return d
 
-def get_db(dbfile, stderr=sys.stderr):
+    def _group_commit(self):
+        self.commit_scheduled = False
+        if self.commit_waiters: # else somebody commit()ed in the meantime
+            self.commit()
+
+    def get_commit_stats(self):
+        return {"commits": self.commits,
+                "requests": self.commit_requests,
+                }
+
+class AsyncDatabase(service.Service):
+    """I run statements for an ObservableDatabase on a dedicated writer
+    thread, so a slow fsync or a big query doesn't stall the reactor. Every
+    method returns a Deferred. Statements run one at a time, in the order
+    they were submitted, so an insert followed by commit() is committed,
+    and its notices are delivered (on the reactor thread) just as if the
+    ObservableDatabase had been used directly.
+
+    If 'readers' is more than zero, query() runs on that many reader
+    threads, each with a connection of its own. Those only see committed
+    data, and only help when the database is in WAL mode (otherwise the
+    writer blocks them), so without readers query() uses the writer.
+
+    Code that still uses the ObservableDatabase directly shares its
+    connection (and transaction) with my writer, but may not see changes
+    that are still queued: use barrier() to wait for them."""
+
+    def __init__(self, db, dbfile=None, readers=0):
+        self.db = db
+        self.dbfile = dbfile
+        self.writer = threadpool.ThreadPool(1, 1, "db-writer")
+        self.readers = None
+        if readers:
+            assert dbfile
+            self.readers = threadpool.ThreadPool(readers, readers,
+                                                 "db-reader")
+            self.local = threading.local()
+            self.reader_connections = []
+        self.commit_waiters = []
+        self.commit_scheduled = False
+
+    def startService(self):
+        service.Service.startService(self)
+        self.writer.start()
+        if self.readers:
+            self.readers.start()
+
+    def stopService(self):
+        # both finish the statements they were already given
+        self.writer.stop()
+        if self.readers:
+            self.readers.stop()
+            for conn in self.reader_connections:
+                conn.close()
+            self.reader_connections = []
+        return service.Service.stopService(self)
+
+    def _write(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.writer, f, *args)
+
+    def run(self, f, *args):
+        """Call f(db, *args) on the writer thread, with the database to
+        itself: the statements f makes are not interleaved with anyone
+        else's."""
+        def _run():
+            with self.db.lock:
+                return f(self.db, *args)
+        return self._write(_run)
+
+    def execute(self, sql, values=None):
+        """Fire with the list of rows."""
+        return self.run(lambda db: db.execute(sql, values).fetchall())
+
+    def insert(self, sql, values, table=None):
+        """Fire with the new row's id."""
+        return self._write(self.db.insert, sql, values, table)
+
+    def update(self, sql, values, table=None, id=None):
+        return self._write(self.db.update, sql, values, table, id)
+
+    def delete(self, sql, values, table, id):
+        return self._write(self.db.delete, sql, values, table, id)
+
+    def barrier(self):
+        """Fire once every statement submitted so far has run."""
+        return self._write(lambda: None)
+
+    def commit(self, after=None):
+        """Commit everything submitted so far. If 'after' is given,
+        after(db) runs on the writer thread right behind the COMMIT, before
+        anybody can start another transaction: e.g. a PRAGMA, which would
+        otherwise commit their half-done work."""
+        def _commit():
+            with self.db.lock:
+                res = self.db._commit()
+                f = None
+                if after:
+                    try:
+                        after(self.db)
+                    except Exception:
+                        f = failure.Failure()
+                return res, f
+        def _committed((res, f)):
+            # the notices go out even if after() failed: the COMMIT didn't
+            self.db._deliver(*res)
+            return f
+        d = self._write(_commit)
+        d.addCallback(_committed)
+        return d
+
+    def request_commit(self):
+        """Like ObservableDatabase.request_commit, but the COMMIT runs on
+        the writer thread, after everything submitted so far."""
+        self.db.commit_requests += 1
+        d = defer.Deferred()
+        self.commit_waiters.append(d)
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            eventually(self._group_commit)
+        return d
+
+    def _group_commit(self):
+        self.commit_scheduled = False
+        waiters, self.commit_waiters = self.commit_waiters, []
+        def _fire(res):
+            for d in waiters:
+                if isinstance(res, failure.Failure):
+                    d.errback(res)
+                else:
+                    d.callback(None)
+        self.commit().addBoth(_fire)
+
+    def _read(self, sql, values):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = get_db(self.dbfile,
+                                            check_same_thread=False)
+            self.reader_connections.append(conn)
+        if values:
+            return conn.execute(sql, values).fetchall()
+        return conn.execute(sql).fetchall()
+
+    def query(self, sql, values=None):
+        """Fire with the list of rows. With reader threads, I only see
+        committed changes."""
+        if not self.readers:
+            return self.execute(sql, values)
+        return threads.deferToThreadPool(reactor, self.readers,
+                                         self._read, sql, values)
+
+# Durability profiles, named by the node table's 'db_profile' column, and
+# applied each time the database is opened.
+DB_PROFILES = {
+    # SQLite's defaults: a rollback journal, and an fsync at every commit.
+    # Writers block readers, such as CLI commands polling the database.
+    "safe": [("journal_mode", "DELETE"),
+             ("synchronous", "FULL"),
+             ("busy_timeout", 5000),
+             ],
+    # a write-ahead log: readers and the writer don't block each other, and
+    # a commit only appends to the log. A power failure can lose the last
+    # few commits, but cannot corrupt the database.
+    "wal": [("journal_mode", "WAL"),
+            ("synchronous", "NORMAL"),
+            ("mmap_size", 64*1024*1024),
+            ("cache_size", -16*1024), # KiB
+            ("busy_timeout", 5000), # ms
+            ],
+    }
+DEFAULT_DB_PROFILE = "wal"
+
+def apply_profile(db, name):
+    if name not in DB_PROFILES:
+        raise DBError("unknown db_profile '%s'" % name)
+    for (pragma, value) in DB_PROFILES[name]:
+        db.execute("PRAGMA %s=%s" % (pragma, value))
+
+def get_db(dbfile, stderr=sys.stderr, check_same_thread=True):
     """Open or create the given db file. The parent directory must exist.
     Returns the db connection object, or raises DBError.
     """
 
     must_create = not os.path.exists(dbfile)
     try:
-        db = sqlite3.connect(dbfile)
+        db = sqlite3.connect(dbfile, check_same_thread=check_same_thread,
+                             detect_types=sqlite3.PARSE_DECLTYPES)
     except (EnvironmentError, sqlite3.OperationalError), e:
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
     db.row_factory = sqlite3.Row
+    db.create_function("unhex", 1, unhex)
 
-    VERSION = 1
     if must_create:
-        schema = get_schema(VERSION)
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL") # before any tables
+        schema = get_schema(1)
         db.executescript(schema)
-        db.execute("INSERT INTO version (version) VALUES (?)", (VERSION,))
+        db.execute("INSERT INTO version (version) VALUES (?)", (1,))
         db.commit()
 
     try:
@@ -87,10 +586,26 @@ def get_db(dbfile, stderr=sys.stderr):
         # Perhaps it was created with an old version, or it might be junk.
         raise DBError("db file is unusable: %s" % e)
 
-    if version != VERSION:
+    if version > TARGET_VERSION:
         raise DBError("Unable to handle db version %s" % version)
+    if version < TARGET_VERSION:
+        if not must_create:
+            print >>stderr, ("upgrading %s from version %d to %d"
+                             % (dbfile, version, TARGET_VERSION))
+        upgrade(db, version)
+        if version < 5 and not must_create:
+            print >>stderr, ("%s cannot give space back to the filesystem"
+                             " yet: stop the node and run 'petmail"
+                             " compact-db' to convert it" % dbfile)
+
+    # a brand-new database has no node row yet: the profile is applied
+    # from the next open onwards
+    row = db.execute("SELECT db_profile FROM node LIMIT 1").fetchone()
+    if row and row[0]:
+        apply_profile(db, str(row[0]))
 
     return db
 
 def make_observable_db(dbfile, stderr=sys.stderr):
-    return ObservableDatabase(get_db(dbfile, stderr))
+    # an AsyncDatabase may share this connection with its writer thread
+    return ObservableDatabase(get_db(dbfile, stderr, check_same_thread=False))
@@ -0,0 +1,8 @@
+
+-- secondary indexes, for the lookups that used to scan a whole table:
+-- a channel's messages, an invitation by its rendezvous ID, and the
+-- channel expecting an inbound msgC (mailbox.channel.identify_msgC)
+
+CREATE INDEX `inbound_messages_cid` ON `inbound_messages` (`cid`, `id`);
+CREATE INDEX `invitations_inviteID` ON `invitations` (`inviteID`);
+CREATE INDEX `addressbook_next_CID_token` ON `addressbook` (`next_CID_token`);
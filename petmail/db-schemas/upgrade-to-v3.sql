@@ -0,0 +1,92 @@
+
+-- keys and tokens are stored as BLOBs, rather than as hex strings. They
+-- are bound as database.blob(), and read back as str (get_db registers a
+-- converter for the BLOB column type). unhex() is provided by get_db, for
+-- this upgrade. SQLite can't change the type of a column, so the two tables
+-- are rebuilt, keeping their AUTOINCREMENT high-water marks, since ids
+-- must not be reused.
+
+CREATE TABLE `addressbook_v3`
+(
+ `id` INTEGER PRIMARY KEY AUTOINCREMENT, -- the channelID
+
+ -- our private notes and decisions about them
+ `petname` STRING,
+ `acked` INTEGER,
+ -- public notes about them
+
+ -- things used to send outbound messages
+    -- these three are shared among all of the recipient's mailboxes
+ `next_outbound_seqnum` INTEGER,
+ `my_signkey` BLOB,
+ `their_channel_record_json` STRING, -- .channel_pubkey, .CID_key, .transports
+
+ -- things used to handle inbound messages
+ `my_CID_key` BLOB,
+ `next_CID_token` BLOB,
+ `highest_inbound_seqnum` INTEGER,
+ `my_old_channel_privkey` BLOB,
+ `my_new_channel_privkey` BLOB,
+ `they_used_new_channel_key` INTEGER,
+ `their_verfkey` BLOB -- from their invitation message
+);
+
+INSERT INTO `addressbook_v3`
+ SELECT `id`, `petname`, `acked`,
+        `next_outbound_seqnum`, unhex(`my_signkey`),
+        `their_channel_record_json`,
+        unhex(`my_CID_key`), unhex(`next_CID_token`),
+        `highest_inbound_seqnum`,
+        unhex(`my_old_channel_privkey`), unhex(`my_new_channel_privkey`),
+        `they_used_new_channel_key`, unhex(`their_verfkey`)
+ FROM `addressbook`;
+DELETE FROM sqlite_sequence WHERE name='addressbook_v3';
+INSERT INTO sqlite_sequence (name, seq)
+ SELECT 'addressbook_v3', seq FROM sqlite_sequence WHERE name='addressbook';
+DROP TABLE `addressbook`;
+ALTER TABLE `addressbook_v3` RENAME TO `addressbook`;
+CREATE INDEX `addressbook_next_CID_token` ON `addressbook` (`next_CID_token`);
+
+CREATE TABLE `invitations_v3` -- data on all pending invitations
+(
+ `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+
+ `petname` STRING,
+
+ -- these are only used during the invitation process, then discarded
+ `code` BLOB,
+ `inviteKey` BLOB, -- Ed25519 signing key
+ `inviteID` STRING, -- Ed25519 verifying key, hex: the rendezvous channel
+ `myTempPrivkey` BLOB, -- Curve25519 privkey (ephemeral)
+ `theirTempPubkey` BLOB, -- Curve25519 pubkey (ephemeral)
+ -- these track the state of the invitation process
+ `myMessages` STRING, -- r0:hex,r0-hex of all my sent messages
+ `theirMessages` STRING, -- r0:hex,r0-hex of all processed inbound messages
+ `nextExpectedMessage` INTEGER,
+
+ -- these two are retained long-term, in the addressbook entry
+ `mySigningKey` BLOB, -- Ed25519 privkey (long-term), for this peer
+ `addressbook_id` INTEGER, -- to correlate with an addressbook entry
+
+ -- my (public) record: .channel_pubkey, .CID_key,
+ --  .transports[]: .STID, .transport_pubkey, .type, .url
+ `my_channel_record` STRING,
+ -- my private record: .my_signkey, .my_CID_key, .my_{old,new}_channel_privkey,
+ --  .transport_ids (points to 'transports' table)
+ `my_private_channel_data` STRING
+);
+
+INSERT INTO `invitations_v3`
+ SELECT `id`, `petname`,
+        unhex(`code`), unhex(`inviteKey`), `inviteID`,
+        unhex(`myTempPrivkey`), unhex(`theirTempPubkey`),
+        `myMessages`, `theirMessages`, `nextExpectedMessage`,
+        unhex(`mySigningKey`), `addressbook_id`,
+        `my_channel_record`, `my_private_channel_data`
+ FROM `invitations`;
+DELETE FROM sqlite_sequence WHERE name='invitations_v3';
+INSERT INTO sqlite_sequence (name, seq)
+ SELECT 'invitations_v3', seq FROM sqlite_sequence WHERE name='invitations';
+DROP TABLE `invitations`;
+ALTER TABLE `invitations_v3` RENAME TO `invitations`;
+CREATE INDEX `invitations_inviteID` ON `invitations` (`inviteID`);
@@ -0,0 +1,31 @@
+
+-- message bodies move out of inbound_messages, which keeps just the small
+-- columns that listing, counting and joining need, so a node with years of
+-- mail doesn't drag every body through the page cache to list them. Bodies
+-- are loaded by id, when they are asked for.
+
+CREATE TABLE `message_bodies`
+(
+ `message_id` INTEGER PRIMARY KEY, -- inbound_messages.id
+ `payload_json` STRING
+);
+
+INSERT INTO `message_bodies` SELECT `id`, `payload_json` FROM `inbound_messages`;
+
+CREATE TABLE `inbound_messages_v4`
+(
+ `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `cid` INTEGER, -- points to addressbook entry
+ `seqnum` INTEGER, -- scoped to channel
+ `payload_size` INTEGER -- of the body, in message_bodies
+);
+
+INSERT INTO `inbound_messages_v4`
+ SELECT `id`, `cid`, `seqnum`, length(`payload_json`) FROM `inbound_messages`;
+DELETE FROM sqlite_sequence WHERE name='inbound_messages_v4';
+INSERT INTO sqlite_sequence (name, seq)
+ SELECT 'inbound_messages_v4', seq FROM sqlite_sequence
+ WHERE name='inbound_messages';
+DROP TABLE `inbound_messages`;
+ALTER TABLE `inbound_messages_v4` RENAME TO `inbound_messages`;
+CREATE INDEX `inbound_messages_cid` ON `inbound_messages` (`cid`, `id`);
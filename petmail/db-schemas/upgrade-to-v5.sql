@@ -0,0 +1,28 @@
+
+-- messages older than the node's archive_after are moved out of the live
+-- database, into compressed archive files (petmail.archive). Each one leaves
+-- a row in archived_messages, which says where its body went, so the
+-- archive can still be listed and searched without opening those files.
+-- Messages from before this version are treated as received now.
+
+ALTER TABLE `inbound_messages` ADD COLUMN `received_at` INTEGER; -- seconds
+UPDATE `inbound_messages` SET `received_at` = CAST(strftime('%s','now') AS INTEGER);
+CREATE INDEX `inbound_messages_received_at` ON `inbound_messages` (`received_at`);
+
+CREATE TABLE `archived_messages`
+(
+ `id` INTEGER PRIMARY KEY, -- its inbound_messages.id, never reused
+ `cid` INTEGER,
+ `seqnum` INTEGER,
+ `payload_size` INTEGER,
+ `received_at` INTEGER,
+ `segment` INTEGER, -- ARCHIVEDIR/SEGMENT.arc
+ `offset` INTEGER, -- of the compressed block holding the body
+ `length` INTEGER -- of that block
+);
+CREATE INDEX `archived_messages_cid` ON `archived_messages` (`cid`, `id`);
+CREATE INDEX `archived_messages_received_at` ON `archived_messages` (`received_at`);
+
+-- seconds before a message is archived: NULL for the default
+-- (archive.DEFAULT_ARCHIVE_AFTER), 0 to keep everything in the database
+ALTER TABLE `node` ADD COLUMN `archive_after` INTEGER;
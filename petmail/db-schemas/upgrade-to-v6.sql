@@ -0,0 +1,28 @@
+
+-- settings which nodes created before migrations existed don't have yet.
+-- NULL means the default, as it did before each was added.
+
+-- if set, the mailbox (/mailbox and /retrieve) gets its own listener on
+-- this service descriptor, with its own limits, instead of the webport
+ALTER TABLE `node` ADD COLUMN `mailbox_port` STRING;
+ALTER TABLE `node` ADD COLUMN `mailbox_max_connections` INT; -- refuse beyond
+ALTER TABLE `node` ADD COLUMN `mailbox_timeout` INT; -- seconds, when idle
+
+-- durability profile, see database.DB_PROFILES
+ALTER TABLE `node` ADD COLUMN `db_profile` STRING;
+
+-- extra mailbox worker processes (relays only, see mailbox/workers.py)
+ALTER TABLE `mailbox_server_config` ADD COLUMN `workers` INT;
+
+-- if set, this relay is a shard: it accepts decrypted messages from a
+-- front end (see mailbox/shard.py) on this twisted service descriptor
+ALTER TABLE `mailbox_server_config` ADD COLUMN `shard_port` STRING;
+
+CREATE TABLE `mailbox_shards` -- if not empty, this relay is a front end
+(
+ `name` STRING,
+ `endpoint` STRING, -- client endpoint string for its shard_port
+ `baseurl` STRING, -- where its retrieval resource lives
+ `basedir` STRING, -- local basedir, for provisioning and migration
+ `draining` INT -- 1: no longer in the ring, transports are moving away
+);
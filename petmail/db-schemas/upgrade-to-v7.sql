@@ -0,0 +1,5 @@
+-- a shard only accepts messages from front ends which know its shard_key
+-- (hex), see mailbox/shard.py. A shard without one makes one up when it
+-- starts, and 'petmail add-shard' copies it into the front end's table.
+ALTER TABLE `mailbox_server_config` ADD COLUMN `shard_key` STRING;
+ALTER TABLE `mailbox_shards` ADD COLUMN `shard_key` STRING;
@@ -4,6 +4,8 @@ from hashlib import sha256
 from twisted.application import service
 from .hkdf import HKDF
 from .errors import CommandError
+from .mailbox.channel import build_CIDToken
+from .database import blob
 from nacl.signing import SigningKey, VerifyKey, BadSignatureError
 from nacl.public import PrivateKey, PublicKey, Box
 from nacl.encoding import HexEncoder as Hex
@@ -132,16 +134,17 @@ class InvitationManager(service.MultiService):
                         "  my_channel_record, my_private_channel_data,"
                         "  myMessages, theirMessages, nextExpectedMessage)"
                         " VALUES (?,?,?, ?, ?,?, ?,?, ?,?,?)",
-                        (code.encode("hex"), petname, stretched.encode("hex"),
+                        (blob(code), petname, blob(stretched),
                          inviteID,
-                         myTempPrivkey.encode(Hex), mySigningKey.encode(Hex),
+                         blob(myTempPrivkey.encode()),
+                         blob(mySigningKey.encode()),
                          json.dumps(pub_crec), json.dumps(priv_data),
                          "", "", 1),
                         "invitations")
         self.subscribe(inviteID)
         i = Invitation(iid, self.db, self)
         i.sendFirstMessage()
-        self.db.commit()
+        self.db.request_commit()
 
 class Invitation:
     # This has a brief lifetime: one is created in response to the rendezvous
@@ -165,10 +168,10 @@ class Invitation:
             raise KeyError("no pending Invitation for '%d'" % iid)
         self.petname = res[0]
         self.inviteID = res[1]
-        self.inviteKey = SigningKey(res[2].decode("hex"))
+        self.inviteKey = SigningKey(res[2])
         self.theirTempPubkey = None
         if res[3]:
-            self.theirTempPubkey = PublicKey(res[3].decode("hex"))
+            self.theirTempPubkey = PublicKey(res[3])
         self.nextExpectedMessage = int(res[4])
         self.myMessages = splitMessages(res[5])
         self.theirMessages = splitMessages(res[6])
@@ -181,12 +184,12 @@ class Invitation:
     def getMyTempPrivkey(self):
         c = self.db.execute("SELECT myTempPrivkey FROM invitations"
                             " WHERE id = ?", (self.iid,))
-        return PrivateKey(c.fetchone()[0].decode("hex"))
+        return PrivateKey(c.fetchone()[0])
 
     def getMySigningKey(self):
         c = self.db.execute("SELECT mySigningKey FROM invitations"
                             " WHERE id = ?", (self.iid,))
-        return SigningKey(c.fetchone()[0].decode("hex"))
+        return SigningKey(c.fetchone()[0])
 
     def getMyPublicChannelRecord(self):
         c = self.db.execute("SELECT my_channel_record FROM invitations"
@@ -274,7 +277,7 @@ class Invitation:
                         self.iid),
                        "invitations", self.iid)
         #print " db.commit"
-        self.db.commit()
+        self.db.request_commit()
 
     def findPrefixAndCall(self, prefix, bodies, handler):
         for msg in bodies:
@@ -298,7 +301,7 @@ class Invitation:
         self.theirTempPubkey = PublicKey(msg)
         self.db.update("UPDATE invitations SET theirTempPubkey=?"
                        " WHERE id=?",
-                       (self.theirTempPubkey.encode(Hex), self.iid),
+                       (blob(self.theirTempPubkey.encode()), self.iid),
                        "invitations", self.iid)
         # theirTempPubkey will committed by our caller, in the same txn as
         # the message send
@@ -352,7 +355,10 @@ class Invitation:
             raise ValueError("binding failure theirTempPubkey")
 
         them = json.loads(their_channel_record_json)
-        me = self.getMyPrivateChannelData()
+        # (the channel data is JSON, so its keys are hex)
+        me = dict([(k, v.decode("hex")) for (k, v)
+                   in self.getMyPrivateChannelData().items()
+                   if k.startswith("my_")])
         addressbook_id = self.db.insert(
             "INSERT INTO addressbook"
             " (petname, acked,"
@@ -370,13 +376,14 @@ class Invitation:
             "         ?,?,"
             "         ?,?)",
             (self.petname, 0,
-             1, me["my_signkey"],
+             1, blob(me["my_signkey"]),
              json.dumps(them),
-             me["my_CID_key"], None,
+             blob(me["my_CID_key"]),
+             blob(build_CIDToken(me["my_CID_key"], 1)),
              0,
-             me["my_old_channel_privkey"],
-             me["my_new_channel_privkey"],
-             0, theirVerfkey.encode(Hex) ),
+             blob(me["my_old_channel_privkey"]),
+             blob(me["my_new_channel_privkey"]),
+             0, blob(theirVerfkey.encode()) ),
             "addressbook")
         self.db.update("UPDATE invitations SET addressbook_id=?"
                        " WHERE id=?", (addressbook_id, self.iid),
@@ -2,6 +2,7 @@ import struct, json, os
 from hashlib import sha256
 from twisted.internet import defer
 from ..errors import ReplayError, WrongVerfkeyError, UnknownChannelError
+from ..database import blob
 from ..util import split_into, verify_with_prefix
 from ..hkdf import HKDF
 from ..netstring import netstring, split_netstrings_and_trailer
@@ -35,17 +36,31 @@ def parse_msgC(msgC):
     return CIDToken, CIDBox, msgD
 
 def find_channel_from_CIDToken(db, CIDToken):
-    # XXX not implemented
-    cid = None
+    # each channel remembers the CIDToken that its next message will carry,
+    # so the message we expect next is found with a single lookup, without
+    # trying any keys. Anything else (out of order, or not for us) falls
+    # back to find_channel_from_CIDBox.
+    c = db.execute("SELECT id FROM addressbook WHERE next_CID_token=?",
+                   (blob(CIDToken),))
+    row = c.fetchone()
+    cid = row["id"] if row else None
     known_channel_pubkey = None # e.g. unknown
     return cid, known_channel_pubkey
 
+def identify_msgC(db, msgC):
+    """Return the cid of the channel which expects this msgC next, or None
+    if it can only be identified the slow way (by trial decryption)."""
+    if not msgC.startswith("c0:"):
+        return None
+    CIDToken = msgC[len("c0:"):len("c0:")+32]
+    return find_channel_from_CIDToken(db, CIDToken)[0]
+
 def find_channel_from_CIDBox(db, CIDBox):
     c = db.execute("SELECT id, my_CID_key, highest_inbound_seqnum"
                    " FROM addressbook")
     for row in c.fetchall():
         try:
-            CIDKey = row["my_CID_key"].decode("hex")
+            CIDKey = row["my_CID_key"]
             seqnum, HmsgD, channel_pubkey_s = decrypt_CIDBox(CIDKey, CIDBox)
             # if we get here, the CIDBox matches this channel. We're allowed
             # to reject the message if the seqnum shows it to be a replay.
@@ -68,10 +83,10 @@ def build_channel_keylist(db, known_cid):
                        "       my_new_channel_privkey"
                        " FROM addressbook")
     for row in c.fetchall():
-        privkey = PrivateKey(row["my_old_channel_privkey"].decode("hex"))
+        privkey = PrivateKey(row["my_old_channel_privkey"])
         yield (privkey, (row["id"], "old", privkey.public_key))
 
-        privkey = PrivateKey(row["my_new_channel_privkey"].decode("hex"))
+        privkey = PrivateKey(row["my_new_channel_privkey"])
         yield (privkey, (row["id"], "new", privkey.public_key))
 
 def filter_on_known_channel_pubkey(keylist, known_channel_pubkey_s):
@@ -141,7 +156,9 @@ def validate_msgC(CIDKey, channel_pubkey,
     # ok, message is valid. Caller should update highest_seen_seqnum and
     # deliver the payload
 
-def process_msgC(db, msgC):
+def check_msgC(db, msgC):
+    # I only read: the caller records the new seqnum with record_seqnum(),
+    # in the same transaction that stores the payload
     CIDToken, CIDBox, msgD = parse_msgC(msgC)
     keylist = find_channel_list(db, CIDToken, CIDBox)
     keyid, pubkey2_s, msgE = decrypt_msgD(msgD, keylist)
@@ -152,14 +169,31 @@ def process_msgC(db, msgC):
                    " FROM addressbook WHERE id=?", (cid,))
     row = c.fetchone()
     seqnum, payload_s = check_msgE(msgE, pubkey2_s,
-                                   row["their_verfkey"].decode("hex"),
+                                   row["their_verfkey"],
                                    row["highest_inbound_seqnum"])
     # seqnum > highest_inbound_seqnum
-    validate_msgC(row["my_CID_key"].decode("hex"), channel_pubkey,
+    validate_msgC(row["my_CID_key"], channel_pubkey,
                   seqnum, CIDBox, CIDToken, msgD)
-    db.update("UPDATE addressbook SET highest_inbound_seqnum=? WHERE id=?",
-              (seqnum, cid), "addressbook", cid)
-    db.commit() # TODO: allow caller to do the commit
+    return cid, seqnum, payload_s
+
+def record_seqnum(db, cid, seqnum):
+    # checked again here, since another copy of the message may have been
+    # recorded after check_msgC() looked
+    c = db.execute("SELECT my_CID_key, highest_inbound_seqnum"
+                   " FROM addressbook WHERE id=?", (cid,))
+    row = c.fetchone()
+    if seqnum <= row["highest_inbound_seqnum"]:
+        raise ReplayError()
+    next_CID_token = build_CIDToken(row["my_CID_key"], seqnum+1)
+    db.update("UPDATE addressbook"
+              " SET highest_inbound_seqnum=?, next_CID_token=?"
+              " WHERE id=?",
+              (seqnum, blob(next_CID_token), cid), "addressbook", cid)
+
+def process_msgC(db, msgC):
+    cid, seqnum, payload_s = check_msgC(db, msgC)
+    record_seqnum(db, cid, seqnum)
+    # the caller commits, along with whatever it does with the payload
     return cid, seqnum, payload_s
 
 def build_CIDToken(CIDKey, seqnum):
@@ -169,35 +203,55 @@ def build_CIDToken(CIDKey, seqnum):
 assert struct.calcsize(">Q")*8 == 64
 
 class OutboundChannel:
-    # I am created to send messages.
-    def __init__(self, db, cid):
+    # I am created to send messages. If I'm given an AsyncDatabase, the
+    # seqnum is allocated and committed on its writer thread.
+    def __init__(self, db, cid, adb=None):
         self.db = db
         self.cid = cid
+        self.adb = adb
 
     def send(self, payload):
         # returns a Deferred that fires when the delivery is complete, so
         # tests can synchronize
-        msgC = self.createMsgC(payload)
-        dl = []
-        for t in self.createTransports():
-            # now wrap msgC into a msgA for each transport they're using
-            dl.append(t.send(msgC))
-        return defer.DeferredList(dl)
+        if self.adb:
+            d = self.adb.run(self.allocate_seqnum)
+            d.addCallback(self.build_msgC, payload)
+            committed = self.adb.request_commit()
+        else:
+            d = defer.succeed(self.createMsgC(payload))
+            committed = self.db.request_commit()
+        # the seqnum must be durable before the message leaves, or a crash
+        # could make us use it twice
+        d.addCallback(lambda msgC: committed.addCallback(lambda _: msgC))
+        def _send(msgC):
+            dl = []
+            for t in self.createTransports():
+                # now wrap msgC into a msgA for each transport they're using
+                dl.append(t.send(msgC))
+            return defer.DeferredList(dl)
+        d.addCallback(_send)
+        return d
 
     def createMsgC(self, payload):
-        c = self.db.execute("SELECT next_outbound_seqnum, my_signkey,"
-                            " their_channel_record_json"
-                            " FROM addressbook WHERE id=?", (self.cid,))
+        return self.build_msgC(self.allocate_seqnum(self.db), payload)
+
+    def allocate_seqnum(self, db):
+        # returns (seqnum, addressbook row), the caller commits
+        c = db.execute("SELECT next_outbound_seqnum, my_signkey,"
+                       " their_channel_record_json"
+                       " FROM addressbook WHERE id=?", (self.cid,))
         res = c.fetchone()
         assert res, "missing cid"
         next_outbound_seqnum = res["next_outbound_seqnum"]
-        self.db.update("UPDATE addressbook SET next_outbound_seqnum=?"
-                       " WHERE id=?",
-                       (next_outbound_seqnum+1, self.cid),
-                       "addressbook", self.cid)
-        self.db.commit()
+        db.update("UPDATE addressbook SET next_outbound_seqnum=?"
+                  " WHERE id=?",
+                  (next_outbound_seqnum+1, self.cid),
+                  "addressbook", self.cid)
+        return next_outbound_seqnum, res
+
+    def build_msgC(self, (next_outbound_seqnum, res), payload):
         seqnum_s = struct.pack(">Q", next_outbound_seqnum)
-        my_signkey = SigningKey(res["my_signkey"].decode("hex"))
+        my_signkey = SigningKey(res["my_signkey"])
         privkey2 = PrivateKey.generate()
         pubkey2 = privkey2.public_key.encode()
         assert len(pubkey2) == 32
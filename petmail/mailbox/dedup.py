@@ -0,0 +1,120 @@
+
+# I remember recently-seen messages, so the mailbox server can drop
+# duplicates. Senders retry when they don't hear back, and they may send the
+# same message through several of our transports, so the same msgA (or,
+# re-encrypted, the same msgC) can arrive more than once. A duplicate is
+# acknowledged as usual, but it is not queued or delivered again, which
+# saves queue space, retrieval bandwidth, and a trial decryption on the
+# recipient's side.
+#
+# A message is only remembered once it has been accepted (queued, or
+# handed to the local transport). A duplicate that arrives while the
+# original is still on its way waits for it. If the original is accepted,
+# so is the duplicate. If it fails (its queue is full, or its shard is
+# unreachable), the failure is not shared: the duplicate is handled again,
+# as if it had arrived just then, and gets a result of its own.
+#
+# Each process keeps its own filter. With worker processes
+# (mailbox.workers), a duplicate that reaches a different process than the
+# original is queued again. That happens for some of the retries, and
+# fan-out copies, but no message is lost by it.
+#
+# The window is bounded in both time and size: a duplicate that arrives long
+# after the original, or after many other messages, is delivered again.
+# That is no worse than not checking at all, since the recipient has to cope
+# with duplicates anyway.
+
+import time
+from hashlib import sha256
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.python import log, failure
+
+DEFAULT_WINDOW = 60*60
+DEFAULT_MAX_ENTRIES = 100000
+
+def message_hash(*pieces):
+    h = sha256()
+    for p in pieces:
+        h.update(p) # p might be an mmap
+    return h.digest()
+
+class DuplicateFilter:
+    """I hold the hashes of the messages accepted in the last 'window'
+    seconds, at most 'max_entries' of them, oldest first, and those of the
+    messages which are still being handled."""
+    def __init__(self, window=DEFAULT_WINDOW, max_entries=DEFAULT_MAX_ENTRIES,
+                 clock=time.time):
+        self.window = window
+        self.max_entries = max_entries
+        self.clock = clock
+        self.seen = OrderedDict() # hash -> when accepted
+        self.in_flight = {} # hash -> Deferreds waiting for its result
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, h, func, *args):
+        """Handle the message whose hash is 'h' with func(*args), which
+        returns None or a Deferred, unless it is a duplicate. Returns None
+        for a duplicate of a recently-accepted message, and a Deferred for a
+        duplicate of one in flight, which fires with the original's result
+        if that succeeds. 'h' is remembered once func's result succeeds. If
+        it fails instead, the duplicates that waited for it run func
+        again."""
+        when = self.seen.get(h)
+        if when is not None and when >= self.clock() - self.window:
+            self.hits += 1
+            return None
+        if h in self.in_flight:
+            self.hits += 1
+            d = defer.Deferred()
+            self.in_flight[h].append(d)
+            return d
+        self.misses += 1
+        d = func(*args) # if this raises, nothing was accepted
+        if not isinstance(d, defer.Deferred):
+            self.remember(h)
+            return d
+        self.in_flight[h] = []
+        def _done(res):
+            waiting = self.in_flight.pop(h)
+            if isinstance(res, failure.Failure):
+                # the first of them runs func again, the rest wait for it
+                for w in waiting:
+                    d2 = defer.maybeDeferred(self.run, h, func, *args)
+                    d2.chainDeferred(w)
+            else:
+                self.remember(h)
+                for w in waiting:
+                    w.callback(res)
+            return res
+        d.addBoth(_done)
+        return d
+
+    def remember(self, h):
+        self.seen.pop(h, None)
+        self.seen[h] = self.clock()
+        while len(self.seen) > self.max_entries:
+            self.seen.popitem(last=False)
+
+    def prune(self):
+        cutoff = self.clock() - self.window
+        while self.seen:
+            h, when = next(self.seen.iteritems())
+            if when >= cutoff:
+                break
+            del self.seen[h]
+
+    def get_stats(self):
+        return {"duplicates": self.hits,
+                "unique": self.misses,
+                "tracked": len(self.seen),
+                "in_flight": len(self.in_flight),
+                }
+
+    def log_stats(self):
+        if not (self.hits or self.misses):
+            return
+        log.msg("mailbox duplicates: %(duplicates)d dropped, %(unique)d"
+                " unique, %(tracked)d tracked, %(in_flight)d in flight"
+                % self.get_stats())
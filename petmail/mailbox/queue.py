@@ -0,0 +1,523 @@
+
+# I manage the on-disk message queues of a mailbox server. Each registered
+# transport (one per recipient) gets its own directory, named by the hex of
+# its TID tokenid:
+#
+#  QUEUEDIR/TIDHEX/transport.json  : retention period, segment size,
+#                                    retrieval_id, quotas, session keys
+#  QUEUEDIR/TIDHEX/START.seg       : netstring(msgC) records, append-only
+#  QUEUEDIR/TIDHEX/START.idx       : one INDEX_RECORD per .seg record
+#  QUEUEDIR/TIDHEX/cursor.json     : (START, position) of the oldest
+#                                    message not yet retrieved
+#  QUEUEDIR/TIDHEX/counters        : one COUNTERS record: how many messages
+#                                    are queued, their total size, and when
+#                                    the oldest was enqueued
+#  QUEUEDIR/sweep-stats.json       : what the RetentionSweeper has reclaimed
+#
+# Messages are bucketed into segments by the time they were enqueued: START
+# is the (integer) time at which the segment's bucket begins. Everything in
+# a segment expires together, so enforcing the retention period is a matter
+# of unlinking whole segments, without looking at individual messages. A
+# TransportQueue remembers when its oldest segment will expire, so a sweep
+# skips the queues which have nothing old enough to drop.
+#
+# A record is appended to the .seg file before its index entry is appended
+# to the .idx file, so the index only ever points at complete records. A
+# crash between the two leaves some unindexed bytes at the end of the
+# segment, which are never served and vanish when the segment expires.
+#
+# Several processes may share a QueueStore (see mailbox.workers), so appends
+# and retrievals for each transport are serialized by an flock() on its
+# 'lock' file.
+#
+# The counters are updated (under the lock) by every enqueue, retrieval, and
+# expiry, so checking a transport's quota, or listing the busiest transports,
+# never has to scan its queue.
+#
+# Retrieval advances the cursor. Segments which lie entirely behind the
+# cursor are dropped right away, rather than waiting for them to expire.
+# Since .seg records are stored already netstring-framed, a retrieval
+# response is just a list of byte ranges of .seg files (see pending()),
+# which the server streams out without parsing them.
+
+import os, json, time, struct, fcntl, mmap, shutil
+from contextlib import contextmanager
+from nacl.public import PrivateKey, PublicKey
+from twisted.application import service, internet
+from twisted.python import log
+from ..netstring import netstring
+
+DEFAULT_SEGMENT_SECONDS = 60*60
+DEFAULT_RETENTION = 14*24*60*60
+DEFAULT_SWEEP_INTERVAL = 10*60
+
+# (offset of the netstring within .seg, length of the netstring, enqueue
+# time in seconds)
+INDEX_RECORD = struct.Struct(">QQQ")
+# (queued messages, queued bytes, enqueue time of the oldest, or 0)
+COUNTERS = struct.Struct(">QQQ")
+
+class QuotaExceededError(Exception):
+    """The transport's queue is full: the message was not queued."""
+
+class TransportQueue:
+    def __init__(self, dirname, clock=time.time):
+        self.dirname = dirname
+        self.TID_tokenid = os.path.basename(dirname).decode("hex")
+        self.clock = clock
+        with open(os.path.join(dirname, "transport.json"), "rb") as f:
+            self.config = json.load(f)
+        self.segment_seconds = int(self.config.get("segment_seconds",
+                                                   DEFAULT_SEGMENT_SECONDS))
+        self.retention = int(self.config.get("retention", DEFAULT_RETENTION))
+        self.retrieval_id = self.config.get("retrieval_id")
+        self.next_expiry = None # unknown until our first expire()
+        # None means unlimited
+        self.quota_messages = self.config.get("quota_messages")
+        self.quota_bytes = self.config.get("quota_bytes")
+        # our share of the server's disk and bandwidth (mailbox.scheduler)
+        self.weight = self.config.get("weight") or 1
+        # retrieval session keys (see mailbox.session). Transports without
+        # them are retrieved in the clear.
+        self.server_privkey = self.retrieval_pubkey = None
+        if self.config.get("server_privkey"):
+            self.server_privkey = PrivateKey(
+                self.config["server_privkey"].decode("hex"))
+            self.retrieval_pubkey = PublicKey(
+                self.config["retrieval_pubkey"].decode("hex"))
+
+    def _fn(self, start, suffix):
+        return os.path.join(self.dirname, "%d.%s" % (start, suffix))
+
+    def bucket(self, when):
+        when = int(when)
+        return when - (when % self.segment_seconds)
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.dirname, "lock"), "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_counters(self):
+        """Return (messages, bytes, oldest) for the messages which are
+        queued and not yet retrieved. 'bytes' includes netstring framing.
+        'oldest' is the enqueue time of the oldest message, or 0."""
+        with self.locked():
+            return self._get_counters()
+
+    def _get_counters(self):
+        # call with the lock held
+        try:
+            with open(os.path.join(self.dirname, "counters"), "rb") as f:
+                return COUNTERS.unpack(f.read(COUNTERS.size))
+        except (EnvironmentError, struct.error):
+            # written by a version which didn't keep counters
+            return self.recount()
+
+    def _set_counters(self, messages, bytes, oldest):
+        # a single small write into an existing file, so it is atomic
+        fn = os.path.join(self.dirname, "counters")
+        with open(fn, "r+b" if os.path.exists(fn) else "wb") as f:
+            f.write(COUNTERS.pack(messages, bytes, oldest))
+
+    def _oldest(self):
+        r = self.next_record()
+        if not r:
+            return 0
+        start, position, offset, length = r
+        return self.read_index_entry(start, position)[2]
+
+    def recount(self):
+        # the slow way, used to rebuild the counters. Call with the lock held.
+        counters = self._count(self.get_cursor()) + (self._oldest(),)
+        self._set_counters(*counters)
+        return counters
+
+    def check_quota(self, length, counters=None):
+        """Raise QuotaExceededError if a msgC of this length would not fit
+        in the queue."""
+        if counters is None:
+            counters = self.get_counters()
+        messages, bytes, oldest = counters
+        size = len("%d:," % length) + length
+        if (self.quota_messages is not None
+            and messages + 1 > self.quota_messages):
+            raise QuotaExceededError("too many messages queued")
+        if self.quota_bytes is not None and bytes + size > self.quota_bytes:
+            raise QuotaExceededError("too many bytes queued")
+
+    def enqueue(self, msgC):
+        record = netstring(msgC)
+        with self.locked():
+            counters = messages, bytes, oldest = self._get_counters()
+            self.check_quota(len(msgC), counters)
+            now = self.clock()
+            start = self.bucket(now)
+            with open(self._fn(start, "seg"), "ab") as f:
+                f.seek(0, 2)
+                offset = f.tell()
+                f.write(record)
+            with open(self._fn(start, "idx"), "ab") as f:
+                f.write(INDEX_RECORD.pack(offset, len(record), int(now)))
+            self._set_counters(messages+1, bytes+len(record),
+                               oldest or int(now))
+        return start, offset
+
+    def list_segments(self):
+        starts = []
+        for fn in os.listdir(self.dirname):
+            name, ext = os.path.splitext(fn)
+            if ext == ".seg" and name.isdigit():
+                starts.append(int(name))
+        return sorted(starts)
+
+    def read_index(self, start):
+        # returns a list of (offset, length, timestamp)
+        try:
+            with open(self._fn(start, "idx"), "rb") as f:
+                data = f.read()
+        except EnvironmentError:
+            return []
+        size = INDEX_RECORD.size
+        return [INDEX_RECORD.unpack_from(data, i)
+                for i in range(0, len(data) - len(data) % size, size)]
+
+    def read_index_entry(self, start, position):
+        try:
+            with open(self._fn(start, "idx"), "rb") as f:
+                f.seek(position * INDEX_RECORD.size)
+                data = f.read(INDEX_RECORD.size)
+        except EnvironmentError:
+            return None
+        if len(data) < INDEX_RECORD.size:
+            return None
+        return INDEX_RECORD.unpack(data)
+
+    def scan_index(self, start, position):
+        """Yield (position, offset, length, timestamp) for every message in
+        the segment from 'position' onwards. The index is mmapped, so a long
+        backlog is not copied into memory to be scanned."""
+        try:
+            f = open(self._fn(start, "idx"), "rb")
+        except EnvironmentError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // INDEX_RECORD.size
+            if position >= count:
+                return
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for p in range(position, count):
+                    entry = INDEX_RECORD.unpack_from(m, p*INDEX_RECORD.size)
+                    yield (p,) + entry
+            finally:
+                m.close()
+
+    def pending(self, max_bytes):
+        """Plan a retrieval of the oldest messages not yet retrieved. I
+        return (ranges, last): 'ranges' is a list of (start, offset, length)
+        byte ranges of .seg files which together hold the messages' records,
+        in order, and 'last' is the (start, position) to pass to consume()
+        once they have been delivered. I stop before 'max_bytes', but always
+        include at least one message. I return None if there is nothing to
+        retrieve."""
+        cursor_start, cursor_position = self.get_cursor()
+        ranges = []
+        last = None
+        total = 0
+        for start in self.list_segments():
+            if start < cursor_start:
+                continue # already retrieved, waiting to be dropped
+            first = cursor_position if start == cursor_start else 0
+            for (position, offset, length, when) in self.scan_index(start,
+                                                                    first):
+                if last and total + length > max_bytes:
+                    return ranges, last
+                if (ranges and ranges[-1][0] == start
+                    and sum(ranges[-1][1:]) == offset):
+                    # adjacent records coalesce into a single range
+                    ranges[-1] = (start, ranges[-1][1], ranges[-1][2]+length)
+                else:
+                    ranges.append((start, offset, length))
+                last = (start, position)
+                total += length
+        if not last:
+            return None
+        return ranges, last
+
+    def open_segment(self, start):
+        return open(self._fn(start, "seg"), "rb")
+
+    def read_record(self, start, offset, length):
+        with open(self._fn(start, "seg"), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def segment_size(self, start):
+        size = 0
+        for suffix in ("seg", "idx"):
+            try:
+                size += os.stat(self._fn(start, suffix)).st_size
+            except EnvironmentError:
+                pass
+        return size
+
+    def drop_segment(self, start):
+        size = self.segment_size(start)
+        for suffix in ("seg", "idx"):
+            try:
+                os.unlink(self._fn(start, suffix))
+            except EnvironmentError:
+                pass
+        return size
+
+    def get_cursor(self):
+        try:
+            with open(os.path.join(self.dirname, "cursor.json"), "rb") as f:
+                return tuple(json.load(f))
+        except EnvironmentError:
+            return (0, 0)
+
+    def set_cursor(self, start, position):
+        fn = os.path.join(self.dirname, "cursor.json")
+        with open(fn+".tmp", "wb") as f:
+            json.dump([start, position], f)
+        os.rename(fn+".tmp", fn)
+
+    def next_record(self):
+        """Return (start, position, offset, length) for the oldest message
+        which has not yet been retrieved, or None if there are none."""
+        cursor_start, cursor_position = self.get_cursor()
+        for start in self.list_segments():
+            if start < cursor_start:
+                continue # already retrieved, waiting to be dropped
+            position = cursor_position if start == cursor_start else 0
+            entry = self.read_index_entry(start, position)
+            if entry:
+                offset, length, when = entry
+                return start, position, offset, length
+        return None
+
+    def _count(self, first, last=None):
+        # returns (messages, bytes) queued from cursor 'first' up to and
+        # including message 'last' (or to the end)
+        messages = bytes = 0
+        for start in self.list_segments():
+            if start < first[0]:
+                continue
+            if last and start > last[0]:
+                break
+            for (position, offset, length, when) in self.scan_index(
+                start, first[1] if start == first[0] else 0):
+                if last and (start, position) > last:
+                    break
+                messages += 1
+                bytes += length
+        return messages, bytes
+
+    def consume(self, start, position):
+        """Mark everything up to and including the given message as
+        retrieved. Drop the segments that this empties, unless they might
+        still grow. Call with the lock held."""
+        cursor = self.get_cursor()
+        if cursor > (start, position):
+            return # a concurrent retrieval got further than we did
+        gone_messages, gone_bytes = self._count(cursor, (start, position))
+        messages, bytes, oldest = self._get_counters()
+        self.set_cursor(start, position+1)
+        current = self.bucket(self.clock())
+        for s in self.list_segments():
+            if s < start:
+                self.drop_segment(s)
+            elif (s == start and s != current
+                  and not self.read_index_entry(s, position+1)):
+                self.drop_segment(s)
+        self._set_counters(max(0, messages - gone_messages),
+                           max(0, bytes - gone_bytes), self._oldest())
+
+    def is_expired(self, start, now):
+        return start + self.segment_seconds + self.retention <= now
+
+    def expire(self, now=None):
+        """Drop every segment whose newest possible message is older than
+        the retention period. Returns (segments, bytes) reclaimed."""
+        if now is None:
+            now = self.clock()
+        if self.next_expiry is not None and now < self.next_expiry:
+            return 0, 0 # without listing the segments
+        segments = bytes = 0
+        with self.locked():
+            counters = None
+            # new segments can only be younger than those we see now
+            self.next_expiry = (self.bucket(now) + self.segment_seconds
+                                + self.retention)
+            for start in self.list_segments():
+                if not self.is_expired(start, now):
+                    # segments are sorted, the rest are younger
+                    self.next_expiry = (start + self.segment_seconds
+                                        + self.retention)
+                    break
+                if counters is None:
+                    counters = list(self._get_counters())
+                cursor = max(self.get_cursor(), (start, 0))
+                gone_messages, gone_bytes = self._count(cursor,
+                                                        (start, 1<<63))
+                counters[0] = max(0, counters[0] - gone_messages)
+                counters[1] = max(0, counters[1] - gone_bytes)
+                bytes += self.drop_segment(start)
+                segments += 1
+            if counters is not None:
+                self._set_counters(counters[0], counters[1], self._oldest())
+        return segments, bytes
+
+class QueueStore:
+    """I hold the TransportQueues for a mailbox server. Transports are
+    registered on disk, so they can be provisioned by a separate process
+    (e.g. a CLI command) while the server is running."""
+    def __init__(self, basedir, clock=time.time):
+        self.basedir = basedir
+        self.clock = clock
+        self.queues = {}
+        self.retrieval_ids = {}
+        self.stats = self.get_sweep_stats()
+
+    def _dirname(self, TID_tokenid):
+        return os.path.join(self.basedir, TID_tokenid.encode("hex"))
+
+    def add_transport(self, TID_tokenid, retention=DEFAULT_RETENTION,
+                      segment_seconds=DEFAULT_SEGMENT_SECONDS,
+                      retrieval_id=None, quota_messages=None,
+                      quota_bytes=None, server_privkey=None,
+                      retrieval_pubkey=None, weight=1):
+        dirname = self._dirname(TID_tokenid)
+        if os.path.exists(dirname):
+            raise KeyError("transport already registered")
+        os.makedirs(dirname)
+        config = {"retention": retention,
+                  "segment_seconds": segment_seconds,
+                  "retrieval_id": retrieval_id,
+                  "quota_messages": quota_messages,
+                  "quota_bytes": quota_bytes,
+                  "server_privkey": server_privkey,
+                  "retrieval_pubkey": retrieval_pubkey,
+                  "weight": weight,
+                  }
+        with open(os.path.join(dirname, "counters"), "wb") as f:
+            f.write(COUNTERS.pack(0, 0, 0))
+        with open(os.path.join(dirname, "transport.json"), "wb") as f:
+            json.dump(config, f)
+        return self.get_transport(TID_tokenid)
+
+    def get_transport(self, TID_tokenid):
+        q = self.queues.get(TID_tokenid)
+        if q is None:
+            dirname = self._dirname(TID_tokenid)
+            if not os.path.exists(os.path.join(dirname, "transport.json")):
+                return None
+            q = self.queues[TID_tokenid] = TransportQueue(dirname, self.clock)
+            if q.retrieval_id:
+                self.retrieval_ids[q.retrieval_id] = q
+        return q
+
+    def get_transport_by_retrieval_id(self, retrieval_id):
+        if retrieval_id not in self.retrieval_ids:
+            # it may have been provisioned since we last looked
+            for TID_tokenid in self.list_transports():
+                self.get_transport(TID_tokenid)
+        return self.retrieval_ids.get(retrieval_id)
+
+    def list_transports(self):
+        if not os.path.isdir(self.basedir):
+            return []
+        # skip TIDHEX.moving, a half-finished move_transport()
+        return [name.decode("hex") for name in sorted(os.listdir(self.basedir))
+                if "." not in name
+                and os.path.exists(os.path.join(self.basedir, name,
+                                                "transport.json"))]
+
+    def forget(self, TID_tokenid):
+        q = self.queues.pop(TID_tokenid, None)
+        if q and q.retrieval_id:
+            self.retrieval_ids.pop(q.retrieval_id, None)
+
+    def move_transport(self, TID_tokenid, other):
+        """Move a transport, with its queue, to another QueueStore (on the
+        same machine, e.g. that of another mailbox shard)."""
+        q = self.get_transport(TID_tokenid)
+        target = other._dirname(TID_tokenid)
+        if os.path.exists(target):
+            raise KeyError("transport already registered there")
+        if not os.path.isdir(other.basedir):
+            os.makedirs(other.basedir)
+        with q.locked():
+            # copy then rename, so the other store never sees half of it.
+            # Deliveries which arrive here in the meantime wait for the
+            # lock, then fail (see mailbox.shard.ShardServerFactory)
+            moving = target + ".moving"
+            if os.path.exists(moving):
+                shutil.rmtree(moving)
+            shutil.copytree(q.dirname, moving)
+            os.rename(moving, target)
+            shutil.rmtree(q.dirname)
+        self.forget(TID_tokenid)
+
+    def get_sweep_stats(self):
+        """Return the RetentionSweeper's totals, as last written to disk (by
+        whichever process runs it)."""
+        stats = {"sweeps": 0,
+                 "segments_reclaimed": 0,
+                 "bytes_reclaimed": 0,
+                 "last_sweep": None,
+                 }
+        try:
+            with open(os.path.join(self.basedir, "sweep-stats.json"),
+                      "rb") as f:
+                stats.update(json.load(f))
+        except (EnvironmentError, ValueError):
+            pass
+        return stats
+
+    def expire(self):
+        """Drop the expired segments of every transport. Returns (segments,
+        bytes) reclaimed, and adds them to self.stats."""
+        now = self.clock()
+        reclaimed_segments = reclaimed_bytes = 0
+        for TID_tokenid in self.list_transports():
+            segments, bytes = self.get_transport(TID_tokenid).expire(now)
+            reclaimed_segments += segments
+            reclaimed_bytes += bytes
+        self.stats["sweeps"] += 1
+        self.stats["segments_reclaimed"] += reclaimed_segments
+        self.stats["bytes_reclaimed"] += reclaimed_bytes
+        self.stats["last_sweep"] = now
+        if os.path.isdir(self.basedir):
+            # written aside then renamed, so readers never see half of it
+            fn = os.path.join(self.basedir, "sweep-stats.json")
+            with open(fn + ".tmp", "wb") as f:
+                json.dump(self.stats, f)
+            os.rename(fn + ".tmp", fn)
+        return reclaimed_segments, reclaimed_bytes
+
+class RetentionSweeper(service.MultiService):
+    """I periodically drop expired segments from a QueueStore."""
+    def __init__(self, store, interval=DEFAULT_SWEEP_INTERVAL):
+        service.MultiService.__init__(self)
+        self.store = store
+        t = internet.TimerService(interval, self.sweep)
+        t.setServiceParent(self)
+
+    def sweep(self):
+        try:
+            segments, bytes = self.store.expire()
+        except EnvironmentError:
+            log.err()
+            return
+        stats = self.store.stats
+        log.msg("mailbox sweep: %d segments (%d bytes) reclaimed,"
+                " %d bytes in all %d sweeps"
+                % (segments, bytes, stats["bytes_reclaimed"], stats["sweeps"]))
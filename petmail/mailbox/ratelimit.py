@@ -0,0 +1,117 @@
+
+# I provide token-bucket rate limiters for the mailbox inlet. Anyone can POST
+# to a mailbox, and every msgA costs us a Curve25519 decryption, so we want
+# to throw away abusive traffic before we spend any CPU on it.
+
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    """I hold up to 'burst' tokens, refilled at 'rate' tokens per second.
+    Each accepted event costs some tokens."""
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = now
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.last)
+        self.tokens = min(self.burst, self.tokens + elapsed*self.rate)
+        self.last = now
+
+    def consume(self, now, cost=1.0):
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class KeyedRateLimiter:
+    """I maintain one TokenBucket per key (e.g. per source address). To keep
+    memory bounded against an attacker who rotates keys, I remember at most
+    'max_keys' buckets, and forget the least-recently-used one when I need
+    room. A forgotten bucket is equivalent to a full one, so the eviction
+    only ever makes me more lenient, never less.
+    """
+    def __init__(self, rate, burst, max_keys=10000, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.rejected = 0
+
+    def allow(self, key, cost=1.0):
+        now = self.clock()
+        b = self.buckets.pop(key, None)
+        if b is None:
+            b = TokenBucket(self.rate, self.burst, now)
+        self.buckets[key] = b # most-recently-used at the end
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        if b.consume(now, cost):
+            return True
+        self.rejected += 1
+        return False
+
+    def prune(self):
+        # full buckets carry no information, so they can be dropped
+        now = self.clock()
+        for key, b in list(self.buckets.items()):
+            if b.is_full(now):
+                del self.buckets[key]
+
+def size_class(length):
+    """Group message lengths into power-of-two classes, so a flood of
+    same-sized junk shares a single bucket."""
+    c = 0
+    while length > 1:
+        length >>= 1
+        c += 1
+    return c
+
+class InletLimits:
+    """I combine the per-source and per-shape limiters used by
+    mailbox.server.ServerResource. The per-source check happens before we
+    read the request body, the per-shape check (version prefix plus size
+    class) happens after the cheap structural checks but before any
+    public-key crypto.
+
+    A relay with worker processes (mailbox.workers) has one of me in each
+    process, and nothing is shared between us. The kernel spreads incoming
+    connections across the processes, so each one enforces 1/'processes'
+    of the configured rates and bursts, and the relay as a whole about the
+    configured limits. A source whose connections all happen to land on
+    one process is limited a little harder than that.
+    """
+    def __init__(self, source_rate=20, source_burst=100,
+                 shape_rate=500, shape_burst=2000, max_keys=10000,
+                 clock=time.time, processes=1):
+        n = float(processes)
+        self.by_source = KeyedRateLimiter(source_rate/n,
+                                          max(1.0, source_burst/n),
+                                          max_keys, clock)
+        self.by_shape = KeyedRateLimiter(shape_rate/n,
+                                         max(1.0, shape_burst/n),
+                                         max_keys, clock)
+
+    def allow_source(self, address):
+        return self.by_source.allow(address)
+
+    def allow_shape(self, prefix, length):
+        return self.by_shape.allow((prefix, size_class(length)))
+
+    def prune(self):
+        self.by_source.prune()
+        self.by_shape.prune()
+
+    def get_stats(self):
+        return {"rejected_by_source": self.by_source.rejected,
+                "rejected_by_shape": self.by_shape.rejected,
+                "tracked_sources": len(self.by_source.buckets),
+                }
@@ -1,7 +1,12 @@
 from twisted.application import service, internet
+from twisted.internet import defer
 from twisted.web import client
 from twisted.python import log
+from nacl.public import PrivateKey, PublicKey
 from ..eventual import eventually
+from ..netstring import split_netstrings
+from .session import create_request, decrypt_response
+from .server import BATCH_HEADER
 
 class LocalRetriever(service.MultiService):
     """I can 'retrieve' messages from an in-process HTTPMailboxServer. This
@@ -12,34 +17,112 @@ class LocalRetriever(service.MultiService):
     itself, as opposed to remote senders to delivering messages to
     customers).
     """
-    def __init__(self, descriptor, got_msgC, server):
+    def __init__(self, descriptor, got_msgCs, server):
         service.MultiService.__init__(self)
-        server.register_local_transport_handler(got_msgC)
+        server.register_local_transport_handler(lambda msgC:
+                                                got_msgCs([msgC]))
+
+    # messages are pushed to us by senders, one at a time, and the spool
+    # keeps them on disk, so there is nothing for flow control to hold back
+    def pauseProducing(self):
+        pass
+    def resumeProducing(self):
+        pass
+    def stopProducing(self):
+        pass
 
 ENABLE_POLLING = False
 
 class HTTPRetriever(service.MultiService):
     """I provide a retriever that fetches messages from an HTTP server
     defined in mailbox.server.RetrievalResource. I can either poll or use
-    Server-Sent Events to discover new messages. Once I've retrieved them, I
-    delete them from the server. I handle transport encryption to hide the
-    message contents as I grab them."""
-    def __init__(self, descriptor, got_msgC):
+    Server-Sent Events to discover new messages. Once I've retrieved them,
+    and got_msgCs has stored them durably, I acknowledge them, which deletes
+    them from the server. Each request runs a retrieval session
+    (mailbox.session), which hides the message contents as I grab them.
+
+    I am a producer for the client's inbound spool: while I'm paused, I
+    leave the rest of a backlog on the server, and pick it up again when
+    I'm resumed."""
+    def __init__(self, descriptor, got_msgCs):
         service.MultiService.__init__(self)
         self.descriptor = descriptor
-        self.got_msgC = got_msgC
+        self.got_msgCs = got_msgCs
+        self.paused = False
+        self.polling = False
+        self.poll_when_resumed = False
         self.ts = internet.TimerService(10*60, self.poll)
         if ENABLE_POLLING:
             self.ts.setServiceParent(self)
 
-    def poll(self):
-        # TODO: transport security, SSE, overlap prevention, deletion (server
-        # currently serves each message just once)
-        d = client.getPage(self.descriptor["url"], method="POST")
+    def _post(self, url):
+        # returns (HTTPClientFactory, eph_privkey or None). The factory is
+        # what getPage() would use, but we want the response headers too.
+        eph = None
+        body = ""
+        if "retrieval_privkey" in self.descriptor:
+            body, eph = create_request(self._server_pubkey(), PrivateKey(
+                self.descriptor["retrieval_privkey"].decode("hex")))
+        f = client._makeGetterFactory(url, client.HTTPClientFactory,
+                                      method="POST", postdata=body)
+        return f, eph
+
+    def _server_pubkey(self):
+        return PublicKey(self.descriptor["server_pubkey"].decode("hex"))
+
+    def fetch(self):
+        """Retrieve one batch of messages. Returns a Deferred that fires with
+        (msgCs, batch): a list of msgC, oldest first, or an empty list, and
+        the name of the batch to pass to ack() (or None)."""
+        f, eph = self._post(str(self.descriptor["url"]))
         def _done(page):
-            # the response is a single msgC, or an empty string
-            if page:
-                self.got_msgC(page)
-                eventually(self.poll) # repeat until drained
+            if eph:
+                page = decrypt_response(self._server_pubkey(), eph, page)
+            # the response is a series of netstring(msgC), or an empty
+            # string. A big backlog comes in several batches.
+            batch = f.response_headers.get(BATCH_HEADER.lower(), [None])[0]
+            return split_netstrings(page), batch
+        f.deferred.addCallback(_done)
+        return f.deferred
+
+    def ack(self, batch):
+        """Tell the server that a batch has been stored, so it can forget
+        those messages."""
+        f, eph = self._post(str(self.descriptor["url"]) + "/ack/" + batch)
+        return f.deferred
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.poll_when_resumed:
+            self.poll_when_resumed = False
+            eventually(self.poll)
+
+    def stopProducing(self):
+        self.paused = True
+        self.poll_when_resumed = False
+
+    def poll(self):
+        # TODO: SSE
+        if self.paused:
+            self.poll_when_resumed = True
+            return
+        if self.polling:
+            return
+        self.polling = True
+        d = self.fetch()
+        def _done((msgCs, batch)):
+            # this spools them to disk (see petmail.spool), and only then
+            # may the server forget them. It may also pause us.
+            self.got_msgCs(msgCs)
+            d2 = self.ack(batch) if batch else defer.succeed(None)
+            if msgCs:
+                d2.addCallback(lambda _: eventually(self.poll)) # until drained
+            return d2
         d.addCallback(_done)
         d.addErrback(log.err)
+        def _finished(_):
+            self.polling = False
+        d.addBoth(_finished)
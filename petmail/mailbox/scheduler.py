@@ -0,0 +1,144 @@
+
+# I share a mailbox server's disk and bandwidth fairly between its tenants.
+# Queue writes (mailbox.server.HTTPMailboxServer.dispatch_msgC, and
+# mailbox.shard.ShardServerFactory for messages a front end routed to us),
+# forwards to shards, and retrieval chunks
+# (mailbox.server.SegmentRangeSender) are submitted as jobs, keyed
+# by TID tokenid, with a cost in bytes. Jobs are run by deficit round robin:
+# each tenant with pending work gets a quantum of bytes (times its weight)
+# per round, so a tenant draining a huge backlog, or being flooded by a
+# sender, gets its share and no more, and everybody else's jobs wait for at
+# most one round.
+#
+# Jobs run on later turns of the eventual-send queue, at most TURN_BUDGET
+# bytes per turn, so the reactor can get on with accepting connections and
+# reading requests in between.
+
+import time
+from collections import deque
+from twisted.internet import defer
+from twisted.python import log
+from ..eventual import eventually
+
+DEFAULT_QUANTUM = 64*1024
+DEFAULT_TURN_BUDGET = 1*1000*1000
+LATENCY_SAMPLES = 256
+
+class LatencyStats:
+    """I remember the most recent wait times, for percentiles."""
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.count = 0
+        self.bytes = 0
+
+    def add(self, latency, cost):
+        self.samples.append(latency)
+        self.count += 1
+        self.bytes += cost
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        s = sorted(self.samples)
+        return s[min(len(s)-1, int(len(s)*p/100.0))]
+
+    def get(self):
+        return {"count": self.count,
+                "bytes": self.bytes,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                "max": max(self.samples) if self.samples else None,
+                }
+
+class Job:
+    def __init__(self, kind, cost, submitted, func, args):
+        self.kind = kind
+        self.cost = cost
+        self.submitted = submitted
+        self.func = func
+        self.args = args
+        self.d = defer.Deferred()
+
+class DeficitRoundRobin:
+    def __init__(self, quantum=DEFAULT_QUANTUM,
+                 turn_budget=DEFAULT_TURN_BUDGET, clock=time.time):
+        self.quantum = quantum
+        self.turn_budget = turn_budget
+        self.clock = clock
+        self.jobs = {} # key -> deque of Jobs
+        self.deficits = {}
+        self.weights = {}
+        self.active = deque() # keys with pending jobs, in round order
+        self.stats = {} # (key, kind) -> LatencyStats
+        self.scheduled = False
+
+    def submit(self, key, cost, kind, func, *args, **kwargs):
+        """Run func(*args) once it is 'key's turn. 'cost' is in bytes.
+        Returns a Deferred that fires with func's result. A 'weight' above 1
+        gives the key a bigger share, and must be positive: a key with no
+        share would never get to run its jobs, and _run would spin."""
+        weight = kwargs.get("weight", 1)
+        if not weight > 0:
+            raise ValueError("weight must be positive, not %r" % (weight,))
+        self.weights[key] = weight
+        job = Job(kind, cost, self.clock(), func, args)
+        if key not in self.jobs:
+            self.jobs[key] = deque()
+            self.deficits[key] = 0
+            self.active.append(key)
+        self.jobs[key].append(job)
+        if not self.scheduled:
+            self.scheduled = True
+            eventually(self._run)
+        return job.d
+
+    def _run(self):
+        self.scheduled = False
+        budget = self.turn_budget
+        while self.active and budget > 0:
+            key = self.active.popleft()
+            jobs = self.jobs[key]
+            self.deficits[key] += self.quantum * self.weights[key]
+            while jobs and jobs[0].cost <= self.deficits[key]:
+                job = jobs.popleft()
+                self.deficits[key] -= job.cost
+                budget -= job.cost
+                self._execute(key, job)
+            if jobs:
+                self.active.append(key) # back of the line
+            else:
+                # idle tenants don't bank credit
+                del self.jobs[key]
+                del self.deficits[key]
+        if self.active and not self.scheduled:
+            self.scheduled = True
+            eventually(self._run)
+
+    def _execute(self, key, job):
+        latency = self.clock() - job.submitted
+        if (key, job.kind) not in self.stats:
+            self.stats[(key, job.kind)] = LatencyStats()
+        self.stats[(key, job.kind)].add(latency, job.cost)
+        d = defer.maybeDeferred(job.func, *job.args)
+        d.chainDeferred(job.d)
+
+    def pending(self, key):
+        return len(self.jobs.get(key, ()))
+
+    def get_stats(self):
+        """Return {key: {kind: {count, bytes, p50, p99, max}}}, where the
+        latencies are the seconds each job waited for its turn."""
+        stats = {}
+        for (key, kind), s in self.stats.items():
+            stats.setdefault(key, {})[kind] = s.get()
+        return stats
+
+    def log_stats(self, worst=5):
+        rows = []
+        for (key, kind), s in self.stats.items():
+            p99 = s.percentile(99)
+            if p99 is not None:
+                rows.append((p99, key, kind))
+        for p99, key, kind in sorted(rows, reverse=True)[:worst]:
+            log.msg("mailbox scheduler: %s %s p99 wait %.3fs"
+                    % (key.encode("hex")[:16], kind, p99))
@@ -3,21 +3,94 @@
 # petmail.mailbox.delivery.http . I define a ServerResource which accepts the
 # POSTs and delivers their msgA to a Mailbox.
 
-from twisted.application import service
-from twisted.web import resource
+import os, mmap, hmac
+from hashlib import sha256
+from twisted.application import service, internet
+from twisted.internet import defer
+from twisted.python import log, failure
+from twisted.web import resource, http, server
 from nacl.public import PrivateKey, PublicKey, Box
 from .. import rrid
 from ..eventual import eventually
-from ..util import remove_prefix, split_into
-from ..netstring import split_netstrings_and_trailer
+from ..util import remove_prefix, split_into, BadPrefixError, equal
+from ..netstring import netstring, split_netstring_prefix
+from .ratelimit import InletLimits
+from .dedup import DuplicateFilter, message_hash
+from .queue import QueueStore, RetentionSweeper, QuotaExceededError
+from .scheduler import DeficitRoundRobin
+from .session import (open_request, ReplayFile, BadRequestError,
+                      FRAME_OVERHEAD)
+
+MSGA_PREFIX = "a0:"
+# prefix, pubkey1, nonce, and the Poly1305 MAC around an (empty) msgB
+MIN_MSGA_SIZE = len(MSGA_PREFIX) + 32 + Box.NONCE_SIZE + 16
+MAX_MSGA_SIZE = 1*1000*1000
+TOO_MANY_REQUESTS = 429 # not in older twisted.web.http
+
+class DeliveryError(Exception):
+    """The message was not queued, for reasons the sender doesn't get to
+    know, but it may succeed if they try again later."""
+
+# offsets within msgA
+PUBKEY1_START = len(MSGA_PREFIX)
+NONCE_START = PUBKEY1_START + 32
+CIPHERTEXT_START = NONCE_START + Box.NONCE_SIZE
+
+def check_msgA(msgA):
+    # cheap structural checks, done before any public-key crypto. msgA might
+    # be an mmap, which has no .startswith
+    if msgA[:len(MSGA_PREFIX)] != MSGA_PREFIX:
+        raise BadPrefixError("did not see expected '%s' prefix"
+                             % (MSGA_PREFIX,))
+    if len(msgA) < MIN_MSGA_SIZE:
+        raise ValueError("msgA too short")
+
+def get_body_length(request):
+    length = request.getHeader("content-length")
+    if length is not None:
+        try:
+            return int(length)
+        except ValueError:
+            pass
+    # chunked uploads have no Content-Length, so measure what we buffered
+    f = request.content
+    here = f.tell()
+    f.seek(0, 2)
+    length = f.tell()
+    f.seek(here)
+    return length
+
+def read_body(request):
+    # Small bodies are already in memory. Larger ones were spooled to a
+    # temporary file by web.BoundedRequest: we map those instead of reading
+    # them, so slicing the ciphertext out is the only full-size copy.
+    f = request.content
+    if not hasattr(f, "fileno"):
+        f.seek(0)
+        return f.read()
+    f.seek(0, 2)
+    if f.tell() == 0:
+        return ""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 def parseMsgA(msgA):
-    key_and_boxed = remove_prefix(msgA, "a0:")
+    key_and_boxed = remove_prefix(msgA, MSGA_PREFIX)
     pubkey1_s, boxed = split_into(key_and_boxed, [32], True)
     return pubkey1_s, boxed
 
+def decryptMsgA(privkey, msgA):
+    # Equivalent to parseMsgA+Box.decrypt, but it slices the pubkey, nonce,
+    # and ciphertext out of msgA directly, instead of building a chain of
+    # full-size intermediate strings. crypto_box is one-shot, so the
+    # ciphertext and plaintext still each exist once.
+    check_msgA(msgA)
+    pubkey1_s = msgA[PUBKEY1_START:NONCE_START]
+    nonce = msgA[NONCE_START:CIPHERTEXT_START]
+    box = Box(privkey, PublicKey(pubkey1_s))
+    return box.decrypt(msgA[CIPHERTEXT_START:], nonce)
+
 def parseMsgB(msgB):
-    (MSTID,),msgC = split_netstrings_and_trailer(msgB)
+    MSTID, msgC = split_netstring_prefix(msgB)
     return MSTID, msgC
 
 # the Mailbox object decrypts msgA to get msgB, decrypts the TID, looks up a
@@ -33,21 +106,270 @@ def parseMsgB(msgB):
 # the direct_http retriever subscribes directly to the Transport.
 
 class ServerResource(resource.Resource):
-    """I accept POSTs with msgA."""
-    def __init__(self, message_handler):
+    """I accept POSTs with msgA. I reject abusive or malformed requests
+    before handing anything to the (expensive) message handler."""
+    def __init__(self, message_handler, limits=None):
         resource.Resource.__init__(self)
         self.message_handler = message_handler
+        self.limits = limits or InletLimits()
 
     def render_POST(self, request):
-        msgA = request.content.read()
+        if not self.limits.allow_source(request.getClientIP()):
+            request.setResponseCode(TOO_MANY_REQUESTS, "too many requests")
+            return "rate limit exceeded"
+        length = get_body_length(request)
+        if length > MAX_MSGA_SIZE:
+            request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE,
+                                    "message too large")
+            return "message too large"
+        msgA = read_body(request)
+        try:
+            return self.handle(request, msgA)
+        finally:
+            if isinstance(msgA, mmap.mmap):
+                msgA.close()
+
+    def handle(self, request, msgA):
+        try:
+            check_msgA(msgA)
+        except (BadPrefixError, ValueError), e:
+            request.setResponseCode(http.BAD_REQUEST, "malformed message")
+            return str(e)
+        if not self.limits.allow_shape(msgA[:len(MSGA_PREFIX)], len(msgA)):
+            request.setResponseCode(TOO_MANY_REQUESTS, "too many requests")
+            return "rate limit exceeded"
         # the sender is allowed to observe the following failures:
         #  unrecognized version prefix ("a0:")
         #  message not boxed to our mailbox pubkey
         # but no others. self.messageReceived() will raise any observable
         # errors, and defer the rest of processing until later
-        self.message_handler(msgA)
+        try:
+            d = self.message_handler(msgA)
+        except QuotaExceededError:
+            return self.mailbox_full(request)
+        if not isinstance(d, defer.Deferred):
+            return "ok"
+        # the message is being forwarded to another server (see
+        # mailbox.shard), which can also tell us that the queue is full
+        finished = request.notifyFinish()
+        finished.addErrback(lambda f: None) # connection lost
+        def _done(res):
+            if finished.called:
+                return
+            if isinstance(res, failure.Failure):
+                if res.check(DeliveryError):
+                    request.setResponseCode(http.SERVICE_UNAVAILABLE,
+                                            "try again later")
+                    request.write("try again later")
+                else:
+                    res.trap(QuotaExceededError)
+                    request.write(self.mailbox_full(request))
+            else:
+                request.write("ok")
+            request.finish()
+        d.addBoth(_done)
+        d.addErrback(log.err)
+        return server.NOT_DONE_YET
+
+    def mailbox_full(self, request):
+        request.setResponseCode(http.INSUFFICIENT_STORAGE_SPACE,
+                                "mailbox full")
+        return "mailbox full"
+
+
+# a single retrieval response carries at most this much (but always at
+# least one message)
+RETRIEVE_BATCH_BYTES = 1*1000*1000
+SEND_CHUNK_SIZE = 64*1024
+
+class SegmentRangeSender:
+    """I am a pull producer that writes byte ranges of queue segment files
+    into an HTTP response, one chunk at a time, so a large backlog is never
+    held in memory. The segment files must already be open: a segment may
+    be dropped while I am still sending from it. If I'm given a
+    session.SessionSender, each chunk goes out as an encrypted frame."""
+    def __init__(self, request, ranges, files, session=None,
+                 scheduler=None, queue=None):
+        self.request = request
+        self.ranges = list(ranges) # (start, offset, length)
+        self.files = files # start -> open file
+        self.session = session
+        # with a scheduler, each chunk waits for its tenant's turn
+        self.scheduler = scheduler
+        self.queue = queue
+        self.waiting = False
+        self.stopped = False
+
+    def get_length(self):
+        length = sum([l for (_,_,l) in self.ranges])
+        if not self.session:
+            return length
+        # the header, then a frame per chunk, then an empty frame
+        length = (len(self.session.header)
+                  + len(netstring("x"*FRAME_OVERHEAD)))
+        for (start, offset, l) in self.ranges:
+            while l:
+                chunk = min(l, SEND_CHUNK_SIZE)
+                length += len(netstring("x"*(chunk+FRAME_OVERHEAD)))
+                l -= chunk
+        return length
+
+    def start(self):
+        if self.session:
+            self.request.write(self.session.header)
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.scheduler:
+            return self.produce()
+        # a pull consumer may ask again before our turn comes up
+        if self.waiting:
+            return
+        self.waiting = True
+        cost = min(SEND_CHUNK_SIZE, sum([l for (_,_,l) in self.ranges[:1]]))
+        d = self.scheduler.submit(self.queue.TID_tokenid, cost, "retrieve",
+                                  self.produce, weight=self.queue.weight)
+        d.addErrback(log.err)
+
+    def produce(self):
+        self.waiting = False
+        if self.stopped:
+            return # the client went away while we waited for our turn
+        while self.ranges and self.ranges[0][2] == 0:
+            self.ranges.pop(0)
+        if not self.ranges:
+            self._close()
+            self.request.unregisterProducer()
+            if self.session:
+                self.request.write(self.session.end())
+            self.request.finish()
+            return
+        start, offset, length = self.ranges[0]
+        f = self.files[start]
+        f.seek(offset)
+        data = f.read(min(length, SEND_CHUNK_SIZE))
+        if not data:
+            raise EnvironmentError("segment %d truncated" % start)
+        self.ranges[0] = (start, offset+len(data), length-len(data))
+        if self.session:
+            data = self.session.frame(data)
+        self.request.write(data)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.ranges = []
+        self._close()
+
+    def _close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+# the header that names a retrieved batch, for its acknowledgement
+BATCH_HEADER = "X-Petmail-Batch"
+
+def batch_token_key(server_privkey):
+    # a MAC key of its own, rather than the Box key itself
+    return hmac.new(server_privkey.encode(), "petmail batch-token",
+                    sha256).digest()
+
+def make_batch_token(queue, last):
+    token = "%d-%d" % last
+    if queue.server_privkey:
+        # so whoever can tamper with the response can't make the client
+        # acknowledge more than it got
+        token += "-" + hmac.new(batch_token_key(queue.server_privkey), token,
+                                sha256).hexdigest()[:32]
+    return token
+
+def parse_batch_token(queue, token):
+    """Return the (start, position) that make_batch_token() was given, or
+    raise ValueError."""
+    pieces = token.split("-")
+    if len(pieces) != (3 if queue.server_privkey else 2):
+        raise ValueError("malformed batch token")
+    if queue.server_privkey:
+        expected = make_batch_token(queue, (int(pieces[0]), int(pieces[1])))
+        if not equal(token, expected):
+            raise ValueError("bad batch token")
+    return (int(pieces[0]), int(pieces[1]))
+
+class TransportRetrievalResource(resource.Resource):
+    """Each POST returns the oldest queued messages for one transport, as a
+    series of netstring(msgC), or an empty body if there are none. They are
+    sent straight from the queue's segment files, which hold them in exactly
+    this form. The BATCH_HEADER of the response names the batch.
+
+    The messages stay queued until the client has stored them durably, and
+    POSTs to ack/BATCH: until then, each retrieval sends them again.
+
+    Transports which have session keys require each POST (acks too) to
+    start a session (see mailbox.session), and the response is
+    encrypted."""
+    isLeaf = True
+    def __init__(self, queue, scheduler=None):
+        resource.Resource.__init__(self)
+        self.queue = queue
+        # shared with any other processes serving this queue
+        self.replays = ReplayFile(os.path.join(queue.dirname, "replays"),
+                                  queue.locked)
+        self.scheduler = scheduler
+
+    def render_POST(self, request):
+        request.setHeader("content-type", "application/octet-stream")
+        session = None
+        if self.queue.server_privkey:
+            try:
+                session = open_request(self.queue.server_privkey,
+                                       self.queue.retrieval_pubkey,
+                                       request.content.read(), self.replays)
+            except BadRequestError:
+                request.setResponseCode(http.FORBIDDEN,
+                                        "bad retrieval request")
+                return "bad retrieval request"
+        if request.postpath[:1] == ["ack"]:
+            return self.render_ack(request, "/".join(request.postpath[1:]))
+        with self.queue.locked():
+            plan = self.queue.pending(RETRIEVE_BATCH_BYTES)
+            if not plan:
+                if session:
+                    return session.header + session.end()
+                return ""
+            ranges, last = plan
+            files = {}
+            for start, offset, length in ranges:
+                if start not in files:
+                    files[start] = self.queue.open_segment(start)
+        sender = SegmentRangeSender(request, ranges, files, session,
+                                    self.scheduler, self.queue)
+        request.setHeader("content-length", str(sender.get_length()))
+        request.setHeader(BATCH_HEADER, make_batch_token(self.queue, last))
+        sender.start()
+        return server.NOT_DONE_YET
+
+    def render_ack(self, request, token):
+        try:
+            last = parse_batch_token(self.queue, token)
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST, "bad batch")
+            return "bad batch"
+        with self.queue.locked():
+            self.queue.consume(*last) # which ignores repeated acks
         return "ok"
 
+class RetrievalResource(resource.Resource):
+    """I am /retrieve/ . My children are named by the retrieval_id of each
+    registered transport."""
+    def __init__(self, queues, scheduler=None):
+        resource.Resource.__init__(self)
+        self.queues = queues
+        self.scheduler = scheduler
+
+    def getChild(self, path, request):
+        q = self.queues.get_transport_by_retrieval_id(path)
+        if not q:
+            return resource.NoResource("unknown transport")
+        return TransportRetrievalResource(q, self.scheduler)
 
 class BaseServer(service.MultiService):
     """I am a base Petmail Mailbox Server. I accept messages from clients
@@ -72,7 +394,8 @@ class HTTPMailboxServer(BaseServer):
     by remote clients.
     """
 
-    def __init__(self, web, enable_retrieval, desc):
+    def __init__(self, web, enable_retrieval, desc, queuedir=None,
+                 run_sweeper=True, router=None, processes=1):
         BaseServer.__init__(self)
         self.web = web
         self.privkey = PrivateKey(desc["transport_privkey"].decode("hex"))
@@ -84,12 +407,49 @@ class HTTPMailboxServer(BaseServer):
         self.local_TID0 = desc["local_TID0"].decode("hex")
         self.local_TID_tokenid = desc["local_TID_tokenid"].decode("hex")
 
-        # this is how we get messages from senders
-        web.get_root().putChild("mailbox", ServerResource(self.handle_msgA))
+        # messages for the other transports are queued on disk until their
+        # recipients retrieve them, or until the retention period expires
+        self.queues = None
+        if queuedir:
+            self.queues = QueueStore(queuedir)
+            if run_sweeper: # only one process sharing the queues needs it
+                RetentionSweeper(self.queues).setServiceParent(self)
+
+        # queue writes and retrieval take turns, tenant by tenant
+        self.scheduler = DeficitRoundRobin()
+        t = internet.TimerService(10*60, self.scheduler.log_stats)
+        t.setServiceParent(self)
+
+        # this is how we get messages from senders. The inlet limits are
+        # pruned periodically, so idle sources don't pin memory. With
+        # worker processes, each of the 'processes' gets a share of them.
+        self.inlet_limits = InletLimits(processes=processes)
+        t = internet.TimerService(60, self.inlet_limits.prune)
+        t.setServiceParent(self)
+        # retried and fanned-out messages are acknowledged, but only the
+        # first copy is queued or delivered
+        self.duplicates = DuplicateFilter()
+        t = internet.TimerService(60, self.duplicates.prune)
+        t.setServiceParent(self)
+        t = internet.TimerService(10*60, self.duplicates.log_stats)
+        t.setServiceParent(self)
+        web.get_root().putChild("mailbox",
+                                ServerResource(self.handle_msgA,
+                                               self.inlet_limits))
+
+        # a front end (mailbox.shard) forwards everything to its shards
+        self.router = router
+        if router:
+            router.setServiceParent(self)
 
         if enable_retrieval:
             # add a second resource for clients to retrieve messages
-            raise NotImplementedError()
+            assert self.queues
+            if router:
+                r = router.get_retrieval_resource(self.queues)
+            else:
+                r = RetrievalResource(self.queues, self.scheduler)
+            web.get_root().putChild("retrieve", r)
 
     def get_retrieval_descriptor(self):
         return { "type": "local",
@@ -113,19 +473,61 @@ class HTTPMailboxServer(BaseServer):
         self.local_transport_handler = handler
 
     def handle_msgA(self, msgA):
-        pubkey1_s, boxed = parseMsgA(msgA)
-        msgB = Box(self.privkey, PublicKey(pubkey1_s)).decrypt(boxed)
-        # this ends the observable errors
-        eventually(self.handle_msgB, msgB)
+        # an identical msgA is a retry by the sender: skip the decryption
+        d = self.duplicates.run(message_hash(msgA), self._handle_msgA, msgA)
+        if d:
+            # the message was not queued (e.g. its shard is unreachable), so
+            # the sender must not be told otherwise: it will try again
+            def _failed(f):
+                if f.check(QuotaExceededError):
+                    return f
+                log.err(f, "error routing msgC")
+                raise DeliveryError("message not queued")
+            d.addErrback(_failed)
+        return d
+
+    def _handle_msgA(self, msgA):
+        msgB = decryptMsgA(self.privkey, msgA)
+        # this ends the observable errors, except that the sender may learn
+        # that the recipient's queue is full. They already know that the
+        # transport exists, and they need to know to try again later.
+        try:
+            return self.handle_msgB(msgB)
+        except QuotaExceededError:
+            raise
+        except Exception:
+            log.err(None, "error handling msgB")
+            return None
 
     def handle_msgB(self, msgB):
         MSTID, msgC = parseMsgB(msgB)
         TID = rrid.decrypt(self.TID_privkey, MSTID)
+        # a sender which re-encrypts its retries (or sends through several
+        # of our transports) makes a new msgA, but the same msgC
+        return self.duplicates.run(message_hash(TID, msgC),
+                                   self.dispatch_msgC, TID, msgC)
+
+    def dispatch_msgC(self, TID, msgC):
         if TID == self.local_TID_tokenid:
-            self.local_transport_handler(msgC)
+            eventually(self.local_transport_handler, msgC)
+            return
+        q = self.queues and self.queues.get_transport(TID)
+        if self.router:
+            # we're a front end: the queue lives on a shard. The forwards
+            # take turns too, so a flooded tenant can't hog the stream.
+            return self.scheduler.submit(TID, len(msgC), "write",
+                                         self.router.route, TID, msgC,
+                                         weight=q.weight if q else 1)
+        if q:
+            # the quota is checked against the queue's counters, so this
+            # costs the same no matter how much is queued. Check now, so a
+            # flood is refused without waiting for its turn, and again when
+            # writing.
+            q.check_quota(len(msgC)) # may raise QuotaExceededError
+            return self.scheduler.submit(TID, len(msgC), "write",
+                                         q.enqueue, msgC, weight=q.weight)
         else:
-            # TODO: look up registered transports, queue message
-            self.signal_unrecognized_TID(TID)
+            eventually(self.signal_unrecognized_TID, TID)
 
     def signal_unrecognized_TID(self, TID):
         # this can be overridden by unit tests
@@ -0,0 +1,171 @@
+
+# I define the transport security for retrieval (mailbox.server
+# TransportRetrievalResource, mailbox.retrieval.HTTPRetriever). Each
+# retrieval request starts a session, which costs one public-key
+# operation on each side to set up. Everything retrieved in that session
+# is protected with a symmetric SecretBox, so draining a big backlog
+# costs no more Curve25519 operations than draining a single message.
+#
+# Each transport has two long-term keypairs, created when it is
+# provisioned. The mailbox server keeps the private "server" key. The
+# recipient keeps the private "retrieval" key, and each side knows the
+# other's public key.
+#
+# request: "r0:" + nonce + Box(retrieval, server)(time + ephemeral_pubkey)
+# response: nonce + Box(server, ephemeral)(session_key), then frames
+# frame: netstring(SecretBox(session_key)(chunk, nonce=frame number))
+#
+# Only the holder of the retrieval key can start a session, since
+# retrieving removes messages from the queue. Only the holder of the
+# ephemeral key (freshly made for each request, then forgotten) can read
+# the session key. The server rejects requests that are too old, or that
+# it has seen before. The chunks, concatenated, are the usual series of
+# netstring(msgC). The last frame has an empty chunk, so the client can
+# tell a complete response from a truncated one.
+#
+# With worker processes (mailbox.workers), a replayed request could reach a
+# different process than the original did, so the mailbox server keeps the
+# requests it has seen in a file in each transport's queue directory
+# (ReplayFile), under the same flock() as the queue itself.
+
+import time, struct, os
+from nacl.public import PrivateKey, PublicKey, Box
+from nacl.secret import SecretBox
+from nacl.exceptions import CryptoError
+from ..netstring import netstring, split_netstring_prefix
+from ..util import split_into
+
+REQUEST_PREFIX = "r0:"
+MAX_CLOCK_SKEW = 5*60
+KEY_SIZE = SecretBox.KEY_SIZE
+NONCE_SIZE = SecretBox.NONCE_SIZE
+FRAME_OVERHEAD = 16 # the Poly1305 MAC
+
+class BadRequestError(Exception):
+    pass
+
+class TruncatedError(Exception):
+    pass
+
+def frame_nonce(number):
+    return "\x00"*(NONCE_SIZE-8) + struct.pack(">Q", number)
+
+def create_request(server_pubkey, retrieval_privkey, now=None):
+    """Return (request body, ephemeral privkey). The ephemeral key is
+    needed to read the response, and should be forgotten afterwards."""
+    if now is None:
+        now = time.time()
+    eph = PrivateKey.generate()
+    b = Box(retrieval_privkey, server_pubkey)
+    auth = b.encrypt(struct.pack(">Q", int(now)) + eph.public_key.encode(),
+                     os.urandom(Box.NONCE_SIZE))
+    return REQUEST_PREFIX + auth, eph
+
+class ReplayCache:
+    """I remember the requests seen recently (within the clock-skew window,
+    outside of which requests are rejected anyway)."""
+    def __init__(self):
+        self.seen = {} # nonce -> request time
+
+    def check(self, nonce, when, now):
+        for n, t in self.seen.items():
+            if t < now - MAX_CLOCK_SKEW:
+                del self.seen[n]
+        if nonce in self.seen:
+            raise BadRequestError("replayed request")
+        self.seen[nonce] = when
+
+# (request nonce, request time)
+REPLAY_RECORD = struct.Struct(">%dsQ" % Box.NONCE_SIZE)
+
+class ReplayFile:
+    """I am a ReplayCache kept in 'filename', so every process serving the
+    transport sees the same requests. 'locked' is a context manager that
+    keeps the other processes out while I read and rewrite the file."""
+    def __init__(self, filename, locked):
+        self.filename = filename
+        self.locked = locked
+
+    def check(self, nonce, when, now):
+        with self.locked():
+            seen = []
+            try:
+                with open(self.filename, "rb") as f:
+                    data = f.read()
+            except EnvironmentError:
+                data = ""
+            for i in range(0, len(data) - REPLAY_RECORD.size + 1,
+                           REPLAY_RECORD.size):
+                n, t = REPLAY_RECORD.unpack_from(data, i)
+                if t >= now - MAX_CLOCK_SKEW:
+                    if n == nonce:
+                        raise BadRequestError("replayed request")
+                    seen.append((n, t))
+            seen.append((nonce, when))
+            tmp = self.filename + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write("".join([REPLAY_RECORD.pack(seen_nonce, seen_when)
+                                 for (seen_nonce, seen_when) in seen]))
+            os.rename(tmp, self.filename)
+
+def open_request(server_privkey, retrieval_pubkey, body, replays,
+                 now=None):
+    """Check a retrieval request, and return a SessionSender for the
+    response. Raises BadRequestError."""
+    if now is None:
+        now = time.time()
+    if body[:len(REQUEST_PREFIX)] != REQUEST_PREFIX:
+        raise BadRequestError("missing prefix")
+    auth = body[len(REQUEST_PREFIX):]
+    try:
+        m = Box(server_privkey, retrieval_pubkey).decrypt(auth)
+        when_s, eph_pubkey_s = split_into(m, [8, 32])
+    except (CryptoError, ValueError):
+        raise BadRequestError("bad request")
+    when = struct.unpack(">Q", when_s)[0]
+    if abs(now - when) > MAX_CLOCK_SKEW:
+        raise BadRequestError("stale request")
+    replays.check(auth[:Box.NONCE_SIZE], when, now)
+    return SessionSender(server_privkey, PublicKey(eph_pubkey_s))
+
+class SessionSender:
+    def __init__(self, server_privkey, eph_pubkey):
+        self.key = os.urandom(KEY_SIZE)
+        self.header = Box(server_privkey, eph_pubkey).encrypt(
+            self.key, os.urandom(Box.NONCE_SIZE))
+        self.box = SecretBox(self.key)
+        self.frames = 0
+
+    def frame(self, chunk):
+        nonce = frame_nonce(self.frames)
+        self.frames += 1
+        return netstring(self.box.encrypt(chunk, nonce).ciphertext)
+
+    def end(self):
+        return self.frame("")
+
+def decrypt_response(server_pubkey, eph_privkey, response):
+    """Return the plaintext of a complete response, i.e. a series of
+    netstring(msgC). Raises TruncatedError if the response was cut short,
+    and CryptoError if it was tampered with."""
+    header_size = Box.NONCE_SIZE + KEY_SIZE + FRAME_OVERHEAD
+    if len(response) < header_size:
+        raise TruncatedError("no session header")
+    key = Box(eph_privkey, server_pubkey).decrypt(response[:header_size])
+    box = SecretBox(key)
+    rest = response[header_size:]
+    chunks = []
+    number = 0
+    while rest:
+        try:
+            ciphertext, rest = split_netstring_prefix(rest)
+        except ValueError:
+            raise TruncatedError("partial frame")
+        chunk = box.decrypt(ciphertext, frame_nonce(number))
+        number += 1
+        if not chunk:
+            if rest:
+                raise CryptoError("data after the last frame")
+            return "".join(chunks)
+        chunks.append(chunk)
+    raise TruncatedError("missing last frame")
@@ -0,0 +1,471 @@
+
+# I spread a relay's transports across several mailbox "shards", so that one
+# machine's disk and CPU don't bound the number of tenants. Each shard is a
+# relay (see create_node.create_relay) that holds the queues of some of the
+# transports. The front end is a relay which owns the mailbox keys: it
+# accepts msgA from senders, decrypts it with HTTPMailboxServer.handle_msgA
+# as usual, and forwards (TID tokenid, msgC) to the shard which owns that
+# TID, over a persistent stream connection. Recipients retrieve through the
+# front end too, which redirects them to the owning shard, so their
+# retrieval URLs survive migrations.
+#
+# Ownership is decided by a consistent-hash ring: each shard gets
+# DEFAULT_VNODES points on a 64-bit circle, and a TID belongs to the shard
+# with the first point at or after hash(TID tokenid). Adding a shard moves
+# only the TIDs which the new shard takes over (about 1/N of them), and
+# draining one moves only that shard's TIDs.
+#
+# The stream protocol is a series of netstrings. The front end sends
+# TID_tokenid+msgC, and the shard answers each one, in order, with OK,
+# FULL (quota exceeded), UNKNOWN, or ERROR. Both ends put the messages
+# through their mailbox.scheduler, like deliveries made over HTTP, so the
+# stream is shared fairly between tenants; the shard still answers in the
+# order the messages arrived.
+#
+# Before any of that, the front end proves that it knows the shard's
+# shard_key (kept in both relays' databases): the shard opens with a random
+# challenge, and takes nothing but HMAC-SHA256(shard_key, challenge) in
+# reply. Anyone else who can reach the shard_port is disconnected. The
+# stream is not encrypted (msgC is already encrypted to its recipient), so
+# shards should still listen on an interface the front end alone can reach.
+#
+# Shards which share a machine with the front end record their basedir in
+# the front end's mailbox_shards table. That lets 'petmail add-transport'
+# provision transports on them, and 'petmail migrate-shards' move transport
+# directories between them.
+#
+# A running front end re-reads mailbox_shards every RELOAD_INTERVAL seconds,
+# so shards can be added, drained, or removed without a restart. But a relay
+# only becomes a front end when it starts with at least one shard in the
+# table (see make_router): after adding the first shard, restart it.
+
+import os, bisect, struct, hmac
+from collections import deque
+from hashlib import sha256
+from twisted.application import service, internet, strports
+from twisted.internet import reactor, protocol, defer, endpoints
+from twisted.protocols.basic import NetstringReceiver
+from twisted.web import resource, util, http
+from twisted.python import log
+from ..util import equal
+from .queue import QueueStore, QuotaExceededError
+from .server import MAX_MSGA_SIZE
+
+DEFAULT_VNODES = 100
+RELOAD_INTERVAL = 60
+
+OK, FULL, UNKNOWN, ERROR = "ok", "full", "unknown", "error"
+
+class ShardError(Exception):
+    pass
+
+def ring_point(key):
+    return struct.unpack(">Q", sha256(key).digest()[:8])[0]
+
+class HashRing:
+    """I map TID tokenids to shard names."""
+    def __init__(self, names=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.points = [] # sorted list of (point, name)
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        for i in range(self.vnodes):
+            bisect.insort(self.points, (ring_point("%s:%d" % (name, i)),
+                                        name))
+
+    def remove(self, name):
+        self.points = [p for p in self.points if p[1] != name]
+
+    def get_names(self):
+        return sorted(set([name for (point, name) in self.points]))
+
+    def lookup(self, TID_tokenid):
+        if not self.points:
+            raise ShardError("no shards in the ring")
+        i = bisect.bisect_left(self.points, (ring_point(TID_tokenid),))
+        return self.points[i % len(self.points)][1]
+
+def load_shards(db):
+    """Return (ring, rows), where rows maps shard name to its row in the
+    mailbox_shards table. Draining shards are left out of the ring."""
+    ring = HashRing()
+    rows = {}
+    for row in db.execute("SELECT * FROM mailbox_shards").fetchall():
+        name = str(row["name"])
+        rows[name] = row
+        if not row["draining"]:
+            ring.add(name)
+    return ring, rows
+
+def get_shard_key(db):
+    """Return this shard's shard_key, making one up if it doesn't have one
+    yet."""
+    row = db.execute("SELECT shard_key FROM mailbox_server_config"
+                     ).fetchone()
+    if row["shard_key"]:
+        return str(row["shard_key"])
+    shard_key = os.urandom(32).encode("hex")
+    db.execute("UPDATE mailbox_server_config SET shard_key=?", (shard_key,))
+    db.commit()
+    return shard_key
+
+def auth_response(shard_key, challenge):
+    return hmac.new(shard_key.decode("hex"), challenge, sha256).digest()
+
+def get_shard_store(row):
+    if not row["basedir"]:
+        raise ShardError("shard '%s' is not local" % row["name"])
+    return QueueStore(os.path.join(row["basedir"], "mailbox-queues"))
+
+def migrate(db, stdout):
+    """Move every transport whose directory is not on its owning shard.
+    Returns the number of transports moved."""
+    ring, rows = load_shards(db)
+    stores = dict([(name, get_shard_store(row))
+                   for (name, row) in rows.items()])
+    moved = 0
+    for name in sorted(stores):
+        for TID_tokenid in stores[name].list_transports():
+            owner = ring.lookup(TID_tokenid)
+            if owner != name:
+                stores[name].move_transport(TID_tokenid, stores[owner])
+                print >>stdout, "moved %s: %s -> %s" % (
+                    TID_tokenid.encode("hex")[:16], name, owner)
+                moved += 1
+    return moved
+
+# shard side
+
+class ShardProtocol(NetstringReceiver):
+    MAX_LENGTH = 32 + MAX_MSGA_SIZE
+
+    def connectionMade(self):
+        self.factory.connections.add(self)
+        self.replies = deque() # one list per frame, holding its reply
+        self.challenge = os.urandom(32)
+        self.authenticated = False
+        self.rejected = False
+        self.sendString(self.challenge)
+
+    def stringReceived(self, frame):
+        if self.rejected:
+            return # frames that arrived along with a bad response
+        if not self.authenticated:
+            expected = auth_response(self.factory.shard_key, self.challenge)
+            if not equal(frame, expected):
+                log.msg("shard: disconnecting %s, which does not know our"
+                        " shard_key" % (self.transport.getPeer(),))
+                self.rejected = True
+                self.transport.loseConnection()
+                return
+            self.authenticated = True
+            return
+        TID_tokenid, msgC = frame[:32], frame[32:]
+        reply = []
+        self.replies.append(reply)
+        d = self.factory.deliver(TID_tokenid, msgC)
+        def _failed(f):
+            # every frame must be answered, or the replies that follow
+            # would be matched to the wrong messages
+            log.err(f, "error delivering routed msgC")
+            return ERROR
+        d.addErrback(_failed)
+        def _delivered(res):
+            # deliveries finish in their tenants' turns, not in order
+            reply.append(res)
+            while self.replies and self.replies[0]:
+                self.sendString(self.replies.popleft()[0])
+        d.addCallback(_delivered)
+        d.addErrback(log.err)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        self.factory.check_closed()
+
+class ShardServerFactory(protocol.ServerFactory):
+    protocol = ShardProtocol
+
+    def __init__(self, store, scheduler, shard_key):
+        self.store = store
+        self.scheduler = scheduler # the mailbox server's
+        self.shard_key = shard_key
+        self.connections = set()
+        self.closed = []
+
+    def deliver(self, TID_tokenid, msgC):
+        """Queue a routed msgC when its tenant's turn comes. Fires with the
+        reply for the front end."""
+        q = self.store.get_transport(TID_tokenid)
+        if q and not os.path.isdir(q.dirname):
+            # migrated away since we last looked
+            self.store.forget(TID_tokenid)
+            q = None
+        if not q:
+            return defer.succeed(UNKNOWN)
+        return self.scheduler.submit(TID_tokenid, len(msgC), "write",
+                                     self.enqueue, q, msgC, weight=q.weight)
+
+    def enqueue(self, q, msgC):
+        try:
+            q.enqueue(msgC)
+        except QuotaExceededError:
+            return FULL
+        except EnvironmentError:
+            if not os.path.isdir(q.dirname):
+                # migrated away while we waited for the lock
+                self.store.forget(q.TID_tokenid)
+                return UNKNOWN
+            log.err(None, "error queueing msgC")
+            return ERROR
+        return OK
+
+    def close_connections(self):
+        d = defer.Deferred()
+        self.closed.append(d)
+        for p in list(self.connections):
+            p.transport.loseConnection()
+        self.check_closed()
+        return d
+
+    def check_closed(self):
+        if not self.connections:
+            closed, self.closed = self.closed, []
+            for d in closed:
+                d.callback(None)
+
+class ShardListener(service.MultiService):
+    """I accept routed messages from a front end, and queue them in
+    'store' as 'scheduler' allows."""
+    def __init__(self, db, shard_port, store, scheduler):
+        service.MultiService.__init__(self)
+        self.db = db
+        self.factory = ShardServerFactory(store, scheduler,
+                                          get_shard_key(db))
+        self.shard_port = str(shard_port)
+        self.port_service = strports.service(self.shard_port, self.factory)
+        self.port_service.setServiceParent(self)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        # like WebPort, record the real port if we were given port 0, so
+        # 'petmail add-shard' can find us
+        pieces = self.shard_port.split(":")
+        if pieces[0:2] == ["tcp", "0"]:
+            d = self.port_service._waitingForPort
+            def _ready(port):
+                pieces[1] = str(port.getHost().port)
+                self.db.execute("UPDATE mailbox_server_config"
+                                " SET shard_port=?", (":".join(pieces),))
+                self.db.commit()
+                return port
+            d.addCallback(_ready)
+            d.addErrback(log.err)
+
+    def stopService(self):
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        d.addCallback(lambda _: self.factory.close_connections())
+        return d
+
+def shard_port_to_endpoint(shard_port):
+    # "tcp:PORT:interface=IP" -> "tcp:host=IP:port=PORT"
+    pieces = str(shard_port).split(":")
+    if pieces[0] != "tcp" or int(pieces[1]) == 0:
+        raise ShardError("cannot connect to shard_port '%s'" % shard_port)
+    host = "localhost"
+    for piece in pieces[2:]:
+        if piece.startswith("interface="):
+            host = piece[len("interface="):]
+    return "tcp:host=%s:port=%d" % (host, int(pieces[1]))
+
+# front end side
+
+class ShardClientProtocol(NetstringReceiver):
+    def __init__(self, connection):
+        self.connection = connection
+        self.waiting = deque()
+        self.ready = defer.Deferred() # fires once we've answered the shard
+
+    def deliver(self, TID_tokenid, msgC):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self.sendString(TID_tokenid + msgC)
+        return d
+
+    def stringReceived(self, reply):
+        if not self.ready.called:
+            # the shard's challenge. If our answer is wrong, it hangs up,
+            # and whatever we've sent since then fails with the connection.
+            self.sendString(auth_response(self.connection.shard_key, reply))
+            self.ready.callback(self)
+            return
+        self.waiting.popleft().callback(reply)
+
+    def connectionLost(self, reason):
+        if not self.ready.called:
+            self.ready.errback(reason)
+        waiting, self.waiting = self.waiting, deque()
+        for d in waiting:
+            d.errback(reason)
+        self.connection.lost(self)
+
+class ShardConnection:
+    """I hold the (lazily-established) stream connection to one shard.
+    Deliveries are pipelined over it."""
+    def __init__(self, name, endpoint, baseurl, basedir, shard_key):
+        self.name = name
+        self.endpoint = endpoint
+        self.baseurl = baseurl
+        self.basedir = basedir
+        self.shard_key = shard_key
+        self.protocol = None
+        self.pending = []
+        self.closed = []
+
+    def deliver(self, TID_tokenid, msgC):
+        if self.protocol:
+            return self.protocol.deliver(TID_tokenid, msgC)
+        if not self.shard_key:
+            # added before shards had keys
+            return defer.fail(ShardError("no shard_key for shard '%s': run"
+                                         " 'petmail add-shard' again"
+                                         % self.name))
+        d = defer.Deferred()
+        self.pending.append(d)
+        if len(self.pending) == 1:
+            self._connect()
+        d.addCallback(lambda p: p.deliver(TID_tokenid, msgC))
+        return d
+
+    def _connect(self):
+        ep = endpoints.clientFromString(reactor, self.endpoint)
+        d = endpoints.connectProtocol(ep, ShardClientProtocol(self))
+        d.addCallback(lambda p: p.ready)
+        def _connected(p):
+            self.protocol = p
+            return p
+        d.addCallback(_connected)
+        def _fire(res):
+            pending, self.pending = self.pending, []
+            for p in pending:
+                if isinstance(res, protocol.Protocol):
+                    p.callback(res)
+                else:
+                    p.errback(res)
+        d.addBoth(_fire)
+
+    def has_transport(self, TID_tokenid):
+        # for local shards, this is cheaper than asking them
+        return os.path.isdir(os.path.join(self.basedir, "mailbox-queues",
+                                          TID_tokenid.encode("hex")))
+
+    def lost(self, p):
+        if self.protocol is p:
+            self.protocol = None
+        closed, self.closed = self.closed, []
+        for d in closed:
+            d.callback(None)
+
+    def disconnect(self):
+        if not self.protocol:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.closed.append(d)
+        self.protocol.transport.loseConnection()
+        return d
+
+class ShardRetrievalResource(resource.Resource):
+    """I am /retrieve/ on a front end. I redirect each retrieval to the
+    shard that holds the transport's queue."""
+    def __init__(self, router, queues):
+        resource.Resource.__init__(self)
+        self.router = router
+        self.queues = queues
+
+    def getChild(self, path, request):
+        q = self.queues.get_transport_by_retrieval_id(path)
+        if not q:
+            return resource.NoResource("unknown transport")
+        try:
+            conn = self.router.locate(q.TID_tokenid)
+        except ShardError, e:
+            return resource.ErrorPage(http.SERVICE_UNAVAILABLE,
+                                      "no shard available", str(e))
+        # (acks too: retrieve/ID/ack/BATCH)
+        return util.Redirect(str(conn.baseurl) + "retrieve/"
+                             + "/".join([path] + request.postpath))
+
+class ShardRouter(service.MultiService):
+    """I forward msgC to the shard which owns its TID. I re-read the
+    mailbox_shards table every RELOAD_INTERVAL seconds, and whenever a shard
+    doesn't recognize a TID (it may have just been migrated)."""
+    def __init__(self, db):
+        service.MultiService.__init__(self)
+        self.db = db
+        self.connections = {}
+        self.reload()
+        t = internet.TimerService(RELOAD_INTERVAL, self.reload)
+        t.setServiceParent(self)
+
+    def reload(self):
+        ring, rows = load_shards(self.db)
+        connections = {}
+        for name, row in rows.items():
+            conn = self.connections.pop(name, None)
+            shard_key = row["shard_key"] and str(row["shard_key"])
+            if (not conn or conn.endpoint != row["endpoint"]
+                or conn.shard_key != shard_key):
+                if conn:
+                    conn.disconnect()
+                conn = ShardConnection(name, str(row["endpoint"]),
+                                       str(row["baseurl"]), row["basedir"],
+                                       shard_key)
+            connections[name] = conn
+        for conn in self.connections.values():
+            conn.disconnect() # removed from the table
+        self.ring, self.connections = ring, connections
+
+    def locate(self, TID_tokenid):
+        """Return the ShardConnection for the shard which holds the TID's
+        queue. That is the ring's owner, unless the transport has not yet
+        been migrated there."""
+        owner = self.connections[self.ring.lookup(TID_tokenid)]
+        if not owner.basedir or owner.has_transport(TID_tokenid):
+            return owner
+        for conn in self.connections.values():
+            if conn.basedir and conn.has_transport(TID_tokenid):
+                return conn
+        return owner
+
+    def route(self, TID_tokenid, msgC, retry=True):
+        d = self.locate(TID_tokenid).deliver(TID_tokenid, msgC)
+        def _replied(reply):
+            if reply == OK:
+                return None
+            if reply == FULL:
+                raise QuotaExceededError("mailbox full")
+            if reply == UNKNOWN:
+                if retry:
+                    self.reload()
+                    return self.route(TID_tokenid, msgC, retry=False)
+                raise KeyError("unrecognized transport identifier")
+            raise ShardError("shard replied '%s'" % reply)
+        d.addCallback(_replied)
+        return d
+
+    def get_retrieval_resource(self, queues):
+        return ShardRetrievalResource(self, queues)
+
+    def stopService(self):
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        d.addCallback(lambda _: defer.DeferredList(
+            [conn.disconnect() for conn in self.connections.values()]))
+        return d
+
+def make_router(db):
+    """Return a ShardRouter if this relay is a front end, else None. This is
+    only decided at startup."""
+    if db.execute("SELECT COUNT(*) FROM mailbox_shards").fetchone()[0]:
+        return ShardRouter(db)
+    return None
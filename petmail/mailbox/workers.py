@@ -0,0 +1,185 @@
+
+# I run a relay's mailbox server in several processes. A single reactor can
+# only use one core, and msgA decryption is CPU-bound, so a busy relay
+# spawns worker processes which all accept connections on the relay's
+# listening socket (inherited as a file descriptor). The master keeps
+# accepting too, and runs the retention sweeper.
+#
+# All processes share the on-disk QueueStore. TransportQueue serializes
+# appends and retrievals with a per-transport lock file, so queue order is
+# the order in which deliveries were accepted, no matter which process
+# accepted them, and each message is retrieved exactly once. Retrieval reads
+# the queue from disk on every request, so any process can serve it.
+#
+# Each process has inlet rate limits of its own (see
+# mailbox.ratelimit.InletLimits), which enforce 1/N of the configured rates
+# when there are N processes (the workers, plus the master). Run
+# misc/relay-benchmark.py to see what the workers buy on a given machine.
+
+import os, sys, json, socket
+from twisted.application import service
+from twisted.internet import reactor, protocol, defer, stdio
+from twisted.internet.address import IPv6Address
+from twisted.python import log
+
+RESPAWN_DELAY = 1.0
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        if "ready" in data and not self.ready.called:
+            self.ready.callback(self)
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            log.msg("worker[%d]: %s" % (self.number, line))
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self.pool.worker_ended(self)
+
+class WorkerPool(service.Service):
+    """I spawn (and respawn) 'count' worker processes, each serving the
+    mailbox from the listening port of 'web'."""
+    def __init__(self, basedir, web, count):
+        self.basedir = basedir
+        self.web = web
+        self.count = count
+        self.workers = {}
+        self._ready = []
+
+    def startService(self):
+        service.Service.startService(self)
+        d = self.web.port_service._waitingForPort
+        def _listening(port):
+            self.port = port
+            for number in range(self.count):
+                self.spawn(number)
+            self._notify_ready()
+            return port
+        d.addCallback(_listening)
+
+    def spawn(self, number):
+        family = "inet"
+        if isinstance(self.port.getHost(), IPv6Address):
+            family = "inet6"
+        fd = self.port.fileno()
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join([root] + sys.path[1:])
+        args = [sys.executable, "-m", "petmail.mailbox.workers",
+                self.basedir, str(fd), family]
+        p = WorkerProtocol(self, number)
+        # the worker exits when its stdin closes, i.e. when we go away
+        reactor.spawnProcess(p, sys.executable, args, env=env,
+                             childFDs={0: "w", 1: "r", 2: "r", fd: fd})
+        self.workers[number] = p
+        return p
+
+    def when_ready(self):
+        """Return a Deferred that fires when every worker is accepting
+        connections (for tests)."""
+        d = defer.Deferred()
+        self._ready.append(d)
+        if self.workers:
+            self._notify_ready()
+        return d
+
+    def _notify_ready(self):
+        observers, self._ready = self._ready, []
+        dl = defer.DeferredList([p.ready for p in self.workers.values()])
+        for d in observers:
+            dl.addCallback(lambda _, d=d: d.callback(None))
+
+    def worker_ended(self, p):
+        if self.workers.get(p.number) is not p:
+            return
+        del self.workers[p.number]
+        if self.running:
+            log.msg("mailbox worker %d exited, respawning" % p.number)
+            reactor.callLater(RESPAWN_DELAY, self._respawn, p.number)
+
+    def _respawn(self, number):
+        if self.running and number not in self.workers:
+            self.spawn(number)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        dl = []
+        for p in self.workers.values():
+            dl.append(p.ended)
+            try:
+                p.transport.signalProcess("TERM")
+            except EnvironmentError:
+                pass
+        return defer.DeferredList(dl)
+
+class WorkerWeb:
+    """I provide the parts of web.WebPort that HTTPMailboxServer uses, for a
+    worker process that serves an inherited socket. That is the mailbox's
+    own listener (web.MailboxPort) if the node has one, else the webport."""
+    def __init__(self, db):
+        from twisted.web import resource
+        from ..web import Root, BoundedSite, make_mailbox_factory
+        self.db = db
+        row = db.execute("SELECT * FROM node").fetchone()
+        if row["mailbox_port"]:
+            self.port = str(row["mailbox_port"])
+            self.root = resource.Resource()
+            self.site = BoundedSite(self.root)
+            self.factory = make_mailbox_factory(
+                self.site, row["mailbox_max_connections"],
+                row["mailbox_timeout"])
+        else:
+            self.port = str(row["webport"])
+            self.root = Root()
+            self.site = self.factory = BoundedSite(self.root)
+        self.site.access_log = False
+
+    def get_root(self):
+        return self.root
+
+    def get_baseurl(self):
+        row = self.db.execute("SELECT webhost FROM node").fetchone()
+        pieces = self.port.split(":")
+        return "http://%s:%d/" % (str(row["webhost"]), int(pieces[1]))
+
+class ParentWatcher(protocol.Protocol):
+    # our stdin is a pipe from the master: when that closes, the master is
+    # gone (perhaps SIGKILLed by 'petmail stop'), and so are we
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+def worker_main(basedir, fd, family):
+    from .. import database
+    from .server import HTTPMailboxServer
+    from .shard import make_router
+    log.startLogging(sys.stderr, setStdout=False)
+    db = database.get_db(os.path.join(basedir, "petmail.db"))
+    row = db.execute("SELECT * FROM mailbox_server_config").fetchone()
+    web = WorkerWeb(db)
+    s = HTTPMailboxServer(web, bool(row["enable_retrieval"]),
+                          json.loads(row["private_descriptor_json"]),
+                          os.path.join(basedir, "mailbox-queues"),
+                          run_sweeper=False, router=make_router(db),
+                          processes=1 + (row["workers"] or 0))
+    s.startService()
+    families = {"inet": socket.AF_INET, "inet6": socket.AF_INET6}
+    reactor.adoptStreamPort(fd, families[family], web.factory)
+    # we don't need our copy of the fd any more: the adopted port has its
+    # own
+    os.close(fd)
+    watcher = ParentWatcher()
+    stdio.StandardIO(watcher)
+    watcher.transport.write("ready\n")
+    reactor.run()
+
+if __name__ == "__main__":
+    worker_main(sys.argv[1], int(sys.argv[2]), sys.argv[3])
@@ -1,13 +1,31 @@
 
 console.log("control.js loaded");
 
+function fetchMessageBody(id, cb) {
+    // message events only carry the inbound_messages row: the body is
+    // loaded separately, and only for the messages we want to show
+    var req = {token: token, args: {id: id}};
+    d3.xhr("/api/v1/fetch-message-body", "application/json")
+        .post(JSON.stringify(req), function(err, r) {
+            if (err) {
+                console.log("fetch-message-body failed", id, err);
+                return;
+            }
+            cb(JSON.parse(r.responseText).payload);
+        });
+}
+
 function main() {
     console.log("onload");
     var ev = new EventSource("/api/v1/events/messages?token="+token);
     ev.onmessage = function(e) {
         var data = JSON.parse(e.data);
         console.log("event!", data.action, data.id, data.new_value);
-        console.log("basic message", JSON.parse(data.payload_json).basic);
+        if (data.action == "insert") {
+            fetchMessageBody(data.id, function(payload) {
+                console.log("basic message", payload.basic);
+            });
+        }
     };
 }
 
@@ -4,6 +4,9 @@ class _EmptyTransport:
     def loseConnection(self):
         pass
 class _NetstringParser(NetstringReceiver):
+    # we only parse strings we already hold in memory, so NetstringReceiver's
+    # (99999-byte) protection against huge length headers is no use to us
+    MAX_LENGTH = 1<<31
     def stringReceived(self, msg):
         self.messages.append(msg)
 
@@ -11,6 +14,19 @@ def netstring(msg):
     assert isinstance(msg, str)
     return "%d:%s," % (len(msg), msg)
 
+def split_netstring_prefix(s):
+    """Split s into (first netstring's contents, everything after it). Unlike
+    split_netstrings_and_trailer, this parses the header directly, so the
+    trailer is copied exactly once. 's' can be anything that slices like a
+    string, such as an mmap."""
+    colon = s.find(":", 0, 12)
+    if colon < 1 or not s[:colon].isdigit():
+        raise ValueError("corrupt netstring header")
+    end = colon + 1 + int(s[:colon])
+    if s[end:end+1] != ",":
+        raise ValueError("corrupt netstring")
+    return s[colon+1:end], s[end+1:]
+
 def split_netstrings(s):
     p = _NetstringParser()
     p.messages = messages = []
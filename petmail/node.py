@@ -1,4 +1,4 @@
-import json
+import os, json
 from twisted.application import service
 from . import database, web
 
@@ -9,6 +9,12 @@ class Node(service.MultiService):
         self.dbfile = dbfile
 
         self.db = database.make_observable_db(dbfile)
+        # hot paths use this instead, to keep SQLite off the reactor thread.
+        # It is our first child, so it stops last. Readers only help in WAL
+        # mode.
+        readers = 1 if self.get_node_config("db_profile") == "wal" else 0
+        self.adb = database.AsyncDatabase(self.db, dbfile, readers)
+        self.adb.setServiceParent(self)
         self.init_webport()
         self.init_mailbox_server()
         self.client = None
@@ -18,6 +24,8 @@ class Node(service.MultiService):
             if name == "client":
                 self.init_client()
                 self.web.enable_client(self.client, self.db)
+            elif name == "relay":
+                self.init_relay()
             else:
                 raise ValueError("Unknown service '%s'" % name)
 
@@ -25,6 +33,13 @@ class Node(service.MultiService):
         #print "NODE STARTED"
         service.MultiService.startService(self)
 
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        # don't leave requested commits (ObservableDatabase.request_commit)
+        # waiting for a reactor turn that may never come
+        self.db.commit()
+        return d
+
     def get_node_config(self, name):
         c = self.db.execute("SELECT %s FROM node LIMIT 1" % name)
         (value,) = c.fetchone()
@@ -37,18 +52,51 @@ class Node(service.MultiService):
     def init_webport(self):
         self.web = web.WebPort(self.basedir, self)
         self.web.setServiceParent(self)
+        # the mailbox can have a listener of its own, so deliveries don't
+        # compete with the control panel and API
+        self.mailbox_web = self.web
+        if self.get_node_config("mailbox_port"):
+            self.mailbox_web = web.MailboxPort(self.basedir, self)
+            self.mailbox_web.setServiceParent(self)
 
     def init_mailbox_server(self):
         from .mailbox.server import HTTPMailboxServer
+        from .mailbox.shard import make_router
         # TODO: learn/be-told our IP addr/hostname
         c = self.db.execute("SELECT * FROM mailbox_server_config")
         row = c.fetchone()
-        s = HTTPMailboxServer(self.web, bool(row["enable_retrieval"]),
-                              json.loads(row["private_descriptor_json"]))
+        s = HTTPMailboxServer(self.mailbox_web, bool(row["enable_retrieval"]),
+                              json.loads(row["private_descriptor_json"]),
+                              os.path.join(self.basedir, "mailbox-queues"),
+                              router=make_router(self.db),
+                              processes=1 + (row["workers"] or 0))
         s.setServiceParent(self)
         self.mailbox_server = s
 
+    def init_relay(self):
+        # A relay runs nothing but the mailbox server, which we tune for
+        # throughput: an access-log line per delivery costs more than
+        # queueing the message.
+        self.web.site.access_log = False
+        self.mailbox_web.site.access_log = False
+        c = self.db.execute("SELECT * FROM mailbox_server_config")
+        row = c.fetchone()
+        if row["shard_port"]:
+            from .mailbox.shard import ShardListener
+            l = ShardListener(self.db, row["shard_port"],
+                              self.mailbox_server.queues,
+                              self.mailbox_server.scheduler)
+            l.setServiceParent(self)
+            self.shard_listener = l
+        workers = row["workers"]
+        if workers:
+            from .mailbox.workers import WorkerPool
+            pool = WorkerPool(self.basedir, self.mailbox_web, workers)
+            pool.setServiceParent(self)
+            self.worker_pool = pool
+
     def init_client(self):
         from . import client
-        self.client = client.Client(self.db, self.basedir, self.mailbox_server)
+        self.client = client.Client(self.db, self.adb, self.basedir,
+                                    self.mailbox_server)
         self.client.setServiceParent(self)
@@ -0,0 +1,25 @@
+# 'petmail compact-db' converts a node's database to auto_vacuum=INCREMENTAL
+# (see database.enable_incremental_vacuum), so the archiver can give the
+# space of archived messages back to the filesystem. Databases created
+# before archiving existed need this once. It rewrites the whole file, which
+# takes a while for a big one, so the node must be stopped.
+
+import os
+from .. import database
+from .runner import NoNodeError
+
+def compact_db(so, stdout, stderr):
+    basedir = os.path.abspath(so["basedir"])
+    dbfile = os.path.join(basedir, "petmail.db")
+    if not (os.path.isdir(basedir) and os.path.exists(dbfile)):
+        raise NoNodeError(basedir)
+    if os.path.exists(os.path.join(basedir, "twistd.pid")):
+        print >>stderr, "%s is running: stop it first" % basedir
+        return 1
+    db = database.get_db(dbfile, stderr)
+    if database.enable_incremental_vacuum(db):
+        print >>stdout, "converted %s" % dbfile
+    else:
+        print >>stdout, "%s was already converted" % dbfile
+    db.close()
+    return 0
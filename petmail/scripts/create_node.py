@@ -1,21 +1,24 @@
 import os, sys, json
 from nacl.public import PrivateKey
-from .. import rrid, database
+from .. import rrid, database, archive
 
-def create_node(so, stdout=sys.stdout, stderr=sys.stderr):
-    basedir = so["basedir"]
+def create_basedir_and_db(basedir, stderr):
     if os.path.exists(basedir):
         print >>stderr, "basedir '%s' already exists, refusing to touch it" % basedir
-        return 1
+        return None
     os.mkdir(basedir)
     dbfile = os.path.join(basedir, "petmail.db")
-    db = database.get_db(dbfile, stderr)
-    db.execute("INSERT INTO node (webhost, webport) VALUES (?,?)",
-               (so["webhost"], so["webport"]))
-    db.execute("INSERT INTO services (name) VALUES (?)", ("client",))
-    db.execute("INSERT INTO `client_profile`"
-               " (`name`, `icon_data`) VALUES (?,?)",
-               ("",""))
+    return database.get_db(dbfile, stderr)
+
+def add_node_config(db, so):
+    db.execute("INSERT INTO node (webhost, webport, mailbox_port,"
+               " mailbox_max_connections, mailbox_timeout, db_profile)"
+               " VALUES (?,?,?,?,?,?)",
+               (so["webhost"], so["webport"], so["mailbox-port"],
+                int(so["mailbox-max-connections"]),
+                int(so["mailbox-timeout"]), so["db-profile"]))
+
+def add_mailbox_server_config(db, enable_retrieval, workers=0):
     privkey = PrivateKey.generate()
     TID_tokenid, TID_privkey, TID_token0 = rrid.create()
     server_desc = { "transport_privkey": privkey.encode().encode("hex"),
@@ -24,9 +27,41 @@ def create_node(so, stdout=sys.stdout, stderr=sys.stderr):
                     "local_TID_tokenid": TID_tokenid.encode("hex"),
                     }
     db.execute("INSERT INTO mailbox_server_config"
-               " (private_descriptor_json, enable_retrieval)"
-               " VALUES (?,?)",
-               (json.dumps(server_desc), 0))
+               " (private_descriptor_json, enable_retrieval, workers)"
+               " VALUES (?,?,?)",
+               (json.dumps(server_desc), int(enable_retrieval), workers))
+
+def create_node(so, stdout=sys.stdout, stderr=sys.stderr):
+    basedir = so["basedir"]
+    db = create_basedir_and_db(basedir, stderr)
+    if not db:
+        return 1
+    add_node_config(db, so)
+    db.execute("UPDATE node SET archive_after=?",
+               (int(so["archive-after"]) * archive.DAY,))
+    db.execute("INSERT INTO services (name) VALUES (?)", ("client",))
+    db.execute("INSERT INTO `client_profile`"
+               " (`name`, `icon_data`) VALUES (?,?)",
+               ("",""))
+    add_mailbox_server_config(db, False)
     db.commit()
     print >>stdout, "node created in %s" % basedir
     return 0
+
+def create_relay(so, stdout=sys.stdout, stderr=sys.stderr):
+    # A relay is a node that runs only the mailbox server, with retrieval
+    # enabled, for many tenants. It has no client, so no control panel,
+    # addressbook, or invitations.
+    basedir = so["basedir"]
+    db = create_basedir_and_db(basedir, stderr)
+    if not db:
+        return 1
+    add_node_config(db, so)
+    db.execute("INSERT INTO services (name) VALUES (?)", ("relay",))
+    add_mailbox_server_config(db, True, int(so["workers"]))
+    if so["shard-port"]:
+        db.execute("UPDATE mailbox_server_config SET shard_port=?",
+                   (so["shard-port"],))
+    db.commit()
+    print >>stdout, "relay created in %s" % basedir
+    return 0
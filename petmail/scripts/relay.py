@@ -0,0 +1,191 @@
+
+# Administrative commands for a relay (see create_node.create_relay). These
+# work directly on the relay's basedir, and do not need the relay to be
+# running: the mailbox server notices newly-provisioned transports on disk.
+
+import os, sys, json, time
+from nacl.public import PrivateKey
+from .. import rrid, database
+from ..util import make_nonce
+from ..mailbox.queue import QueueStore
+from ..mailbox.shard import (load_shards, get_shard_store, get_shard_key,
+                             migrate, shard_port_to_endpoint, ShardError)
+from .runner import NoNodeError
+
+def open_relay(basedir):
+    basedir = os.path.abspath(basedir)
+    dbfile = os.path.join(basedir, "petmail.db")
+    if not (os.path.isdir(basedir) and os.path.exists(dbfile)):
+        raise NoNodeError(basedir)
+    return basedir, database.get_db(dbfile)
+
+def get_relay_baseurl(db):
+    # the mailbox may have a listener of its own (see web.MailboxPort)
+    row = db.execute("SELECT webhost, webport, mailbox_port FROM node"
+                     " LIMIT 1").fetchone()
+    pieces = str(row["mailbox_port"] or row["webport"]).split(":")
+    assert pieces[0] == "tcp"
+    return "http://%s:%d/" % (str(row["webhost"]), int(pieces[1]))
+
+def add_transport(so, stdout=sys.stdout, stderr=sys.stderr):
+    basedir, db = open_relay(so["basedir"])
+    row = db.execute("SELECT * FROM mailbox_server_config").fetchone()
+    if not row["enable_retrieval"]:
+        print >>stderr, "%s is not a relay (retrieval is disabled)" % basedir
+        return 1
+    desc = json.loads(row["private_descriptor_json"])
+    privkey = PrivateKey(desc["transport_privkey"].decode("hex"))
+    if int(so["weight"]) < 1:
+        print >>stderr, "--weight must be at least 1"
+        return 1
+    baseurl = get_relay_baseurl(db)
+
+    TID_tokenid, TID_privkey, TID_token0 = rrid.create()
+    retrieval_id = make_nonce()
+    store = QueueStore(os.path.join(basedir, "mailbox-queues"))
+    quota_messages = quota_bytes = None
+    if so["quota-messages"]:
+        quota_messages = int(so["quota-messages"])
+    if so["quota-mb"]:
+        quota_bytes = int(float(so["quota-mb"])*1000*1000)
+    # the session keys that protect retrieval (see mailbox.session)
+    server_key = PrivateKey.generate()
+    retrieval_key = PrivateKey.generate()
+    config = {"retention": int(so["retention-days"])*24*60*60,
+              "retrieval_id": retrieval_id,
+              "quota_messages": quota_messages,
+              "quota_bytes": quota_bytes,
+              "server_privkey": server_key.encode().encode("hex"),
+              "retrieval_pubkey":
+              retrieval_key.public_key.encode().encode("hex"),
+              "weight": int(so["weight"]),
+              }
+    store.add_transport(TID_tokenid, **config)
+    ring, shards = load_shards(db)
+    if shards:
+        # we're a front end: our own copy only maps the retrieval_id to the
+        # TID, the queue itself lives on the owning shard
+        owner = shards[ring.lookup(TID_tokenid)]
+        get_shard_store(owner).add_transport(TID_tokenid, **config)
+
+    # this is what the tenant gives to 'petmail add-mailbox'
+    descriptor = {"sender": {"type": "http",
+                             "url": baseurl + "mailbox",
+                             "transport_pubkey":
+                             privkey.public_key.encode().encode("hex"),
+                             },
+                  "retrieval": {"type": "http",
+                                "url": baseurl + "retrieve/" + retrieval_id,
+                                "TID": TID_token0.encode("hex"),
+                                "server_pubkey":
+                                server_key.public_key.encode().encode("hex"),
+                                "retrieval_privkey":
+                                retrieval_key.encode().encode("hex"),
+                                },
+                  }
+    print >>stdout, json.dumps(descriptor)
+    return 0
+
+def list_transports(so, stdout=sys.stdout, stderr=sys.stderr):
+    basedir, db = open_relay(so["basedir"])
+    store = QueueStore(os.path.join(basedir, "mailbox-queues"))
+    now = time.time()
+    transports = []
+    for TID_tokenid in store.list_transports():
+        q = store.get_transport(TID_tokenid)
+        messages, bytes, oldest = q.get_counters()
+        transports.append({"TID_tokenid": TID_tokenid.encode("hex"),
+                           "retrieval_id": q.retrieval_id,
+                           "messages": messages,
+                           "bytes": bytes,
+                           "oldest": oldest or None,
+                           "quota_messages": q.quota_messages,
+                           "quota_bytes": q.quota_bytes,
+                           })
+    # the hottest tenants first
+    transports.sort(key=lambda t: (t["bytes"], t["messages"]), reverse=True)
+    if so["json"]:
+        print >>stdout, json.dumps(transports, indent=1)
+        return 0
+    def quota(used, limit):
+        if limit is None:
+            return "%d" % used
+        return "%d/%d" % (used, limit)
+    print >>stdout, "%-16s %12s %16s %10s" % ("TID", "messages", "bytes",
+                                              "oldest")
+    for t in transports:
+        age = "-"
+        if t["oldest"]:
+            age = "%dm" % ((now - t["oldest"]) // 60)
+        print >>stdout, "%-16s %12s %16s %10s" % (
+            t["TID_tokenid"][:16],
+            quota(t["messages"], t["quota_messages"]),
+            quota(t["bytes"], t["quota_bytes"]),
+            age)
+    # written by the relay's RetentionSweeper
+    stats = store.get_sweep_stats()
+    if stats["last_sweep"]:
+        print >>stdout, ("sweeps: %d, reclaimed: %d segments (%d bytes),"
+                         " last: %dm ago"
+                         % (stats["sweeps"], stats["segments_reclaimed"],
+                            stats["bytes_reclaimed"],
+                            (now - stats["last_sweep"]) // 60))
+    return 0
+
+def add_shard(so, stdout=sys.stdout, stderr=sys.stderr):
+    basedir, db = open_relay(so["basedir"])
+    shard_basedir, shard_db = open_relay(so["shard-basedir"])
+    name = so["name"] or os.path.basename(shard_basedir)
+    old = db.execute("SELECT * FROM mailbox_shards WHERE name=?",
+                     (name,)).fetchone()
+    if old and old["shard_key"]:
+        print >>stderr, "there is already a shard named '%s'" % name
+        return 1
+    # the front end proves it is one by knowing this (see mailbox.shard)
+    shard_key = get_shard_key(shard_db)
+    if old:
+        # added before shards had keys: that's all it lacks
+        db.execute("UPDATE mailbox_shards SET shard_key=? WHERE name=?",
+                   (shard_key, name))
+        db.commit()
+        print >>stdout, "added the shard_key of shard '%s'" % name
+        return 0
+    endpoint = so["endpoint"]
+    if not endpoint:
+        row = shard_db.execute("SELECT shard_port FROM mailbox_server_config"
+                               ).fetchone()
+        if not row["shard_port"]:
+            print >>stderr, ("%s is not a shard (create it with"
+                             " --shard-port)" % shard_basedir)
+            return 1
+        try:
+            endpoint = shard_port_to_endpoint(row["shard_port"])
+        except ShardError, e:
+            print >>stderr, "%s (start the shard first?)" % e
+            return 1
+    baseurl = so["url"] or get_relay_baseurl(shard_db)
+    first = not db.execute("SELECT COUNT(*) FROM mailbox_shards"
+                           ).fetchone()[0]
+    db.execute("INSERT INTO mailbox_shards"
+               " (name, endpoint, baseurl, basedir, draining, shard_key)"
+               " VALUES (?,?,?,?,0,?)",
+               (name, endpoint, baseurl, shard_basedir, shard_key))
+    db.commit()
+    print >>stdout, "added shard '%s'" % name
+    if first:
+        print >>stdout, "restart the relay to make it a front end"
+    print >>stdout, "run 'petmail migrate-shards' to give it its transports"
+    return 0
+
+def migrate_shards(so, stdout=sys.stdout, stderr=sys.stderr):
+    basedir, db = open_relay(so["basedir"])
+    if so["drain"]:
+        c = db.execute("UPDATE mailbox_shards SET draining=1 WHERE name=?",
+                       (so["drain"],))
+        if not c.rowcount:
+            print >>stderr, "no shard named '%s'" % so["drain"]
+            return 1
+        db.commit()
+    moved = migrate(db, stdout)
+    print >>stdout, "%d transports moved" % moved
+    return 0
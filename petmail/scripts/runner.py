@@ -43,13 +43,88 @@ class StartArguments(BasedirArgument):
         self.twistd_args = twistd_args
         BasedirArgument.parseArgs(self, basedir)
 
-class CreateNodeOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
-    optParameters = [
+MAILBOX_PORT_OPTIONS = [
+    ("mailbox-port", None, None,
+     "Separate port for mailbox deliveries and retrieval (default: webport)"),
+    ("mailbox-max-connections", None, "1000",
+     "Refuse connections to the mailbox-port beyond this many"),
+    ("mailbox-timeout", None, "60",
+     "Drop idle mailbox-port connections after this many seconds"),
+    ]
+
+# for the commands which create a database
+DB_OPTIONS = [
+    ("db-profile", None, "wal",
+     "Database durability profile: 'wal' (faster) or 'safe'"),
+    ]
+
+class DBOptionsMixin(BasedirParameterMixin):
+    def postOptions(self):
+        BasedirParameterMixin.postOptions(self)
+        from .. import database
+        if self["db-profile"] not in database.DB_PROFILES:
+            raise usage.UsageError("unknown --db-profile '%s', try one of: %s"
+                                   % (self["db-profile"],
+                                      ", ".join(sorted(database.DB_PROFILES))))
+
+class CreateNodeOptions(DBOptionsMixin, BasedirArgument, usage.Options):
+    optParameters = MAILBOX_PORT_OPTIONS + DB_OPTIONS + [
         ("webport", "p", "tcp:0:interface=127.0.0.1",
          "TCP port for the node's HTTP interface."),
         ("webhost", "h", "localhost",
          "hostname/IP-addr to advertise in URLs"),
         ("relay", "r", "tcp:host=localhost:port=5773", "Relay location"),
+        ("archive-after", None, "90",
+         "Archive messages after this many days (0: never)"),
+        ]
+
+class CreateRelayOptions(DBOptionsMixin, BasedirArgument, usage.Options):
+    optParameters = MAILBOX_PORT_OPTIONS + DB_OPTIONS + [
+        ("webport", "p", "tcp:5773",
+         "TCP port for the relay's HTTP (mailbox) interface."),
+        ("webhost", "h", "localhost",
+         "hostname/IP-addr to advertise in URLs"),
+        ("workers", "w", "0",
+         "Extra worker processes to accept and decrypt deliveries"),
+        ("shard-port", None, None,
+         "Also act as a shard: accept messages from a front end on this port"),
+        ]
+
+class AddTransportOptions(BasedirParameterMixin, usage.Options):
+    optParameters = [
+        ("retention-days", "r", "14",
+         "Delete even unretrieved messages after this many days"),
+        ("quota-messages", None, None,
+         "Refuse deliveries once this many messages are queued"),
+        ("quota-mb", None, None,
+         "Refuse deliveries once this many megabytes are queued"),
+        ("weight", None, "1",
+         "Share of the relay's disk and bandwidth, relative to others"),
+        ]
+
+class AddShardOptions(BasedirParameterMixin, usage.Options):
+    optParameters = [
+        ("name", "n", None, "Shard name (default: its basedir's name)"),
+        ("endpoint", None, None,
+         "Client endpoint for the shard's shard-port (default: from its DB)"),
+        ("url", None, None,
+         "Base URL of the shard's web port (default: from its DB)"),
+        ]
+    def parseArgs(self, shard_basedir):
+        self["shard-basedir"] = shard_basedir
+
+class MigrateShardsOptions(BasedirParameterMixin, usage.Options):
+    optParameters = [
+        ("drain", None, None,
+         "Take this shard out of the ring, and move its transports away"),
+        ]
+
+class CompactDBOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
+    pass
+
+class ListTransportsOptions(BasedirParameterMixin, usage.Options):
+    optFlags = [
+        ("json", "j", "Emit JSON instead of a table"),
         ]
 
 class StartNodeOptions(BasedirParameterMixin, StartArguments, usage.Options):
@@ -101,6 +176,9 @@ class SendBasicOptions(BasedirParameterMixin, usage.Options):
 class FetchMessagesOptions(BasedirParameterMixin, usage.Options):
     pass
 
+class SpoolStatusOptions(BasedirParameterMixin, usage.Options):
+    pass
+
 class TestOptions(usage.Options):
     def parseArgs(self, *test_args):
         if not test_args:
@@ -114,18 +192,26 @@ class Options(usage.Options):
         ("basedir", "d", os.path.expanduser("~/.petmail"), "Base directory"),
         ]
     subCommands = [("create-node", None, CreateNodeOptions, "Create a node"),
+                   ("create-relay", None, CreateRelayOptions,
+                    "Create a relay (standalone mailbox server)"),
                    ("start", None, StartNodeOptions, "Start a node"),
                    ("stop", None, StopNodeOptions, "Stop a node"),
                    ("restart", None, RestartNodeOptions, "Restart a node"),
                    ("open", None, OpenOptions, "Open web control panel"),
+                   ("compact-db", None, CompactDBOptions, "Let a stopped node's database shrink as messages are archived"),
 
                    ("sample", None, SampleOptions, "Sample Command"),
                    ("invite", None, InviteOptions, "Start an Invitation"),
                    ("addressbook", None, AddressbookOptions, "List Addressbook"),
                    ("add-mailbox", None, AddMailboxOptions, "Add a new mailbox"),
                    ("enable-local-mailbox", None, EnableLocalMailboxOptions, "Enable the local (in-process) HTTP mailbox"),
+                   ("add-transport", None, AddTransportOptions, "Provision a new transport (tenant) on a relay"),
+                   ("list-transports", None, ListTransportsOptions, "List a relay's transports, largest queue first"),
+                   ("add-shard", None, AddShardOptions, "Add a shard to a front-end relay"),
+                   ("migrate-shards", None, MigrateShardsOptions, "Move transports to the shards which now own them"),
                    ("send-basic", None, SendBasicOptions, "Send a basic message"),
                    ("fetch-messages", None, FetchMessagesOptions, "Fetch all stored messages"),
+                   ("spool-status", None, SpoolStatusOptions, "Show how many retrieved messages are waiting to be processed"),
 
                    ("test", None, TestOptions, "Run unit tests"),
                    ]
@@ -175,11 +261,31 @@ def open_control_panel(*args):
     from .open import open_control_panel
     return open_control_panel(*args)
 
+def compact_db(*args):
+    from .compact_db import compact_db
+    return compact_db(*args)
+
 
 def create_relay(*args):
     from .create_node import create_relay
     return create_relay(*args)
 
+def add_transport(*args):
+    from .relay import add_transport
+    return add_transport(*args)
+
+def list_transports(*args):
+    from .relay import list_transports
+    return list_transports(*args)
+
+def add_shard(*args):
+    from .relay import add_shard
+    return add_shard(*args)
+
+def migrate_shards(*args):
+    from .relay import migrate_shards
+    return migrate_shards(*args)
+
 petmail_executable = []
 
 def test(so, stdout, stderr):
@@ -212,6 +318,12 @@ def render_messages(result):
         lines.append(str(entry["payload"]))
     return "\n".join(lines)+"\n"
 
+def render_spool_status(result):
+    spool = result["spool"]
+    return ("inbound: %d, slow lane: %d, retry: %d%s\n"
+            % (spool["inbound"], spool["slow"], spool["retry"],
+               " (retrieval paused)" if spool["paused"] else ""))
+
 def WebCommand(name, argnames, render=render_text):
     # Build a dispatch function for simple commands that deliver some string
     # arguments to a web API, then display a result.
@@ -236,7 +348,12 @@ DISPATCH = {"create-node": create_node,
             "stop": stop,
             "restart": restart,
             "open": open_control_panel,
+            "compact-db": compact_db,
             "create-relay": create_relay,
+            "add-transport": add_transport,
+            "list-transports": list_transports,
+            "add-shard": add_shard,
+            "migrate-shards": migrate_shards,
             "test": test,
 
             "sample": WebCommand("sample", ["data", "success-object",
@@ -249,6 +366,8 @@ DISPATCH = {"create-node": create_node,
             "send-basic": WebCommand("send-basic", ["cid", "message"]),
             "fetch-messages": WebCommand("fetch-messages", [],
                                          render=render_messages),
+            "spool-status": WebCommand("spool-status", [],
+                                       render=render_spool_status),
             "accept": accept,
             }
 
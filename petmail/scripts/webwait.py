@@ -28,6 +28,10 @@ def get_url_and_token(basedir, err):
         # Node has not yet chosen a port number. It needs to be started.
         return None, None
     url = "http://localhost:%d/" % portnum
+    c = db.execute("SELECT name FROM services")
+    if "client" not in [str(name) for (name,) in c.fetchall()]:
+        # relays have no web API, and thus no access token
+        return url, None
     c = db.execute("SELECT token FROM webapi_access_tokens LIMIT 1")
     (token,) = c.fetchone()
     if not token:
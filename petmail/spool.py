@@ -0,0 +1,360 @@
+
+# I hold inbound messages between retrieval and processing. Retrievers
+# (mailbox.retrieval) hand me each batch of msgC as soon as it arrives, and
+# I write it to disk (and fsync) before returning, so the mailbox can forget
+# it. Processing (Client.msgC_received) happens later, at its own pace, and
+# a message whose processing fails is kept and retried, rather than lost.
+#
+#  SPOOLDIR/NUMBER.log  : records, append-only, in arrival order
+#  SPOOLDIR/cursor.json : (NUMBER, offset) of the first unprocessed record
+#  SPOOLDIR/slow.log    : records for the slow lane (see below)
+#  SPOOLDIR/retry.log   : records whose processing failed, for another try
+#
+# A record is netstring(SPOOL_RECORD + msgC). Each .log segment is appended
+# to until it reaches segment_size, and deleted once it has been processed.
+# After a restart we always start a new segment, so a record cut short by a
+# crash is only ever at the end of a segment, where it is ignored.
+#
+# Most messages are the next one expected on some channel, and can be
+# matched to it by their CIDToken, with a single lookup ('classify'). Those
+# are processed right away, in arrival order, which is also seqnum order for
+# each channel. The rest can only be identified by trying every channel's
+# keys, so they are moved to a slow lane, which is processed a few records
+# per reactor turn. A burst of unidentifiable junk then costs the messages
+# behind it a little latency, rather than all of its trial decryptions.
+#
+# Retrievers can pull faster than we can process. They register with me as
+# producers (pauseProducing/resumeProducing, like Twisted's IPushProducer),
+# and I pause them all while more than HIGH_WATER records are waiting
+# (inbound or in the slow lane), until the backlog drops below LOW_WATER.
+# A huge backlog on the mailbox is then drained at the rate we can process
+# it, rather than being moved wholesale into our spool. Both transitions are
+# logged, and 'petmail spool-status' shows the depth of each lane.
+#
+# The cursor is saved after each batch, after calling 'checkpoint' (which
+# commits the database), so a crash may make us process some messages
+# twice, but never lose one. The second attempt raises ReplayError (the channel has
+# already seen that seqnum), which we treat as success. 'checkpoint' may
+# return a Deferred (the commit runs on the database's writer thread): each
+# lane waits for it before moving on to its next batch.
+
+import os, json, struct
+from twisted.application import service, internet
+from twisted.internet import defer
+from twisted.python import log
+from .eventual import eventually
+from .netstring import netstring
+from .errors import ReplayError
+
+# (mailbox id, previous attempts)
+SPOOL_RECORD = struct.Struct(">QH")
+DEFAULT_SEGMENT_SIZE = 1*1000*1000
+DEFAULT_RETRY_INTERVAL = 60
+PROCESS_BATCH = 100 # records per reactor turn
+SLOW_BATCH = 10 # slow-lane records per reactor turn
+MAX_ATTEMPTS = 10
+HIGH_WATER = 5000 # records waiting, before retrievers are paused
+LOW_WATER = 1000 # ... and resumed
+
+class InboundSpool(service.MultiService):
+    def __init__(self, spooldir, process_msgC, classify=None,
+                 checkpoint=None, segment_size=DEFAULT_SEGMENT_SIZE,
+                 retry_interval=DEFAULT_RETRY_INTERVAL):
+        service.MultiService.__init__(self)
+        self.spooldir = spooldir
+        self.process_msgC = process_msgC # (tid, msgC), raises to retry
+        # (tid, msgC) -> cid, or None for the slow lane
+        self.classify = classify
+        # makes the results of processing durable, before we forget the
+        # records that produced them
+        self.checkpoint = checkpoint or (lambda: None)
+        self.segment_size = segment_size
+        if not os.path.isdir(spooldir):
+            os.makedirs(spooldir)
+        segments = self.list_segments()
+        self.current = segments[-1] + 1 if segments else 0
+        self.scheduled = False
+        self.busy = False # waiting for a checkpoint
+        self.again = False # ... and asked to process() meanwhile
+        self.slow_scheduled = False
+        self.slow_busy = False
+        self.slow_again = False
+        self.slow_offset = 0
+        self.producers = []
+        self.paused = False
+        depths = self.get_depths()
+        self.backlog = depths["inbound"] + depths["slow"]
+        t = internet.TimerService(retry_interval, self.process_retries)
+        t.setServiceParent(self)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        # whatever was left over from last time
+        self.schedule()
+        self.schedule_slow()
+
+    def _fn(self, number):
+        return os.path.join(self.spooldir, "%d.log" % number)
+
+    def list_segments(self):
+        numbers = []
+        for fn in os.listdir(self.spooldir):
+            if fn.endswith(".log") and fn[:-len(".log")].isdigit():
+                numbers.append(int(fn[:-len(".log")]))
+        return sorted(numbers)
+
+    def get_cursor(self):
+        try:
+            with open(os.path.join(self.spooldir, "cursor.json"), "rb") as f:
+                return tuple(json.load(f))
+        except EnvironmentError:
+            return (0, 0)
+
+    def set_cursor(self, number, offset):
+        fn = os.path.join(self.spooldir, "cursor.json")
+        with open(fn+".tmp", "wb") as f:
+            json.dump([number, offset], f)
+        os.rename(fn+".tmp", fn)
+
+    def registerProducer(self, producer):
+        self.producers.append(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+    def unregisterProducer(self, producer):
+        self.producers.remove(producer)
+
+    def _update_backlog(self, delta):
+        self.backlog += delta
+        if not self.paused and self.backlog >= HIGH_WATER:
+            self.paused = True
+            log.msg("inbound spool: %d records waiting, pausing %d"
+                    " retrievers" % (self.backlog, len(self.producers)))
+            for p in self.producers:
+                p.pauseProducing()
+        elif self.paused and self.backlog <= LOW_WATER:
+            self.paused = False
+            log.msg("inbound spool: %d records waiting, resuming %d"
+                    " retrievers" % (self.backlog, len(self.producers)))
+            for p in self.producers:
+                p.resumeProducing()
+
+    def append(self, tid, msgCs):
+        """Durably record some msgCs retrieved from mailbox 'tid'. Once this
+        returns, the mailbox may forget them."""
+        if not msgCs:
+            return
+        fn = self._fn(self.current)
+        self._write(fn, [(tid, 0, msgC) for msgC in msgCs])
+        if os.path.getsize(fn) >= self.segment_size:
+            self.current += 1
+        self._update_backlog(len(msgCs))
+        self.schedule()
+
+    def _write(self, fn, records):
+        data = "".join([netstring(SPOOL_RECORD.pack(tid, attempts) + msgC)
+                        for (tid, attempts, msgC) in records])
+        with open(fn, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_records(self, fn, offset):
+        """Yield (tid, attempts, msgC, offset of the next record) for each
+        complete record of 'fn' from 'offset' onwards."""
+        try:
+            with open(fn, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except EnvironmentError:
+            return
+        pos = 0
+        while pos < len(data):
+            colon = data.find(":", pos, pos+12)
+            if colon < 0 or not data[pos:colon].isdigit():
+                break
+            end = colon + 1 + int(data[pos:colon])
+            if data[end:end+1] != ",":
+                break # cut short by a crash
+            header = data[colon+1:colon+1+SPOOL_RECORD.size]
+            tid, attempts = SPOOL_RECORD.unpack(header)
+            msgC = data[colon+1+SPOOL_RECORD.size:end]
+            pos = end + 1
+            yield tid, attempts, msgC, offset+pos
+
+    def schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            eventually(self.process)
+
+    def process(self):
+        self.scheduled = False
+        if self.busy:
+            # the cursor hasn't moved yet: try again once it has
+            self.again = True
+            return
+        number, offset = self.get_cursor()
+        retries = []
+        slow = []
+        finished = []
+        count = 0
+        more = False
+        for n in self.list_segments():
+            if n < number:
+                finished.append(n) # processed before a crash
+                continue
+            if n > number:
+                number, offset = n, 0
+            for (tid, attempts, msgC, end) in self.read_records(self._fn(n),
+                                                                offset):
+                if count >= PROCESS_BATCH:
+                    more = True
+                    break
+                if self.classify and self.classify(tid, msgC) is None:
+                    slow.append((tid, attempts, msgC))
+                else:
+                    self._process(tid, attempts, msgC, retries)
+                offset = end
+                count += 1
+            if more:
+                break
+            if n < self.current:
+                finished.append(n) # nothing more will be appended
+        if not count and not finished:
+            return # nothing new, so nothing to commit
+        # these must be safe before the cursor moves past them
+        self.busy = True
+        d = defer.maybeDeferred(self.checkpoint)
+        def _checkpointed(_):
+            if slow:
+                self._write(os.path.join(self.spooldir, "slow.log"), slow)
+                self.schedule_slow()
+            if retries:
+                self._write(os.path.join(self.spooldir, "retry.log"),
+                            retries)
+            self.set_cursor(number, offset)
+            for n in finished:
+                os.unlink(self._fn(n))
+            # the slow lane is still part of the backlog
+            self._update_backlog(-(count - len(slow)))
+        d.addCallback(_checkpointed)
+        def _done(res):
+            self.busy = False
+            if more or self.again:
+                self.again = False
+                self.schedule()
+            return res
+        d.addBoth(_done)
+        d.addErrback(log.err, "unable to checkpoint the inbound spool")
+
+    def schedule_slow(self):
+        if not self.slow_scheduled:
+            self.slow_scheduled = True
+            eventually(self.process_slow)
+
+    def process_slow(self):
+        # like process_retries, slow.log is moved aside before we work on
+        # it. We don't save our place in slow.old: after a crash we start
+        # it again from the top, and the channels reject the replays.
+        self.slow_scheduled = False
+        if self.slow_busy:
+            self.slow_again = True
+            return
+        fn = os.path.join(self.spooldir, "slow.log")
+        old = os.path.join(self.spooldir, "slow.old")
+        if not os.path.exists(old):
+            if not os.path.exists(fn):
+                return
+            os.rename(fn, old)
+            self.slow_offset = 0
+        retries = []
+        count = 0
+        more = False
+        for (tid, attempts, msgC, end) in self.read_records(old,
+                                                            self.slow_offset):
+            if count >= SLOW_BATCH:
+                more = True
+                break
+            self._process(tid, attempts, msgC, retries)
+            self.slow_offset = end
+            count += 1
+        self.slow_busy = True
+        d = defer.maybeDeferred(self.checkpoint)
+        def _checkpointed(_):
+            if retries:
+                self._write(os.path.join(self.spooldir, "retry.log"),
+                            retries)
+            if not more:
+                os.unlink(old)
+            self._update_backlog(-count)
+        d.addCallback(_checkpointed)
+        def _done(res):
+            self.slow_busy = False
+            if more or self.slow_again or os.path.exists(fn):
+                self.slow_again = False
+                self.schedule_slow()
+            return res
+        d.addBoth(_done)
+        d.addErrback(log.err, "unable to checkpoint the inbound spool")
+
+    def count_records(self, fn, offset=0):
+        return len(list(self.read_records(fn, offset)))
+
+    def get_depths(self):
+        """Return the number of records waiting in each lane: 'inbound'
+        (not yet looked at), 'slow', and 'retry'."""
+        number, offset = self.get_cursor()
+        inbound = 0
+        for n in self.list_segments():
+            if n >= number:
+                inbound += self.count_records(self._fn(n),
+                                              offset if n == number else 0)
+        j = lambda fn: os.path.join(self.spooldir, fn)
+        return {"inbound": inbound,
+                "slow": (self.count_records(j("slow.old"), self.slow_offset)
+                         + self.count_records(j("slow.log"))),
+                "retry": (self.count_records(j("retry.old"))
+                          + self.count_records(j("retry.log"))),
+                }
+
+    def get_status(self):
+        """Return get_depths(), plus whether the retrievers are paused."""
+        status = self.get_depths()
+        status["paused"] = self.paused
+        return status
+
+    def _process(self, tid, attempts, msgC, retries):
+        try:
+            self.process_msgC(tid, msgC)
+        except ReplayError:
+            pass # we processed it already, just before a crash
+        except Exception:
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                log.err(None, "giving up on inbound message from mailbox %d"
+                        % tid)
+                return
+            log.msg("inbound message from mailbox %d failed (attempt %d),"
+                    " will retry" % (tid, attempts))
+            retries.append((tid, attempts, msgC))
+
+    def process_retries(self):
+        # retry.log is moved aside, then processed in full. Anything that
+        # fails again goes into a new retry.log. If we crashed in the middle
+        # of this last time, retry.old is still there: finish it first.
+        fn = os.path.join(self.spooldir, "retry.log")
+        old = os.path.join(self.spooldir, "retry.old")
+        if not os.path.exists(old):
+            if not os.path.exists(fn):
+                return
+            os.rename(fn, old)
+        retries = []
+        for (tid, attempts, msgC, end) in self.read_records(old, 0):
+            self._process(tid, attempts, msgC, retries)
+        d = defer.maybeDeferred(self.checkpoint)
+        def _checkpointed(_):
+            if retries:
+                self._write(fn, retries)
+            os.unlink(old)
+        d.addCallback(_checkpointed)
+        return d # TimerService waits for this before the next round
@@ -17,6 +17,13 @@ class BasedirMixin:
         test = os.path.dirname(random)
         return test
 
+class FakeClock:
+    """I stand in for time.time, and only move when a test sets .now"""
+    def __init__(self, now=0.0):
+        self.now = now
+    def __call__(self):
+        return self.now
+
 class NodeRunnerMixin:
     def setUp(self):
         self.sparent = service.MultiService()
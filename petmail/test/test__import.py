@@ -10,12 +10,20 @@ class Import(unittest.TestCase):
         del _version, base32, client, database, errors, eventual
         from .. import hkdf, invitation, netstring, node, rrid, util, web
         del hkdf, invitation, netstring, node, rrid, util, web
+        from .. import spool
+        del spool
 
         from ..rendezvous import localdir
         del localdir
 
         from ..scripts import create_node, open, runner, startstop, webwait
         del create_node, open, runner, startstop, webwait
+        from ..scripts import relay
+        del relay
 
         from ..mailbox import channel, server, delivery, retrieval
         del channel, server, delivery, retrieval
+        from ..mailbox import queue, ratelimit, workers, shard, session
+        del queue, ratelimit, workers, shard, session
+        from ..mailbox import scheduler, dedup
+        del scheduler, dedup
@@ -0,0 +1,109 @@
+import os.path, json
+from twisted.trial import unittest
+from .common import BasedirMixin, FakeClock
+from .. import archive
+from ..archive import Archiver, DAY
+from ..database import make_observable_db, AsyncDatabase
+
+class Archive(BasedirMixin, unittest.TestCase):
+    def add_message(self, db, seqnum, received_at):
+        body = json.dumps({"basic": "message %d %s" % (seqnum, "x"*5000)})
+        id = db.insert("INSERT INTO inbound_messages"
+                       " (cid, seqnum, payload_size, received_at)"
+                       " VALUES (?,?,?,?)",
+                       (1, seqnum, len(body), received_at))
+        db.insert("INSERT INTO message_bodies (message_id, payload_json)"
+                  " VALUES (?,?)", (id, body))
+        return id
+
+    def test_archive(self):
+        self.patch(archive, "ARCHIVE_BATCH", 2)
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        self.failUnlessEqual(db.execute("PRAGMA auto_vacuum").fetchone()[0],
+                             2) # INCREMENTAL
+        adb = AsyncDatabase(db)
+        adb.startService()
+        self.addCleanup(adb.stopService)
+        clock = FakeClock(100*DAY)
+        old = [self.add_message(db, i, clock.now-2*DAY) for i in range(3)]
+        new = self.add_message(db, 3, clock.now)
+        db.commit()
+        a = Archiver(adb, os.path.join(basedir, "archive"), DAY,
+                     segment_size=1, clock=clock)
+
+        d = a.archive()
+        d.addCallback(self.failUnlessEqual, 2) # a whole batch
+        d.addCallback(lambda _: a.archive())
+        d.addCallback(self.failUnlessEqual, 1)
+        d.addCallback(lambda _: a.archive())
+        d.addCallback(self.failUnlessEqual, 0)
+        def _archived(_):
+            rows = db.execute("SELECT id FROM inbound_messages").fetchall()
+            self.failUnlessEqual([r[0] for r in rows], [new])
+            rows = db.execute("SELECT message_id FROM message_bodies")
+            self.failUnlessEqual([r[0] for r in rows.fetchall()], [new])
+            rows = db.execute("SELECT * FROM archived_messages"
+                              " ORDER BY id").fetchall()
+            self.failUnlessEqual([r["id"] for r in rows], old)
+            # each batch is a block, and the small segment_size gave the
+            # second one a segment of its own
+            self.failUnlessEqual([r["segment"] for r in rows], [0, 0, 1])
+            self.failUnlessEqual(a.store.list_segments(), [0, 1])
+            for r in rows:
+                body = json.loads(a.store.get_body(r))
+                self.failUnless(body["basic"].startswith("message %d "
+                                                         % r["seqnum"]))
+                self.failUnlessEqual(r["received_at"], clock.now-2*DAY)
+            # the freed pages went back to the filesystem
+            free = db.execute("PRAGMA freelist_count").fetchone()[0]
+            self.failUnlessEqual(free, 0)
+            return a.search(rows, "message 1 ")
+        d.addCallback(_archived)
+        d.addCallback(lambda rows:
+                      self.failUnlessEqual([r["id"] for r in rows], [old[1]]))
+        return d
+
+    def test_interrupted(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        adb = AsyncDatabase(db)
+        adb.startService()
+        self.addCleanup(adb.stopService)
+        clock = FakeClock(100*DAY)
+        id = self.add_message(db, 1, clock.now-2*DAY)
+        db.commit()
+        a = Archiver(adb, os.path.join(basedir, "archive"), DAY, clock=clock)
+        # a crash after the block was written, but before the database
+        # committed, leaves the block behind with nothing pointing at it
+        a.store.append({id: "stale"})
+        d = a.archive()
+        d.addCallback(self.failUnlessEqual, 1)
+        def _archived(_):
+            row = db.execute("SELECT * FROM archived_messages").fetchone()
+            self.failIfEqual(row["offset"], 0)
+            # Archiver.get_body reads in a thread
+            d2 = a.get_body(row)
+            d2.addCallback(lambda body:
+                           self.failUnlessIn("message 1 ", body))
+            return d2
+        d.addCallback(_archived)
+        return d
+
+    def test_vacuum(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        adb = AsyncDatabase(db)
+        adb.startService()
+        self.addCleanup(adb.stopService)
+        self.add_message(db, 1, 0)
+        # the PRAGMA would commit the insert, so vacuum refuses
+        self.failUnless(db.in_transaction)
+        self.failUnlessRaises(AssertionError, archive.vacuum, db)
+        seen = []
+        def _after(db):
+            seen.append(db.in_transaction)
+            return archive.vacuum(db)
+        d = adb.commit(after=_after)
+        d.addCallback(lambda _: self.failUnlessEqual(seen, [False]))
+        return d
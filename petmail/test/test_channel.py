@@ -18,15 +18,15 @@ class msgC(TwoNodeMixin, unittest.TestCase):
 
         CIDToken, CIDBox, msgD = channel.parse_msgC(msgC)
 
-        CIDKey = entB["my_CID_key"].decode("hex")
+        CIDKey = entB["my_CID_key"]
         seqnum, HmsgD, channel_pubkey = channel.decrypt_CIDBox(CIDKey, CIDBox)
         self.failUnlessEqual(HmsgD, sha256(msgD).digest())
 
-        Bkey = PrivateKey(entB["my_new_channel_privkey"].decode("hex"))
+        Bkey = PrivateKey(entB["my_new_channel_privkey"])
         keylist = [(Bkey, "keyid")]
         keyid, pubkey2_s, msgE = channel.decrypt_msgD(msgD, keylist)
 
-        their_verfkey = entB["their_verfkey"].decode("hex")
+        their_verfkey = entB["their_verfkey"]
         seqnum, payload2_s = channel.check_msgE(msgE, pubkey2_s,
                                                 their_verfkey,
                                                 entB["highest_inbound_seqnum"])
@@ -59,14 +59,18 @@ class msgC(TwoNodeMixin, unittest.TestCase):
 
         CIDToken, CIDBox, msgD = channel.parse_msgC(msgC)
 
-        # TODO: test CIDToken
+        # test CIDToken: this is the message entB2 expects next
+        cid,which_key = channel.find_channel_from_CIDToken(nB.db, CIDToken)
+        self.failUnlessEqual(cid, entB2["id"])
+        self.failUnlessEqual(channel.identify_msgC(nB.db, msgC), entB2["id"])
+        self.failUnlessEqual(channel.identify_msgC(nA.db, msgC), None)
 
         # test CIDBox
         cid,which_key = channel.find_channel_from_CIDBox(nB.db, CIDBox)
         self.failUnlessEqual(cid, entB2["id"])
         # the CIDBox claims to tell us which key to use. We won't actually
         # use it unless it matches the cid that was able to open the CIDBox
-        privkey_s = entB2["my_new_channel_privkey"].decode("hex")
+        privkey_s = entB2["my_new_channel_privkey"]
         pubkey = PrivateKey(privkey_s).public_key.encode()
         self.failUnlessEqual(which_key, pubkey)
 
@@ -91,6 +95,11 @@ class msgC(TwoNodeMixin, unittest.TestCase):
 
         self.failUnlessEqual(self.get_outbound_seqnum(nA.db, entA2["id"]), 2)
         self.failUnlessEqual(self.get_inbound_seqnum(nB.db, entB2["id"]), 1)
+        # now the channel expects the next seqnum instead
+        self.failUnlessEqual(channel.identify_msgC(nB.db, msgC), None)
+        msgC2 = chan.createMsgC(payload)
+        self.failUnlessEqual(channel.identify_msgC(nB.db, msgC2),
+                             entB2["id"])
 
 class Send(TwoNodeMixin, unittest.TestCase):
     def test_send(self):
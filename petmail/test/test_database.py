@@ -1,8 +1,17 @@
-import os.path
+import os.path, sqlite3
+from StringIO import StringIO
 from twisted.trial import unittest
+from twisted.internet import defer
 from common import BasedirMixin
 from ..eventual import flushEventualQueue
-from ..database import get_db, make_observable_db
+from ..scripts import runner
+from ..database import (get_db, make_observable_db, DBError, AsyncDatabase,
+                        ObservableDatabase, get_schema, TARGET_VERSION,
+                        blob)
+
+# the schema that the first nodes were created with
+V1_BASELINE = os.path.join(os.path.dirname(__file__), "fixtures",
+                           "v1-baseline.sql")
 
 class Database(BasedirMixin, unittest.TestCase):
     def test_create(self):
@@ -11,12 +20,14 @@ class Database(BasedirMixin, unittest.TestCase):
         db = get_db(dbfile)
 
         row = db.execute("SELECT * FROM version").fetchone()
-        self.failUnlessEqual(row["version"], 1)
+        self.failUnlessEqual(row["version"], TARGET_VERSION)
         
     def test_observable(self):
         basedir = self.make_basedir()
         dbfile = os.path.join(basedir, "test.db")
-        db = make_observable_db(dbfile)
+        # what is observed doesn't depend on the schema, so this runs on
+        # the one it was written for: test_observable_schema covers ours
+        db = ObservableDatabase(self.make_v1_db(dbfile))
 
         n = []
         db.subscribe("inbound_messages", n.append)
@@ -80,6 +91,419 @@ class Database(BasedirMixin, unittest.TestCase):
         d.addCallback(_then3)
         
         return d
+
+    def make_v1_db(self, dbfile):
+        conn = sqlite3.connect(dbfile)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(open(V1_BASELINE).read())
+        conn.execute("INSERT INTO version (version) VALUES (1)")
+        conn.commit()
+        return conn
+
+    def test_observable_schema(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = make_observable_db(dbfile)
+
+        n = []
+        db.subscribe("inbound_messages", n.append)
+        # bodies live in a table of their own, which nobody watches
+        imid = db.insert("INSERT INTO inbound_messages"
+                         " (cid, seqnum, payload_size, received_at)"
+                         " VALUES (?,?,?,?)", (4, 9, 7, 1000),
+                         "inbound_messages")
+        db.insert("INSERT INTO message_bodies (message_id, payload_json)"
+                  " VALUES (?,?)", (imid, "payload"), "message_bodies")
+        db.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(n), 1)
+            n0 = n.pop(0)
+            self.failUnlessEqual(n0.action, "insert")
+            self.failUnlessEqual(n0.id, imid)
+            self.failUnlessEqual(n0.new_value["seqnum"], 9)
+            self.failUnlessEqual(n0.new_value["payload_size"], 7)
+            self.failUnlessEqual(n0.new_value["received_at"], 1000)
+            self.failIfIn("payload_json", n0.new_value)
+            db.update("UPDATE inbound_messages SET payload_size=?"
+                      " WHERE id=?", (8, imid), "inbound_messages", imid)
+            db.commit()
+            return flushEventualQueue()
+        d.addCallback(_then)
+        def _then2(_):
+            self.failUnlessEqual(len(n), 1)
+            self.failUnlessEqual(n[0].action, "update")
+            self.failUnlessEqual(n[0].new_value["payload_size"], 8)
+        d.addCallback(_then2)
+        return d
     
             
         
+
+    def test_lazy_notices(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        # unobserved tables cost nothing extra
+        mid = db.insert("INSERT INTO mailboxes (sender_descriptor_json)"
+                        " VALUES (?)", ("desc",), "mailboxes")
+        db.update("UPDATE mailboxes SET sender_descriptor_json=?"
+                  " WHERE id=?", ("desc2", mid), "mailboxes", mid)
+        self.failUnlessEqual(db.pending_notifications, [])
+
+        n = []
+        db.subscribe("inbound_messages", n.append)
+        ids = [db.insert("INSERT INTO inbound_messages"
+                         " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                         (1, seqnum, 10), "inbound_messages")
+               for seqnum in range(3)]
+        # columns with no default that weren't written are NULL, so none of
+        # the inserted rows need to be read back
+        pid = db.insert("INSERT INTO inbound_messages (cid) VALUES (?)",
+                        (2,), "inbound_messages")
+        self.failIf([p for p in db.pending_notifications if p[4]])
+        # but the updates are, at commit
+        for id in ids:
+            db.update("UPDATE inbound_messages SET seqnum=seqnum+10"
+                      " WHERE id=?", (id,), "inbound_messages", id)
+        self.failUnlessEqual(len([p for p in db.pending_notifications
+                                  if p[4]]), 3)
+        db.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual([(x.action, x.id) for x in n],
+                                 [("insert", id) for id in ids+[pid]]
+                                 + [("update", id) for id in ids])
+            self.failUnlessEqual([x.new_value["seqnum"] for x in n],
+                                 [0, 1, 2, None, 10, 11, 12])
+            self.failUnlessEqual(n[0].new_value["id"], ids[0])
+            self.failUnlessEqual(n[3].new_value["cid"], 2)
+        d.addCallback(_then)
+        return d
+
+    def test_group_commit(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        n = []
+        db.subscribe("inbound_messages", n.append)
+        before = db.get_commit_stats()["commits"]
+        ds = []
+        for seqnum in range(10):
+            db.insert("INSERT INTO inbound_messages"
+                      " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                      (1, seqnum, 10), "inbound_messages")
+            ds.append(db.request_commit())
+        fired = []
+        for d in ds:
+            d.addCallback(fired.append)
+        self.failUnlessEqual(fired, [])
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(fired), 10)
+            self.failUnlessEqual(len(n), 10)
+            stats = db.get_commit_stats()
+            self.failUnlessEqual(stats["commits"], before+1)
+            self.failUnlessEqual(stats["requests"], 10)
+            # an explicit commit() satisfies any outstanding requests
+            d1 = db.request_commit()
+            db.commit()
+            self.failUnless(d1.called)
+            return flushEventualQueue()
+        d.addCallback(_then)
+        d.addCallback(lambda _:
+                      self.failUnlessEqual(db.get_commit_stats()["commits"],
+                                           before+2))
+        return d
+
+    def test_profiles(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = get_db(dbfile)
+        db.execute("INSERT INTO node (webhost, webport, db_profile)"
+                   " VALUES (?,?,?)", ("localhost", "tcp:0", "wal"))
+        db.commit()
+        db.close()
+        # profiles are applied at the next open
+        db = get_db(dbfile)
+        mode = db.execute("PRAGMA journal_mode").fetchone()[0]
+        self.failUnlessEqual(mode, "wal")
+        self.failUnlessEqual(db.execute("PRAGMA synchronous").fetchone()[0],
+                             1) # NORMAL
+        db.execute("UPDATE node SET db_profile=?", ("safe",))
+        db.commit()
+        db.close()
+        db = get_db(dbfile)
+        mode = db.execute("PRAGMA journal_mode").fetchone()[0]
+        self.failUnlessEqual(mode, "delete")
+        self.failUnlessEqual(db.execute("PRAGMA synchronous").fetchone()[0],
+                             2) # FULL
+        db.execute("UPDATE node SET db_profile=?", ("bogus",))
+        db.commit()
+        db.close()
+        self.failUnlessRaises(DBError, get_db, dbfile)
+
+    def test_async(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = get_db(dbfile)
+        db.execute("INSERT INTO node (webhost, webport, db_profile)"
+                   " VALUES (?,?,?)", ("localhost", "tcp:0", "wal"))
+        db.commit()
+        db.close()
+        db = make_observable_db(dbfile)
+        adb = AsyncDatabase(db, dbfile, readers=1)
+        adb.startService()
+        self.addCleanup(adb.stopService)
+        n = []
+        db.subscribe("inbound_messages", n.append)
+
+        ds = [adb.insert("INSERT INTO inbound_messages"
+                         " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                         (1, seqnum, 10), "inbound_messages")
+              for seqnum in range(3)]
+        d = defer.gatherResults(ds)
+        def _inserted(ids):
+            self.failUnlessEqual(len(set(ids)), 3)
+            # the writer sees its own uncommitted changes, the readers don't
+            d1 = adb.execute("SELECT * FROM inbound_messages")
+            d1.addCallback(lambda rows: self.failUnlessEqual(len(rows), 3))
+            d2 = adb.query("SELECT * FROM inbound_messages")
+            d2.addCallback(lambda rows: self.failUnlessEqual(len(rows), 0))
+            return defer.gatherResults([d1, d2])
+        d.addCallback(_inserted)
+        d.addCallback(lambda _: adb.request_commit())
+        d.addCallback(lambda _: flushEventualQueue())
+        def _committed(_):
+            self.failUnlessEqual([x.new_value["seqnum"] for x in n],
+                                 [0, 1, 2])
+            return adb.query("SELECT * FROM inbound_messages WHERE seqnum>?",
+                             (0,))
+        d.addCallback(_committed)
+        d.addCallback(lambda rows: self.failUnlessEqual(len(rows), 2))
+        # run() gets the database to itself
+        def _bump(db):
+            row = db.execute("SELECT MAX(seqnum) FROM inbound_messages")
+            return db.insert("INSERT INTO inbound_messages"
+                             " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                             (1, row.fetchone()[0]+1, 10))
+        d.addCallback(lambda _: defer.gatherResults([adb.run(_bump),
+                                                     adb.run(_bump)]))
+        d.addCallback(lambda _: adb.execute("SELECT seqnum FROM"
+                                            " inbound_messages"))
+        d.addCallback(lambda rows:
+                      self.failUnlessEqual(sorted([r[0] for r in rows]),
+                                           [0, 1, 2, 3, 4]))
+        d.addCallback(lambda _: adb.commit())
+        return d
+
+    def test_v1_unchanged(self):
+        # existing databases were created from v1.sql, so changing it would
+        # leave them without whatever was added
+        self.failUnlessEqual(get_schema(1), open(V1_BASELINE).read())
+
+    def test_upgrade(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        # a node created before migrations existed
+        old = sqlite3.connect(dbfile)
+        old.executescript(open(V1_BASELINE).read())
+        old.execute("INSERT INTO version (version) VALUES (1)")
+        old.execute("INSERT INTO node (webhost, webport) VALUES (?,?)",
+                    ("localhost", "tcp:0"))
+        old.execute("INSERT INTO mailbox_server_config"
+                    " (private_descriptor_json, enable_retrieval)"
+                    " VALUES (?,?)", ("{}", 0))
+        old.execute("INSERT INTO addressbook (petname, next_CID_token)"
+                    " VALUES (?,?)", ("bob", "ab"*32))
+        old.execute("INSERT INTO addressbook (petname) VALUES (?)",
+                    ("deleted",))
+        old.execute("DELETE FROM addressbook WHERE petname=?", ("deleted",))
+        old.execute("INSERT INTO inbound_messages (cid, seqnum, payload_json)"
+                    " VALUES (?,?,?)", (1, 1, '{"hi": "there"}'))
+        old.commit()
+        old.close()
+
+        err = StringIO()
+        db = get_db(dbfile, err)
+        self.failUnlessIn("from version 1 to %d" % TARGET_VERSION,
+                          err.getvalue())
+        row = db.execute("SELECT * FROM version").fetchone()
+        self.failUnlessEqual(row["version"], TARGET_VERSION)
+        row = db.execute("SELECT * FROM inbound_messages").fetchone()
+        self.failUnlessEqual((row["cid"], row["seqnum"]), (1, 1))
+        # v6: settings added since v1
+        row = db.execute("SELECT * FROM node").fetchone()
+        self.failUnlessEqual(row["webport"], "tcp:0")
+        self.failUnlessEqual((row["mailbox_port"],
+                              row["mailbox_max_connections"],
+                              row["mailbox_timeout"], row["db_profile"]),
+                             (None, None, None, None))
+        row = db.execute("SELECT * FROM mailbox_server_config").fetchone()
+        self.failUnlessEqual((row["workers"], row["shard_port"]),
+                             (None, None))
+        self.failUnlessEqual(db.execute("SELECT COUNT(*) FROM mailbox_shards"
+                                        ).fetchone()[0], 0)
+        # v7: shards have keys
+        self.failUnlessEqual(row["shard_key"], None)
+        row = db.execute("SELECT * FROM inbound_messages").fetchone()
+        # v5: messages have a received_at, for archiving. Giving the pages
+        # freed by archiving back to the filesystem takes a rebuild, which
+        # is left to 'petmail compact-db'.
+        self.failUnless(row["received_at"])
+        self.failUnlessIn("petmail compact-db", err.getvalue())
+        self.failUnlessEqual(db.execute("PRAGMA auto_vacuum").fetchone()[0],
+                             0)
+        # v4: bodies live in a table of their own
+        self.failIfIn("payload_json", row.keys())
+        self.failUnlessEqual(row["payload_size"], 15)
+        body = db.execute("SELECT * FROM message_bodies WHERE message_id=?",
+                          (row["id"],)).fetchone()
+        self.failUnlessEqual(body["payload_json"], '{"hi": "there"}')
+        # v3: keys and tokens are BLOBs
+        row = db.execute("SELECT * FROM addressbook").fetchone()
+        self.failUnlessEqual(row["next_CID_token"], "\xab"*32)
+        self.failUnlessEqual(row["my_CID_key"], None)
+        row = db.execute("SELECT id FROM addressbook WHERE next_CID_token=?",
+                         (blob("\xab"*32),)).fetchone()
+        self.failUnlessEqual(row["id"], 1)
+        # and ids are not reused
+        new_id = db.execute("INSERT INTO addressbook (petname) VALUES (?)",
+                            ("carol",)).lastrowid
+        self.failUnlessEqual(new_id, 3)
+        db.commit()
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT id FROM addressbook"
+                          " WHERE next_CID_token=?",
+                          (blob("\xab"*32),)).fetchall()
+        self.failUnlessIn("addressbook_next_CID_token",
+                          " ".join([str(r[-1]) for r in plan]))
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT * FROM inbound_messages"
+                          " WHERE cid=? ORDER BY id", (1,)).fetchall()
+        self.failUnlessIn("inbound_messages_cid",
+                          " ".join([str(r[-1]) for r in plan]))
+        db.close()
+
+        # and nothing happens the second time
+        err = StringIO()
+        db = get_db(dbfile, err)
+        self.failUnlessEqual(err.getvalue(), "")
+        db.execute("UPDATE version SET version=?", (TARGET_VERSION+1,))
+        db.commit()
+        db.close()
+        self.failUnlessRaises(DBError, get_db, dbfile)
+
+    def test_compact(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "petmail.db")
+        old = sqlite3.connect(dbfile)
+        old.executescript(open(V1_BASELINE).read())
+        old.execute("INSERT INTO version (version) VALUES (1)")
+        old.commit()
+        old.close()
+        out, err = StringIO(), StringIO()
+        rc = runner.run(["compact-db", basedir], out, err)
+        self.failUnlessEqual(rc, 0, err.getvalue())
+        self.failUnlessIn("converted", out.getvalue())
+        db = get_db(dbfile)
+        self.failUnlessEqual(db.execute("PRAGMA auto_vacuum").fetchone()[0],
+                             2) # INCREMENTAL
+        db.close()
+        out, err = StringIO(), StringIO()
+        rc = runner.run(["compact-db", basedir], out, err)
+        self.failUnlessIn("already converted", out.getvalue())
+
+    def test_batch_notices(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        each, batches, mailboxes = [], [], []
+        db.subscribe("inbound_messages", each.append)
+        db.subscribe("inbound_messages", batches.append, batch=True)
+        db.subscribe("mailboxes", mailboxes.append, batch=True)
+        for seqnum in range(5):
+            db.insert("INSERT INTO inbound_messages"
+                      " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                      (1, seqnum, 10), "inbound_messages")
+        db.insert("INSERT INTO mailboxes (sender_descriptor_json)"
+                  " VALUES (?)", ("desc",), "mailboxes")
+        db.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(each), 5)
+            # one call per table per commit, in order
+            self.failUnlessEqual(len(batches), 1)
+            self.failUnlessEqual([n.new_value["seqnum"] for n in batches[0]],
+                                 range(5))
+            self.failUnlessEqual(len(mailboxes), 1)
+            self.failUnlessEqual(len(mailboxes[0]), 1)
+            db.unsubscribe("inbound_messages", batches.append)
+            db.insert("INSERT INTO inbound_messages"
+                      " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                      (1, 5, 10), "inbound_messages")
+            db.commit()
+            return flushEventualQueue()
+        d.addCallback(_then)
+        def _then2(_):
+            self.failUnlessEqual(len(each), 6)
+            self.failUnlessEqual(len(batches), 1)
+            self.failUnlessRaises(ValueError, db.unsubscribe,
+                                  "inbound_messages", batches.append)
+        d.addCallback(_then2)
+        return d
+
+    def test_filtered_notices(self):
+        basedir = self.make_basedir()
+        db = make_observable_db(os.path.join(basedir, "test.db"))
+        everything, cid1, cid23, deletes, byid = [], [], [], [], []
+        db.subscribe("inbound_messages", everything.append)
+        db.subscribe("inbound_messages", cid1.append, where={"cid": 1})
+        db.subscribe("inbound_messages", cid23.append, batch=True,
+                     where={"cid": [2, 3]}, actions=["insert"])
+        db.subscribe("inbound_messages", deletes.append, where={"cid": 1},
+                     actions=["delete"])
+        self.failUnlessRaises(ValueError, db.subscribe, "inbound_messages",
+                              byid.append, where={"nope": 1})
+        ids = {}
+        for cid in [1, 2, 3, 4]:
+            ids[cid] = db.insert("INSERT INTO inbound_messages"
+                                 " (cid, seqnum, payload_size)"
+                                 " VALUES (?,?,?)", (cid, 1, 10),
+                                 "inbound_messages")
+        db.subscribe("inbound_messages", byid.append, ids=[ids[4]])
+        db.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(everything), 4)
+            self.failUnlessEqual([n.id for n in cid1], [ids[1]])
+            self.failUnlessEqual(len(cid23), 1)
+            self.failUnlessEqual([n.id for n in cid23[0]], [ids[2], ids[3]])
+            self.failUnlessEqual([n.id for n in byid], [ids[4]])
+            self.failUnlessEqual(deletes, [])
+            # updates are matched by the new value, deletes by the old one
+            db.update("UPDATE inbound_messages SET cid=1 WHERE id=?",
+                      (ids[4],), "inbound_messages", ids[4])
+            db.update("UPDATE inbound_messages SET seqnum=2 WHERE id=?",
+                      (ids[2],), "inbound_messages", ids[2])
+            db.delete("DELETE FROM inbound_messages WHERE id=?",
+                      (ids[1],), "inbound_messages", ids[1])
+            db.delete("DELETE FROM inbound_messages WHERE id=?",
+                      (ids[3],), "inbound_messages", ids[3])
+            db.commit()
+            return flushEventualQueue()
+        d.addCallback(_then)
+        def _then2(_):
+            self.failUnlessEqual(len(everything), 8)
+            self.failUnlessEqual([(n.action, n.id) for n in cid1],
+                                 [("insert", ids[1]), ("update", ids[4]),
+                                  ("delete", ids[1])])
+            self.failUnlessEqual(len(cid23), 1) # inserts only
+            self.failUnlessEqual([(n.action, n.id) for n in deletes],
+                                 [("delete", ids[1])])
+            self.failUnlessEqual([n.action for n in byid],
+                                 ["insert", "update"])
+            db.unsubscribe("inbound_messages", cid1.append)
+            db.insert("INSERT INTO inbound_messages"
+                      " (cid, seqnum, payload_size) VALUES (?,?,?)",
+                      (1, 3, 10), "inbound_messages")
+            db.commit()
+            return flushEventualQueue()
+        d.addCallback(_then2)
+        d.addCallback(lambda _: self.failUnlessEqual(len(cid1), 3))
+        return d
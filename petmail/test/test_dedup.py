@@ -0,0 +1,75 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from .common import FakeClock
+from ..mailbox.dedup import DuplicateFilter, message_hash
+from ..mailbox.queue import QuotaExceededError
+
+class Dedup(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+
+    def handle(self, x):
+        self.handled.append(x)
+
+    def test_window(self):
+        clock = FakeClock(1000.0)
+        df = DuplicateFilter(window=60, max_entries=2, clock=clock)
+        a, b, c = [message_hash(x) for x in "abc"]
+        df.run(a, self.handle, "a")
+        df.run(a, self.handle, "a")
+        self.failUnlessEqual(self.handled, ["a"])
+        clock.now += 30
+        df.run(b, self.handle, "b")
+        # the window is measured from when the original was accepted
+        clock.now += 31
+        df.run(a, self.handle, "a")
+        df.run(b, self.handle, "b")
+        self.failUnlessEqual(self.handled, ["a", "b", "a"])
+        # a third hash evicts the oldest
+        df.run(c, self.handle, "c")
+        self.failUnlessEqual(len(df.seen), 2)
+        df.run(b, self.handle, "b")
+        self.failUnlessEqual(self.handled, ["a", "b", "a", "c", "b"])
+        self.failUnlessEqual(df.get_stats(), {"duplicates": 2, "unique": 5,
+                                              "tracked": 2, "in_flight": 0})
+        clock.now += 100
+        df.prune()
+        self.failUnlessEqual(len(df.seen), 0)
+
+    def test_errors(self):
+        df = DuplicateFilter(clock=FakeClock())
+        a = message_hash("a")
+        def _fail():
+            raise QuotaExceededError("full")
+        self.failUnlessRaises(QuotaExceededError, df.run, a, _fail)
+        # it wasn't accepted, so a retry gets through
+        df.run(a, self.handle, "a")
+        self.failUnlessEqual(self.handled, ["a"])
+
+    def test_in_flight(self):
+        df = DuplicateFilter(clock=FakeClock())
+        a = message_hash("a")
+        pending = []
+        def handle_later(x):
+            self.handled.append(x)
+            pending.append(defer.Deferred())
+            return pending[-1]
+        d = df.run(a, handle_later, "a")
+        # duplicates wait for the original
+        dup1 = df.run(a, handle_later, "a")
+        dup2 = df.run(a, handle_later, "a")
+        self.failUnlessEqual(self.handled, ["a"])
+        self.failUnlessEqual(df.get_stats()["in_flight"], 1)
+        # a failure isn't shared: the first duplicate is handled again, and
+        # the second now waits for that
+        pending[0].errback(QuotaExceededError("full"))
+        self.failureResultOf(d, QuotaExceededError)
+        self.failIf(dup1.called)
+        self.failUnlessEqual(self.handled, ["a", "a"])
+        self.failUnlessEqual(df.get_stats()["tracked"], 0)
+        pending[1].callback("ok")
+        self.failUnlessEqual(self.successResultOf(dup1), "ok")
+        self.failUnlessEqual(self.successResultOf(dup2), "ok")
+        self.failUnlessEqual(df.get_stats()["tracked"], 1)
+        self.failUnlessEqual(df.run(a, handle_later, "a"), None)
+        self.failUnlessEqual(self.handled, ["a", "a"])
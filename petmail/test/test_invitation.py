@@ -4,6 +4,7 @@ from .common import BasedirMixin, NodeRunnerMixin, TwoNodeMixin, fake_transport
 from ..eventual import flushEventualQueue
 from ..errors import CommandError
 from ..invitation import splitMessages
+from ..database import blob
 
 MROW = collections.namedtuple("Row", ["my", "theirs", "next"])
 AddressbookRow = collections.namedtuple("AddressbookEntry",
@@ -17,7 +18,7 @@ class Invite(BasedirMixin, NodeRunnerMixin, unittest.TestCase):
         c = node.db.execute("SELECT"
                             " myMessages, theirMessages, nextExpectedMessage"
                             " FROM invitations WHERE code=?",
-                            (code.encode("hex"),))
+                            (blob(code),))
         rows = [ MROW(splitMessages(row[0]), splitMessages(row[1]), row[2])
                  for row in c.fetchall() ]
         if not exists:
@@ -33,8 +34,9 @@ class Invite(BasedirMixin, NodeRunnerMixin, unittest.TestCase):
         c = node.db.execute("SELECT petname, their_verfkey, acked,"
                             "       my_CID_key, their_channel_record_json"
                             " FROM addressbook")
-        rows = [ AddressbookRow(row[0], str(row[1]), bool(row[2]),
-                                str(row[3]), json.loads(row[4]))
+        # keys are BLOBs, the channel record (JSON) has them in hex
+        rows = [ AddressbookRow(row[0], row[1].encode("hex"), bool(row[2]),
+                                row[3].encode("hex"), json.loads(row[4]))
                  for row in c.fetchall() ]
         return rows
 
@@ -1,7 +1,7 @@
 import unittest
 
 from ..netstring import (netstring, split_netstrings,
-                         split_netstrings_and_trailer)
+                         split_netstrings_and_trailer, split_netstring_prefix)
 
 class Netstring(unittest.TestCase):
     def test_create(self):
@@ -22,3 +22,10 @@ class Netstring(unittest.TestCase):
     def test_no_leftover(self):
         self.failUnlessRaises(ValueError,
                               split_netstrings, "3:abc,extra")
+    def test_prefix(self):
+        self.failUnlessEqual(split_netstring_prefix("3:abc,stuff"),
+                             ("abc", "stuff"))
+        self.failUnlessEqual(split_netstring_prefix("0:,"), ("", ""))
+        self.failUnlessRaises(ValueError, split_netstring_prefix, "3:abcd")
+        self.failUnlessRaises(ValueError, split_netstring_prefix, "x:abc,")
+        self.failUnlessRaises(ValueError, split_netstring_prefix, "abc")
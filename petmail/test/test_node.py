@@ -80,6 +80,17 @@ class CLI(CLIinThreadMixin, BasedirMixin, NodeRunnerMixin, unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_create_bad_db_profile(self):
+        basedir = os.path.join(self.make_basedir(), "node1")
+        d = self.cli("create-node", "--db-profile", "bogus", basedir)
+        def _check((out, err, rc)):
+            self.failUnlessEqual(rc, 1)
+            self.failUnlessIn("unknown --db-profile 'bogus', try one of:"
+                              " safe, wal", err)
+            self.failIf(os.path.exists(basedir))
+        d.addCallback(_check)
+        return d
+
     def test_sample(self):
         basedir = os.path.join(self.make_basedir(), "node1")
         self.createNode(basedir)
@@ -124,3 +135,14 @@ class CLI(CLIinThreadMixin, BasedirMixin, NodeRunnerMixin, unittest.TestCase):
 
         return d
 
+    def test_spool_status(self):
+        basedir = os.path.join(self.make_basedir(), "node1")
+        self.createNode(basedir)
+        self.startNode(basedir)
+        d = self.cliMustSucceed("open", "-n", "-d", basedir)
+        d.addCallback(lambda _: self.cliMustSucceed("spool-status",
+                                                    "-d", basedir))
+        d.addCallback(self.failUnlessEqual,
+                      "inbound: 0, slow lane: 0, retry: 0\n")
+        return d
+
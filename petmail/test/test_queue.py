@@ -0,0 +1,169 @@
+import os
+from twisted.trial import unittest
+from .common import BasedirMixin, FakeClock
+from ..mailbox.queue import QueueStore, INDEX_RECORD, QuotaExceededError
+from ..netstring import netstring
+
+class Queue(BasedirMixin, unittest.TestCase):
+    def make_store(self):
+        self.clock = FakeClock(1000000)
+        queuedir = os.path.join(self.make_basedir(), "queues")
+        return QueueStore(queuedir, self.clock)
+
+    def test_enqueue(self):
+        store = self.make_store()
+        self.failUnlessEqual(store.list_transports(), [])
+        self.failUnlessEqual(store.get_transport("\x01"*32), None)
+        q = store.add_transport("\x01"*32, retention=100,
+                                segment_seconds=10)
+        self.failUnlessEqual(store.list_transports(), ["\x01"*32])
+        self.failUnlessRaises(KeyError, store.add_transport, "\x01"*32)
+
+        start, offset = q.enqueue("msg1")
+        self.failUnlessEqual((start, offset), (1000000, 0))
+        start, offset = q.enqueue("msg2")
+        self.failUnlessEqual((start, offset), (1000000, len(netstring("msg1"))))
+        self.clock.now += 15
+        q.enqueue("msg3")
+        self.failUnlessEqual(q.list_segments(), [1000000, 1000010])
+
+        index = q.read_index(1000000)
+        self.failUnlessEqual(len(index), 2)
+        offset, length, when = index[1]
+        self.failUnlessEqual(q.read_record(1000000, offset, length),
+                             netstring("msg2"))
+        self.failUnlessEqual(when, 1000000)
+
+        # a fresh store (e.g. in another process) finds it on disk
+        store2 = QueueStore(store.basedir, self.clock)
+        q2 = store2.get_transport("\x01"*32)
+        self.failUnlessEqual(q2.retention, 100)
+        self.failUnlessEqual(q2.list_segments(), [1000000, 1000010])
+
+    def test_expire(self):
+        store = self.make_store()
+        q = store.add_transport("\x02"*32, retention=100, segment_seconds=10)
+        q.enqueue("old")
+        self.clock.now += 50
+        q.enqueue("newer")
+        size = q.segment_size(1000000)
+        self.failUnlessEqual(size, len(netstring("old")) + INDEX_RECORD.size)
+
+        self.clock.now = 1000000 + 10 + 99
+        self.failUnlessEqual(store.expire(), (0, 0))
+        self.failUnlessEqual(q.list_segments(), [1000000, 1000050])
+        self.failUnlessEqual(store.stats["bytes_reclaimed"], 0)
+        # the queue knows when to look again
+        self.failUnlessEqual(q.next_expiry, 1000000 + 10 + 100)
+
+        self.clock.now += 1
+        self.failUnlessEqual(store.expire(), (1, size))
+        self.failUnlessEqual(q.list_segments(), [1000050])
+        self.failUnlessEqual(store.stats["sweeps"], 2)
+        self.failUnlessEqual(store.stats["segments_reclaimed"], 1)
+        self.failUnlessEqual(store.stats["bytes_reclaimed"], size)
+        self.failUnlessEqual(store.stats["last_sweep"], self.clock.now)
+        self.failUnlessEqual(q.read_index(1000000), [])
+        self.failUnlessEqual(q.next_expiry, 1000050 + 10 + 100)
+
+        # other processes (e.g. 'petmail list-transports') see the totals
+        store2 = QueueStore(store.basedir, self.clock)
+        self.failUnlessEqual(store2.get_sweep_stats(), store.stats)
+
+    def test_consume(self):
+        store = self.make_store()
+        q = store.add_transport("\x03"*32, segment_seconds=10,
+                                retrieval_id="rid")
+        self.failUnlessIdentical(store.get_transport_by_retrieval_id("rid"), q)
+        self.failUnlessEqual(store.get_transport_by_retrieval_id("nope"), None)
+        self.failUnlessEqual(q.next_record(), None)
+        q.enqueue("one")
+        self.clock.now += 10
+        q.enqueue("two")
+        q.enqueue("three")
+
+        got = []
+        while True:
+            r = q.next_record()
+            if not r:
+                break
+            start, position, offset, length = r
+            got.append(q.read_record(start, offset, length))
+            q.consume(start, position)
+            if len(got) == 1:
+                # the first segment is closed and fully retrieved
+                self.failUnlessEqual(q.list_segments(), [1000010])
+        self.failUnlessEqual(got, [netstring("one"), netstring("two"),
+                                   netstring("three")])
+        # the current segment is kept, since it may still grow
+        self.failUnlessEqual(q.list_segments(), [1000010])
+        q.enqueue("four")
+        start, position, offset, length = q.next_record()
+        self.failUnlessEqual(position, 2)
+
+    def test_pending(self):
+        store = self.make_store()
+        q = store.add_transport("\x04"*32, segment_seconds=10)
+        self.failUnlessEqual(q.pending(1000), None)
+        q.enqueue("one")
+        q.enqueue("two")
+        self.clock.now += 10
+        q.enqueue("three")
+
+        n1, n2, n3 = netstring("one"), netstring("two"), netstring("three")
+        ranges, last = q.pending(1000)
+        # adjacent records in a segment are coalesced
+        self.failUnlessEqual(ranges, [(1000000, 0, len(n1)+len(n2)),
+                                      (1000010, 0, len(n3))])
+        self.failUnlessEqual(last, (1000010, 0))
+        # pending() doesn't consume anything
+        self.failUnlessEqual(q.pending(1000), (ranges, last))
+
+        # a small limit still gets one message
+        ranges, last = q.pending(1)
+        self.failUnlessEqual(ranges, [(1000000, 0, len(n1))])
+        self.failUnlessEqual(last, (1000000, 0))
+        q.consume(*last)
+        # consuming the same message twice is harmless
+        q.consume(*last)
+        ranges, last = q.pending(len(n2)+len(n3))
+        self.failUnlessEqual(ranges, [(1000000, len(n1), len(n2)),
+                                      (1000010, 0, len(n3))])
+        f = q.open_segment(1000010)
+        self.failUnlessEqual(f.read(), n3)
+        f.close()
+        q.consume(*last)
+        self.failUnlessEqual(q.pending(1000), None)
+
+    def test_counters(self):
+        store = self.make_store()
+        q = store.add_transport("\x05"*32, retention=100, segment_seconds=10,
+                                quota_messages=3, quota_bytes=30)
+        self.failUnlessEqual(q.get_counters(), (0, 0, 0))
+        q.enqueue("one") # 5:one, is 6 bytes
+        self.clock.now += 10
+        q.enqueue("two")
+        self.failUnlessEqual(q.get_counters(), (2, 12, 1000000))
+        # too big
+        self.failUnlessRaises(QuotaExceededError, q.enqueue, "x"*15)
+        self.failUnlessEqual(q.get_counters(), (2, 12, 1000000))
+        q.enqueue("x"*14)
+        self.failUnlessEqual(q.get_counters(), (3, 30, 1000000))
+        # too many
+        self.failUnlessRaises(QuotaExceededError, q.check_quota, 0)
+        self.failUnlessRaises(QuotaExceededError, q.enqueue, "")
+
+        ranges, last = q.pending(1)
+        with q.locked():
+            q.consume(*last)
+        self.failUnlessEqual(q.get_counters(), (2, 24, 1000010))
+        q.enqueue("six")
+        self.failUnlessEqual(q.get_counters(), (3, 30, 1000010))
+
+        # the counters can be rebuilt from the queue itself
+        os.unlink(os.path.join(q.dirname, "counters"))
+        self.failUnlessEqual(q.get_counters(), (3, 30, 1000010))
+
+        self.clock.now = 1000000 + 10 + 10 + 100
+        store.expire()
+        self.failUnlessEqual(q.get_counters(), (0, 0, 0))
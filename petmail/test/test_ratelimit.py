@@ -0,0 +1,47 @@
+from twisted.trial import unittest
+from .common import FakeClock
+from ..mailbox.ratelimit import (TokenBucket, KeyedRateLimiter, InletLimits,
+                                 size_class)
+
+class RateLimit(unittest.TestCase):
+    def test_bucket(self):
+        b = TokenBucket(rate=1, burst=2, now=0)
+        self.failUnless(b.consume(0))
+        self.failUnless(b.consume(0))
+        self.failIf(b.consume(0))
+        self.failIf(b.consume(0.5))
+        self.failUnless(b.consume(1.5))
+        self.failUnless(b.is_full(100))
+
+    def test_keyed(self):
+        clock = FakeClock(1000.0)
+        rl = KeyedRateLimiter(rate=1, burst=1, max_keys=2, clock=clock)
+        self.failUnless(rl.allow("a"))
+        self.failIf(rl.allow("a"))
+        self.failUnless(rl.allow("b"))
+        self.failUnlessEqual(rl.rejected, 1)
+        # a third key evicts the least-recently-used bucket ("a")
+        self.failUnless(rl.allow("c"))
+        self.failUnlessEqual(sorted(rl.buckets.keys()), ["b", "c"])
+        clock.now += 10
+        rl.prune()
+        self.failUnlessEqual(len(rl.buckets), 0)
+
+    def test_processes(self):
+        # each of three processes enforces a third of the limits
+        clock = FakeClock(1000.0)
+        limits = InletLimits(source_rate=3, source_burst=6, clock=clock,
+                             processes=3)
+        self.failUnless(limits.allow_source("a"))
+        self.failUnless(limits.allow_source("a"))
+        self.failIf(limits.allow_source("a"))
+        clock.now += 1
+        self.failUnless(limits.allow_source("a"))
+        self.failIf(limits.allow_source("a"))
+
+    def test_size_class(self):
+        self.failUnlessEqual(size_class(0), 0)
+        self.failUnlessEqual(size_class(1), 0)
+        self.failUnlessEqual(size_class(100), 6)
+        self.failUnlessEqual(size_class(127), 6)
+        self.failUnlessEqual(size_class(128), 7)
@@ -0,0 +1,232 @@
+import os, json
+from StringIO import StringIO
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web import client, error
+from .common import BasedirMixin, NodeRunnerMixin
+from .. import rrid
+from ..scripts import runner
+from ..scripts.create_node import create_relay
+from ..scripts.relay import add_transport, list_transports
+from ..mailbox.delivery import createMsgA
+from ..mailbox.server import RETRIEVE_BATCH_BYTES
+from ..mailbox.retrieval import HTTPRetriever
+
+class Relay(BasedirMixin, NodeRunnerMixin, unittest.TestCase):
+    def createRelay(self, basedir, *args):
+        so = runner.CreateRelayOptions()
+        so.parseOptions(["--webport", "tcp:0:interface=127.0.0.1"]
+                        + list(args) + [basedir])
+        out,err = StringIO(), StringIO()
+        rc = create_relay(so, out, err)
+        self.failUnlessEqual(rc, 0, (rc, out, err))
+        return rc, out, err
+
+    def addTransport(self, basedir, *args):
+        so = runner.AddTransportOptions()
+        so.parseOptions(["--basedir", basedir] + list(args))
+        out,err = StringIO(), StringIO()
+        rc = add_transport(so, out, err)
+        self.failUnlessEqual(rc, 0, (rc, out, err))
+        return json.loads(out.getvalue())
+
+    def send(self, desc, msgC):
+        trec = desc["sender"].copy()
+        TID_token0 = desc["retrieval"]["TID"].decode("hex")
+        trec["STID"] = rrid.randomize(TID_token0).encode("hex")
+        return client.getPage(str(trec["url"]), method="POST",
+                              postdata=createMsgA(trec, msgC))
+
+    def retrieve(self, desc):
+        # fetch one batch, and acknowledge it, as if it had been spooled
+        r = HTTPRetriever(desc["retrieval"], None)
+        d = r.fetch()
+        def _fetched((msgCs, batch)):
+            d2 = r.ack(batch) if batch else defer.succeed(None)
+            d2.addCallback(lambda _: msgCs)
+            return d2
+        d.addCallback(_fetched)
+        return d
+
+    def test_relay(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir)
+        r = self.startNode(basedir)
+        self.failUnlessEqual(r.client, None)
+        self.failIf(r.web.site.access_log)
+
+        desc1 = self.addTransport(basedir)
+        desc2 = self.addTransport(basedir)
+        self.failUnlessEqual(desc1["sender"], desc2["sender"])
+        self.failIfEqual(desc1["retrieval"]["url"],
+                         desc2["retrieval"]["url"])
+        send, retrieve = self.send, self.retrieve
+
+        d = send(desc1, "msgC-1a")
+        d.addCallback(lambda _: send(desc2, "msgC-2a"))
+        d.addCallback(lambda _: send(desc1, "msgC-1b"))
+        # retrieval needs the transport's retrieval key
+        d.addCallback(lambda _: client.getPage(
+            str(desc1["retrieval"]["url"]), method="POST"))
+        def _ok(_):
+            self.fail("unauthenticated retrieval should have failed")
+        def _err(f):
+            f.trap(error.Error)
+            self.failUnlessEqual(f.value.status, "403")
+        d.addCallbacks(_ok, _err)
+        d.addCallback(lambda _: retrieve(desc1))
+        d.addCallback(self.failUnlessEqual, ["msgC-1a", "msgC-1b"])
+        d.addCallback(lambda _: retrieve(desc1))
+        d.addCallback(self.failUnlessEqual, [])
+        d.addCallback(lambda _: retrieve(desc2))
+        d.addCallback(self.failUnlessEqual, ["msgC-2a"])
+        return d
+
+    @defer.inlineCallbacks
+    def test_ack(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir)
+        self.startNode(basedir)
+        desc = self.addTransport(basedir)
+        yield self.send(desc, "msgC-1")
+        r = HTTPRetriever(desc["retrieval"], None)
+        # until the batch is acknowledged, it is sent again
+        msgCs, batch = yield r.fetch()
+        self.failUnlessEqual(msgCs, ["msgC-1"])
+        msgCs, batch2 = yield r.fetch()
+        self.failUnlessEqual((msgCs, batch2), (["msgC-1"], batch))
+        # acks are checked, and need the retrieval key too
+        start, position, mac = batch.split("-")
+        forged = "%s-%d-%s" % (start, int(position)+1, mac)
+        yield self.failUnlessFailure(r.ack(forged), error.Error)
+        yield self.failUnlessFailure(client.getPage(
+            str(desc["retrieval"]["url"]) + "/ack/" + batch, method="POST"),
+                                     error.Error)
+        msgCs, batch = yield r.fetch()
+        self.failUnlessEqual(msgCs, ["msgC-1"])
+        yield r.ack(batch)
+        yield r.ack(batch) # repeats are harmless
+        msgCs, batch = yield r.fetch()
+        self.failUnlessEqual((msgCs, batch), ([], None))
+
+    def test_workers(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir, "--workers", "2")
+        r = self.startNode(basedir)
+        desc = self.addTransport(basedir)
+        msgs = ["msgC-%d" % i for i in range(10)]
+
+        d = r.worker_pool.when_ready()
+        def _ready(_):
+            self.failUnlessEqual(len(r.worker_pool.workers), 2)
+            # some of these will be accepted by the workers, some by us
+            d1 = defer.succeed(None)
+            for msgC in msgs:
+                d1.addCallback(lambda _, msgC=msgC: self.send(desc, msgC))
+            return d1
+        d.addCallback(_ready)
+        d.addCallback(lambda _: self.retrieve(desc))
+        d.addCallback(self.failUnlessEqual, msgs)
+        return d
+
+    def test_backlog(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir)
+        self.startNode(basedir)
+        desc = self.addTransport(basedir)
+        # big enough that the backlog is retrieved in several batches
+        msgs = ["%d" % i + "." * (RETRIEVE_BATCH_BYTES // 3)
+                for i in range(5)]
+
+        d = defer.succeed(None)
+        for msgC in msgs:
+            d.addCallback(lambda _, msgC=msgC: self.send(desc, msgC))
+        def _retrieve_all(_, got):
+            d1 = self.retrieve(desc)
+            def _got(msgCs):
+                if not msgCs:
+                    return got
+                self.failIf(len(msgCs) > 3, len(msgCs))
+                got.extend(msgCs)
+                return _retrieve_all(None, got)
+            d1.addCallback(_got)
+            return d1
+        d.addCallback(_retrieve_all, [])
+        d.addCallback(self.failUnlessEqual, msgs)
+        return d
+
+    def test_mailbox_port(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir,
+                         "--mailbox-port", "tcp:0:interface=127.0.0.1",
+                         "--mailbox-max-connections", "5",
+                         "--mailbox-timeout", "30")
+        r = self.startNode(basedir)
+        mw = r.mailbox_web
+        self.failIfIdentical(mw, r.web)
+        self.failUnlessEqual(mw.factory.max_connections, 5)
+        self.failUnlessEqual(mw.site.timeOut, 30)
+        desc = self.addTransport(basedir)
+        webport = r.web.get_baseurl()
+        mailbox_port = mw.get_baseurl()
+        self.failIfEqual(webport, mailbox_port)
+        self.failUnless(desc["sender"]["url"].startswith(mailbox_port))
+        self.failUnless(desc["retrieval"]["url"].startswith(mailbox_port))
+
+        d = self.send(desc, "msgC")
+        d.addCallback(lambda _: self.retrieve(desc))
+        d.addCallback(self.failUnlessEqual, ["msgC"])
+        # the webport no longer serves the mailbox
+        d.addCallback(lambda _: client.getPage(webport+"mailbox",
+                                               method="POST", postdata=""))
+        def _ok(_):
+            self.fail("the webport should not accept deliveries")
+        def _err(f):
+            f.trap(error.Error)
+            self.failUnlessEqual(f.value.status, "404")
+        d.addCallbacks(_ok, _err)
+        return d
+
+    def listTransports(self, basedir):
+        so = runner.ListTransportsOptions()
+        so.parseOptions(["--basedir", basedir, "--json"])
+        out,err = StringIO(), StringIO()
+        rc = list_transports(so, out, err)
+        self.failUnlessEqual(rc, 0, (rc, out, err))
+        return json.loads(out.getvalue())
+
+    def test_quota(self):
+        basedir = os.path.join(self.make_basedir(), "relay")
+        self.createRelay(basedir)
+        self.startNode(basedir)
+        small = self.addTransport(basedir, "--quota-messages", "2")
+        big = self.addTransport(basedir)
+
+        d = self.send(small, "msgC-1")
+        d.addCallback(lambda _: self.send(small, "msgC-2"))
+        d.addCallback(lambda _: self.send(small, "msgC-3"))
+        def _ok(_):
+            self.fail("delivery should have been refused")
+        def _err(f):
+            f.trap(error.Error)
+            self.failUnlessEqual(f.value.status, "507")
+        d.addCallbacks(_ok, _err)
+        d.addCallback(lambda _: self.send(big, "x"*1000))
+        def _check(_):
+            t1, t2 = self.listTransports(basedir)
+            # the largest queue comes first
+            self.failUnlessEqual(t1["messages"], 1)
+            self.failUnlessEqual(t1["bytes"], len("1000:,")+1000)
+            self.failUnlessEqual(t1["quota_messages"], None)
+            self.failUnlessEqual(t2["messages"], 2)
+            self.failUnlessEqual(t2["quota_messages"], 2)
+            self.failUnless(t2["oldest"])
+        d.addCallback(_check)
+        # retrieval makes room again
+        d.addCallback(lambda _: self.retrieve(small))
+        d.addCallback(self.failUnlessEqual, ["msgC-1", "msgC-2"])
+        d.addCallback(lambda _: self.send(small, "msgC-3"))
+        d.addCallback(lambda _: self.listTransports(basedir))
+        d.addCallback(lambda ts: self.failUnlessEqual(
+            [t["messages"] for t in ts], [1, 1]))
+        return d
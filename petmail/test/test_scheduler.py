@@ -0,0 +1,83 @@
+from twisted.trial import unittest
+from .common import FakeClock
+from ..eventual import flushEventualQueue
+from ..mailbox.scheduler import DeficitRoundRobin
+
+class Scheduler(unittest.TestCase):
+    def make(self, **kwargs):
+        self.clock = FakeClock()
+        self.ran = []
+        return DeficitRoundRobin(clock=self.clock, **kwargs)
+
+    def run_job(self, key, n):
+        self.ran.append((key, n))
+        self.clock.now += 1
+        return n
+
+    def test_fair(self):
+        drr = self.make(quantum=10, turn_budget=1000)
+        # "big" floods the scheduler before "small" shows up
+        for i in range(10):
+            drr.submit("big", 10, "write", self.run_job, "big", i)
+        ds = [drr.submit("small", 10, "write", self.run_job, "small", i)
+              for i in range(2)]
+        self.failUnlessEqual(drr.pending("big"), 10)
+        d = flushEventualQueue()
+        def _check(_):
+            self.failUnlessEqual(self.ran[:4], [("big", 0), ("small", 0),
+                                                ("big", 1), ("small", 1)])
+            self.failUnlessEqual(len(self.ran), 12)
+            self.failUnlessEqual(drr.pending("big"), 0)
+            results = []
+            for d in ds:
+                d.addCallback(results.append)
+            self.failUnlessEqual(results, [0, 1])
+            stats = drr.get_stats()
+            self.failUnlessEqual(stats["small"]["write"]["count"], 2)
+            self.failUnlessEqual(stats["big"]["write"]["bytes"], 100)
+            # big's last job waited for all eleven before it
+            self.failUnlessEqual(stats["big"]["write"]["max"], 11)
+            self.failUnless(stats["small"]["write"]["p99"] <= 3)
+        d.addCallback(_check)
+        return d
+
+    def test_weight(self):
+        drr = self.make(quantum=10, turn_budget=1000)
+        for i in range(6):
+            drr.submit("a", 10, "retrieve", self.run_job, "a", i, weight=2)
+            drr.submit("b", 10, "retrieve", self.run_job, "b", i)
+        d = flushEventualQueue()
+        def _check(_):
+            first = [key for (key, n) in self.ran[:6]]
+            self.failUnlessEqual(first, ["a", "a", "b", "a", "a", "b"])
+        d.addCallback(_check)
+        return d
+
+    def test_bad_weight(self):
+        drr = self.make()
+        for weight in [0, -1]:
+            self.failUnlessRaises(ValueError, drr.submit, "a", 10, "write",
+                                  self.run_job, "a", 0, weight=weight)
+        self.failUnlessEqual(drr.pending("a"), 0)
+
+    def test_turn_budget(self):
+        drr = self.make(quantum=100, turn_budget=50)
+        for i in range(4):
+            drr.submit("a", 50, "write", self.run_job, "a", i)
+        # nothing runs synchronously
+        self.failUnlessEqual(self.ran, [])
+        d = flushEventualQueue()
+        d.addCallback(lambda _: self.failUnlessEqual(len(self.ran), 4))
+        return d
+
+    def test_errors(self):
+        drr = self.make()
+        def _fail():
+            raise ValueError("oops")
+        d1 = drr.submit("a", 1, "write", _fail)
+        d2 = drr.submit("a", 1, "write", self.run_job, "a", 0)
+        d = flushEventualQueue()
+        d.addCallback(lambda _: self.failUnlessFailure(d1, ValueError))
+        d.addCallback(lambda _: d2)
+        d.addCallback(self.failUnlessEqual, 0)
+        return d
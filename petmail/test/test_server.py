@@ -1,9 +1,11 @@
 import json, copy
 from twisted.trial import unittest
+from twisted.web import client, error
 from .common import TwoNodeMixin
 from .. import rrid
 from ..eventual import flushEventualQueue
 from ..mailbox.delivery import createMsgA
+from ..mailbox.server import MAX_MSGA_SIZE
 
 class Transports(TwoNodeMixin, unittest.TestCase):
     def test_unknown_TID(self):
@@ -25,4 +27,87 @@ class Transports(TwoNodeMixin, unittest.TestCase):
             self.failUnlessEqual(len(unknowns), 1)
         d.addCallback(_then)
         return d
-    
+
+    def test_queued_TID(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        server = nB.client.mailbox_server
+        TID_tokenid, TID_privkey, TID_token0 = rrid.create()
+        q = server.queues.add_transport(TID_tokenid)
+        trec = json.loads(entA["their_channel_record_json"])["transports"][0]
+        trec = copy.deepcopy(trec)
+        trec["STID"] = rrid.randomize(TID_token0).encode("hex")
+        server.handle_msgA(createMsgA(trec, "msgC"))
+        d = flushEventualQueue()
+        def _then(res):
+            [start] = q.list_segments()
+            [(offset, length, when)] = q.read_index(start)
+            self.failUnlessEqual(q.read_record(start, offset, length),
+                                 "4:msgC,")
+        d.addCallback(_then)
+        return d
+
+    def test_duplicates(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        server = nB.client.mailbox_server
+        TID_tokenid, TID_privkey, TID_token0 = rrid.create()
+        q = server.queues.add_transport(TID_tokenid)
+        trec = json.loads(entA["their_channel_record_json"])["transports"][0]
+        trec = copy.deepcopy(trec)
+        trec["STID"] = rrid.randomize(TID_token0).encode("hex")
+        msgA = createMsgA(trec, "msgC")
+        server.handle_msgA(msgA)
+        # a retry of the same msgA, and a re-encryption of the same msgC
+        server.handle_msgA(msgA)
+        server.handle_msgA(createMsgA(trec, "msgC"))
+        server.handle_msgA(createMsgA(trec, "other"))
+        d = flushEventualQueue()
+        def _then(res):
+            self.failUnlessEqual(q.get_counters()[0], 2)
+            stats = server.duplicates.get_stats()
+            self.failUnlessEqual(stats["duplicates"], 2)
+        d.addCallback(_then)
+        return d
+
+    def post_expecting_error(self, url, body, status):
+        d = client.getPage(url, method="POST", postdata=body)
+        def _ok(_):
+            self.fail("POST should have failed")
+        def _err(f):
+            f.trap(error.Error)
+            self.failUnlessEqual(f.value.status, status)
+        d.addCallbacks(_ok, _err)
+        return d
+
+    def test_inlet_checks(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        trec = json.loads(entA["their_channel_record_json"])["transports"][0]
+        url = str(trec["url"])
+        d = self.post_expecting_error(url, "b0:"+"x"*100, "400")
+        d.addCallback(lambda _:
+                      self.post_expecting_error(url, "a0:short", "400"))
+        big = "a0:" + "x"*(MAX_MSGA_SIZE+1)
+        d.addCallback(lambda _: self.post_expecting_error(url, big, "413"))
+        return d
+
+    def test_oversized_body(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        trec = json.loads(entA["their_channel_record_json"])["transports"][0]
+        url = str(trec["url"])
+        nB.web.site.max_body_size = 1000
+        # rejected from the Content-Length header, before the body is read
+        return self.post_expecting_error(url, "a0:"+"x"*2000, "413")
+
+    def test_large_message(self):
+        # large bodies are spooled to disk and mapped, rather than read
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        P1 = {"big": "x"*200*1000}
+        payloads = []
+        def payload_received(tid, seqnum, payload_json):
+            payloads.append(payload_json)
+        nB.client.payload_received = payload_received
+        d = nA.client.send_message(entA["id"], P1)
+        def _sent(res):
+            self.failUnlessEqual(len(payloads), 1)
+            self.failUnlessEqual(json.loads(payloads[0]), P1)
+        d.addCallback(_sent)
+        return d
@@ -0,0 +1,104 @@
+import os
+from twisted.trial import unittest
+from nacl.public import PrivateKey
+from nacl.exceptions import CryptoError
+from .common import BasedirMixin
+from ..mailbox.queue import QueueStore
+from ..mailbox.session import (create_request, open_request, ReplayCache,
+                               ReplayFile, decrypt_response, BadRequestError,
+                               TruncatedError, MAX_CLOCK_SKEW)
+from ..netstring import netstring
+
+class Session(BasedirMixin, unittest.TestCase):
+    def setUp(self):
+        self.server = PrivateKey.generate()
+        self.retrieval = PrivateKey.generate()
+
+    def respond(self, sender, chunks):
+        return (sender.header + "".join([sender.frame(c) for c in chunks])
+                + sender.end())
+
+    def test_roundtrip(self):
+        body, eph = create_request(self.server.public_key, self.retrieval,
+                                   now=1000)
+        sender = open_request(self.server, self.retrieval.public_key, body,
+                              ReplayCache(), now=1010)
+        plaintext = netstring("msgC-1") + netstring("msgC-2")
+        response = self.respond(sender, [plaintext[:5], plaintext[5:]])
+        self.failIfIn("msgC", response)
+        self.failUnlessEqual(decrypt_response(self.server.public_key, eph,
+                                              response), plaintext)
+        # an empty response is still a session
+        body, eph = create_request(self.server.public_key, self.retrieval,
+                                   now=1000)
+        sender = open_request(self.server, self.retrieval.public_key, body,
+                              ReplayCache(), now=1000)
+        self.failUnlessEqual(decrypt_response(self.server.public_key, eph,
+                                              self.respond(sender, [])), "")
+
+    def test_bad_requests(self):
+        replays = ReplayCache()
+        def check(body, now=1000, retrieval_pubkey=None):
+            return open_request(self.server,
+                                retrieval_pubkey or self.retrieval.public_key,
+                                body, replays, now=now)
+        body, eph = create_request(self.server.public_key, self.retrieval,
+                                   now=1000)
+        self.failUnlessRaises(BadRequestError, check, "")
+        self.failUnlessRaises(BadRequestError, check, body[:-1])
+        # someone else's retrieval key
+        other = PrivateKey.generate()
+        self.failUnlessRaises(BadRequestError, check, body,
+                              retrieval_pubkey=other.public_key)
+        self.failUnlessRaises(BadRequestError, check, body,
+                              now=1000+MAX_CLOCK_SKEW+1)
+        check(body)
+        self.failUnlessRaises(BadRequestError, check, body)
+        # the replay cache forgets requests once they're too old anyway
+        check(create_request(self.server.public_key, self.retrieval,
+                             now=5000)[0], now=5000)
+        self.failUnlessEqual(len(replays.seen), 1)
+
+    def test_replay_file(self):
+        queuedir = os.path.join(self.make_basedir(), "queues")
+        q = QueueStore(queuedir).add_transport("\x01"*32)
+        fn = os.path.join(q.dirname, "replays")
+        # two processes serving the same transport
+        replays1 = ReplayFile(fn, q.locked)
+        replays2 = ReplayFile(fn, q.locked)
+        def check(replays, body, now=1000):
+            return open_request(self.server, self.retrieval.public_key,
+                                body, replays, now=now)
+        body, eph = create_request(self.server.public_key, self.retrieval,
+                                   now=1000)
+        check(replays1, body)
+        self.failUnlessRaises(BadRequestError, check, replays2, body)
+        self.failUnlessRaises(BadRequestError, check, replays1, body)
+        # expired requests are dropped from the file
+        check(replays2, create_request(self.server.public_key,
+                                       self.retrieval, now=5000)[0], now=5000)
+        self.failUnlessEqual(os.path.getsize(fn), 32)
+
+    def test_bad_responses(self):
+        body, eph = create_request(self.server.public_key, self.retrieval)
+        sender = open_request(self.server, self.retrieval.public_key, body,
+                              ReplayCache())
+        frames = [sender.header, sender.frame("one"), sender.frame("two"),
+                  sender.end()]
+        def decrypt(frames):
+            return decrypt_response(self.server.public_key, eph,
+                                    "".join(frames))
+        self.failUnlessEqual(decrypt(frames), "onetwo")
+        self.failUnlessRaises(TruncatedError, decrypt, frames[:-1])
+        self.failUnlessRaises(TruncatedError, decrypt, frames[:1])
+        self.failUnlessRaises(TruncatedError, decrypt,
+                              ["".join(frames)[:-1]])
+        # frames cannot be reordered or dropped
+        self.failUnlessRaises(CryptoError, decrypt,
+                              [frames[0], frames[2], frames[1], frames[3]])
+        self.failUnlessRaises(CryptoError, decrypt,
+                              [frames[0], frames[2], frames[3]])
+        # nor can anyone else read them
+        other = PrivateKey.generate()
+        self.failUnlessRaises(CryptoError, decrypt_response,
+                              self.server.public_key, other, "".join(frames))
@@ -0,0 +1,228 @@
+import os, json, socket
+from StringIO import StringIO
+from twisted.trial import unittest
+from twisted.internet import defer, error
+from twisted.web import client, error as http_error
+from .common import BasedirMixin, NodeRunnerMixin
+from .. import rrid, database
+from ..scripts import runner
+from ..scripts.create_node import create_relay
+from ..scripts.relay import add_transport, add_shard, migrate_shards
+from ..mailbox.delivery import createMsgA
+from ..mailbox.queue import QueueStore
+from ..mailbox.shard import HashRing, ShardConnection, UNKNOWN
+from ..mailbox.retrieval import HTTPRetriever
+
+class Ring(unittest.TestCase):
+    def test_lookup(self):
+        keys = [os.urandom(32) for i in range(2000)]
+        ring = HashRing(["s1", "s2", "s3"])
+        owners = dict([(k, ring.lookup(k)) for k in keys])
+        for name in ["s1", "s2", "s3"]:
+            share = owners.values().count(name) / float(len(keys))
+            self.failUnless(0.2 < share < 0.47, (name, share))
+
+        # a new shard only takes keys, it never shuffles the others
+        ring.add("s4")
+        moved = [k for k in keys if ring.lookup(k) != owners[k]]
+        for k in moved:
+            self.failUnlessEqual(ring.lookup(k), "s4")
+        self.failUnless(0.15 < len(moved) / float(len(keys)) < 0.35)
+
+        # removing it puts them all back
+        ring.remove("s4")
+        for k in keys:
+            self.failUnlessEqual(ring.lookup(k), owners[k])
+        self.failUnlessEqual(ring.get_names(), ["s1", "s2", "s3"])
+
+class Shards(BasedirMixin, NodeRunnerMixin, unittest.TestCase):
+    def run_cli(self, func, options, args):
+        so = options()
+        so.parseOptions(args)
+        out,err = StringIO(), StringIO()
+        rc = func(so, out, err)
+        self.failUnlessEqual(rc, 0, (rc, out.getvalue(), err.getvalue()))
+        return out.getvalue()
+
+    def startRelay(self, name, *args):
+        basedir = os.path.join(self.make_basedir(), name)
+        self.run_cli(create_relay, runner.CreateRelayOptions,
+                     ["--webport", "tcp:0:interface=127.0.0.1"]
+                     + list(args) + [basedir])
+        n = self.startNode(basedir)
+        waiting = [n.web.port_service._waitingForPort]
+        if args:
+            waiting.append(n.shard_listener.port_service._waitingForPort)
+        d = defer.gatherResults(waiting)
+        d.addCallback(lambda _: basedir)
+        return d
+
+    def startShard(self, name):
+        return self.startRelay(name, "--shard-port",
+                               "tcp:0:interface=127.0.0.1")
+
+    def addShard(self, front, shard):
+        self.run_cli(add_shard, runner.AddShardOptions,
+                     ["--basedir", front, shard])
+
+    def migrate(self, front, *args):
+        return self.run_cli(migrate_shards, runner.MigrateShardsOptions,
+                            ["--basedir", front] + list(args))
+
+    def addTransport(self, front):
+        out = self.run_cli(add_transport, runner.AddTransportOptions,
+                           ["--basedir", front])
+        return json.loads(out)
+
+    def send(self, desc, msgC):
+        trec = desc["sender"].copy()
+        TID_token0 = desc["retrieval"]["TID"].decode("hex")
+        trec["STID"] = rrid.randomize(TID_token0).encode("hex")
+        return client.getPage(str(trec["url"]), method="POST",
+                              postdata=createMsgA(trec, msgC))
+
+    def retrieve(self, desc):
+        # the front end redirects this (and the ack) to the shard
+        r = HTTPRetriever(desc["retrieval"], None)
+        d = r.fetch()
+        def _fetched((msgCs, batch)):
+            d2 = r.ack(batch) if batch else defer.succeed(None)
+            d2.addCallback(lambda _: msgCs)
+            return d2
+        d.addCallback(_fetched)
+        return d
+
+    def holders(self, shards, desc):
+        # which shards have this transport's queue?
+        rid = desc["retrieval"]["url"].split("/")[-1]
+        found = []
+        for name, basedir in sorted(shards.items()):
+            store = QueueStore(os.path.join(basedir, "mailbox-queues"))
+            if store.get_transport_by_retrieval_id(rid):
+                found.append(name)
+        return found
+
+    def send_and_retrieve(self, descs, tag):
+        d = defer.succeed(None)
+        for i, desc in enumerate(descs):
+            d.addCallback(lambda _, desc=desc, i=i:
+                          self.send(desc, "%s-%d" % (tag, i)))
+        for i, desc in enumerate(descs):
+            d.addCallback(lambda _, desc=desc: self.retrieve(desc))
+            d.addCallback(self.failUnlessEqual, ["%s-%d" % (tag, i)])
+        return d
+
+    @defer.inlineCallbacks
+    def test_shards(self):
+        shards = {}
+        shards["s1"] = yield self.startShard("s1")
+        shards["s2"] = yield self.startShard("s2")
+        basedir = os.path.join(self.make_basedir(), "front")
+        self.run_cli(create_relay, runner.CreateRelayOptions,
+                     ["--webport", "tcp:0:interface=127.0.0.1", basedir])
+        self.addShard(basedir, shards["s1"])
+        self.addShard(basedir, shards["s2"])
+        front = self.startNode(basedir)
+        # (yielding _waitingForPort itself would clobber its result)
+        yield defer.gatherResults([front.web.port_service._waitingForPort])
+        self.failUnless(front.mailbox_server.router)
+
+        descs = [self.addTransport(basedir) for i in range(8)]
+        for desc in descs:
+            self.failUnlessEqual(len(self.holders(shards, desc)), 1)
+        yield self.send_and_retrieve(descs, "one")
+
+        # a new shard takes over some of the transports
+        shards["s3"] = yield self.startShard("s3")
+        self.addShard(basedir, shards["s3"])
+        before = dict([(i, self.holders(shards, desc))
+                       for i, desc in enumerate(descs)])
+        self.migrate(basedir)
+        after = dict([(i, self.holders(shards, desc))
+                      for i, desc in enumerate(descs)])
+        for i in before:
+            self.failUnlessEqual(len(after[i]), 1)
+            if after[i] != before[i]:
+                self.failUnlessEqual(after[i], ["s3"])
+        # the front end hasn't noticed s3 yet, so this also exercises the
+        # reload-and-retry path
+        yield self.send_and_retrieve(descs, "two")
+
+        # draining s1 moves everything off it
+        self.migrate(basedir, "--drain", "s1")
+        for desc in descs:
+            self.failIfIn("s1", self.holders(shards, desc))
+        yield self.send_and_retrieve(descs, "three")
+
+        # queued messages move along with their transport
+        yield self.send(descs[0], "queued")
+        self.migrate(basedir, "--drain", "s2")
+        got = yield self.retrieve(descs[0])
+        self.failUnlessEqual(got, ["queued"])
+
+    @defer.inlineCallbacks
+    def test_shard_key(self):
+        shard = yield self.startShard("s1")
+        basedir = os.path.join(self.make_basedir(), "front")
+        self.run_cli(create_relay, runner.CreateRelayOptions,
+                     ["--webport", "tcp:0:interface=127.0.0.1", basedir])
+        self.addShard(basedir, shard)
+        db = database.get_db(os.path.join(basedir, "petmail.db"))
+        row = db.execute("SELECT * FROM mailbox_shards").fetchone()
+        db.close()
+        self.failUnless(row["shard_key"])
+
+        # without the shard_key, the shard hangs up before taking anything
+        stranger = ShardConnection("s1", str(row["endpoint"]),
+                                   str(row["baseurl"]), None,
+                                   os.urandom(32).encode("hex"))
+        d = stranger.deliver("\x01"*32, "msgC")
+        yield self.assertFailure(d, error.ConnectionDone)
+
+        conn = ShardConnection("s1", str(row["endpoint"]),
+                               str(row["baseurl"]), None,
+                               str(row["shard_key"]))
+        reply = yield conn.deliver("\x01"*32, "msgC")
+        self.failUnlessEqual(reply, UNKNOWN)
+        yield conn.disconnect()
+
+    @defer.inlineCallbacks
+    def test_unreachable(self):
+        # a shard which isn't running yet, on a port nobody listens on
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+        shard = os.path.join(self.make_basedir(), "s1")
+        self.run_cli(create_relay, runner.CreateRelayOptions,
+                     ["--webport", "tcp:0:interface=127.0.0.1",
+                      "--shard-port", "tcp:%d:interface=127.0.0.1" % port,
+                      shard])
+        basedir = os.path.join(self.make_basedir(), "front")
+        self.run_cli(create_relay, runner.CreateRelayOptions,
+                     ["--webport", "tcp:0:interface=127.0.0.1", basedir])
+        self.addShard(basedir, shard)
+        front = self.startNode(basedir)
+        yield defer.gatherResults([front.web.port_service._waitingForPort])
+        desc = self.addTransport(basedir)
+        trec = desc["sender"].copy()
+        trec["STID"] = rrid.randomize(
+            desc["retrieval"]["TID"].decode("hex")).encode("hex")
+        msgA = createMsgA(trec, "msgC")
+        def post():
+            return client.getPage(str(trec["url"]), method="POST",
+                                  postdata=msgA)
+
+        # the message was not queued, so the sender must hear about it
+        f = yield self.failUnlessFailure(post(), http_error.Error)
+        self.failUnlessEqual(f.status, "503")
+        self.flushLoggedErrors()
+        # and its retry goes through once the shard is up
+        n = self.startNode(shard)
+        yield defer.gatherResults(
+            [n.shard_listener.port_service._waitingForPort])
+        yield post()
+        rid = desc["retrieval"]["url"].split("/")[-1]
+        store = QueueStore(os.path.join(shard, "mailbox-queues"))
+        q = store.get_transport_by_retrieval_id(rid)
+        self.failUnlessEqual(q.get_counters()[0], 1)
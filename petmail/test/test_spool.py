@@ -0,0 +1,159 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import defer
+from .common import BasedirMixin
+from ..eventual import flushEventualQueue
+from ..errors import ReplayError, UnknownChannelError
+from .. import spool
+from ..spool import InboundSpool, MAX_ATTEMPTS, SLOW_BATCH
+from ..mailbox.retrieval import HTTPRetriever
+
+class Spool(BasedirMixin, unittest.TestCase):
+    def make_spool(self, **kwargs):
+        spooldir = os.path.join(self.make_basedir(), "spool")
+        self.processed = []
+        self.failing = set()
+        self.spool = InboundSpool(spooldir, self.process, **kwargs)
+        return spooldir
+
+    def process(self, tid, msgC):
+        if msgC in self.failing:
+            raise UnknownChannelError()
+        if msgC.startswith("replay"):
+            raise ReplayError()
+        self.processed.append((tid, msgC))
+
+    def test_process(self):
+        spooldir = self.make_spool(segment_size=100)
+        self.spool.append(1, ["one", "two"])
+        self.spool.append(2, ["x"*100, "four"])
+        self.spool.append(3, ["five"])
+        # appending is durable, and processing comes later
+        self.failUnlessEqual(self.processed, [])
+        self.failUnlessEqual(self.spool.list_segments(), [0, 1])
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(self.processed, [(1, "one"), (1, "two"),
+                                                  (2, "x"*100), (2, "four"),
+                                                  (3, "five")])
+            # the full segment was dropped once processed
+            self.failUnlessEqual(self.spool.list_segments(), [1])
+            self.failUnlessEqual(self.spool.get_cursor()[0], 1)
+            # a restarted spool has nothing left to do
+            self.processed = []
+            spool2 = InboundSpool(spooldir, self.process)
+            spool2.process()
+            self.failUnlessEqual(self.processed, [])
+        d.addCallback(_then)
+        return d
+
+    def test_crash(self):
+        spooldir = self.make_spool()
+        self.spool.append(1, ["one", "two"])
+        with open(os.path.join(spooldir, "0.log"), "ab") as f:
+            f.write("20:\x00\x00") # cut short
+        # we "crash" before processing them, and restart
+        spool2 = InboundSpool(spooldir, self.process)
+        self.failUnlessEqual(spool2.current, 1)
+        spool2.append(1, ["three", "replay"])
+        spool2.process()
+        self.failUnlessEqual(self.processed, [(1, "one"), (1, "two"),
+                                              (1, "three")])
+        self.failUnlessEqual(spool2.list_segments(), [1])
+        return flushEventualQueue()
+
+    def test_retry(self):
+        spooldir = self.make_spool()
+        self.failing.add("early")
+        self.failing.add("junk")
+        self.spool.append(1, ["early", "two", "junk"])
+        self.spool.process()
+        self.failUnlessEqual(self.processed, [(1, "two")])
+        self.failUnless(os.path.exists(os.path.join(spooldir, "retry.log")))
+        # the channel shows up (e.g. the invitation finished)
+        self.failing.remove("early")
+        self.spool.process_retries()
+        self.failUnlessEqual(self.processed, [(1, "two"), (1, "early")])
+        # junk is eventually dropped
+        for i in range(MAX_ATTEMPTS):
+            self.spool.process_retries()
+        self.failIf(os.path.exists(os.path.join(spooldir, "retry.log")))
+        self.failIf(os.path.exists(os.path.join(spooldir, "retry.old")))
+        self.flushLoggedErrors(UnknownChannelError)
+
+    def test_slow_lane(self):
+        # messages which can't be classified cheaply wait in the slow lane
+        self.make_spool(classify=lambda tid, msgC:
+                        None if msgC.startswith("slow") else 1)
+        slow = ["slow-%d" % i for i in range(SLOW_BATCH+5)]
+        self.spool.append(1, slow[:3] + ["fast-1"] + slow[3:] + ["fast-2"])
+        self.spool.process()
+        self.failUnlessEqual(self.processed, [(1, "fast-1"), (1, "fast-2")])
+        self.failUnlessEqual(self.spool.get_depths(),
+                             {"inbound": 0, "slow": SLOW_BATCH+5,
+                              "retry": 0})
+        self.spool.process_slow()
+        self.failUnlessEqual(len(self.processed), 2+SLOW_BATCH)
+        self.failUnlessEqual(self.spool.get_depths()["slow"], 5)
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual([msgC for (tid, msgC) in self.processed[2:]],
+                                 slow)
+            self.failUnlessEqual(self.spool.get_depths(),
+                                 {"inbound": 0, "slow": 0, "retry": 0})
+        d.addCallback(_then)
+        return d
+
+class FakeProducer:
+    paused = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+
+class Backpressure(BasedirMixin, unittest.TestCase):
+    def test_spool(self):
+        self.patch(spool, "HIGH_WATER", 10)
+        self.patch(spool, "LOW_WATER", 4)
+        processed = []
+        s = InboundSpool(os.path.join(self.make_basedir(), "spool"),
+                         lambda tid, msgC: processed.append(msgC))
+        p1 = FakeProducer()
+        s.registerProducer(p1)
+        s.append(1, ["%d" % i for i in range(6)])
+        self.failIf(p1.paused)
+        s.append(1, ["%d" % i for i in range(6, 12)])
+        self.failUnless(p1.paused)
+        self.failUnlessEqual(s.get_status(), {"inbound": 12, "slow": 0,
+                                              "retry": 0, "paused": True})
+        # latecomers are paused too
+        p2 = FakeProducer()
+        s.registerProducer(p2)
+        self.failUnless(p2.paused)
+        self.patch(spool, "PROCESS_BATCH", 7)
+        s.process()
+        self.failUnlessEqual(s.backlog, 5)
+        self.failUnless(p1.paused)
+        s.process()
+        self.failUnlessEqual(len(processed), 12)
+        self.failIf(p1.paused)
+        self.failIf(p2.paused)
+        self.failUnlessEqual(s.get_status()["paused"], False)
+        return flushEventualQueue()
+
+    def test_retriever(self):
+        fetched = []
+        r = HTTPRetriever({}, lambda msgCs: None)
+        def fetch():
+            fetched.append(1)
+            return defer.succeed((["msgC"] if len(fetched) < 3 else [],
+                                  None))
+        r.fetch = fetch
+        r.pauseProducing()
+        r.poll()
+        self.failUnlessEqual(fetched, [])
+        r.resumeProducing()
+        d = flushEventualQueue()
+        # it drains the backlog once resumed
+        d.addCallback(lambda _: self.failUnlessEqual(len(fetched), 3))
+        return d
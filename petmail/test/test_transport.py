@@ -1,10 +1,12 @@
-import json
+import json, time
 from twisted.trial import unittest
 from nacl.public import PublicKey, Box
 from .common import TwoNodeMixin
+from ..eventual import flushEventualQueue
 from ..mailbox import channel
 from ..mailbox.delivery import createMsgA, ReturnTransport
 from ..mailbox.server import parseMsgA, parseMsgB
+from ..web import MessageEvents, FetchMessageBody
 
 class Transports(TwoNodeMixin, unittest.TestCase):
     def test_create_from_channel(self):
@@ -97,6 +99,8 @@ class Transports(TwoNodeMixin, unittest.TestCase):
         P1 = {"hi": "world"}
 
         d = nA.client.send_message(entA["id"], P1)
+        # the message is stored by nB's database writer thread
+        d.addCallback(lambda _: nB.adb.barrier())
         def _sent(res):
             c = nB.db.execute("SELECT * FROM inbound_messages")
             rows = c.fetchall()
@@ -104,7 +108,9 @@ class Transports(TwoNodeMixin, unittest.TestCase):
             self.failUnlessEqual(rows[0]["id"], 1) # global msgid
             self.failUnlessEqual(rows[0]["cid"], entB["id"])
             self.failUnlessEqual(rows[0]["seqnum"], 1)
-            self.failUnlessEqual(json.loads(rows[0]["payload_json"]), P1)
+            c = nB.db.execute("SELECT payload_json FROM message_bodies"
+                              " WHERE message_id=?", (rows[0]["id"],))
+            self.failUnlessEqual(json.loads(c.fetchone()[0]), P1)
         d.addCallback(_sent)
         d.addCallback(lambda _: nB.client.command_fetch_all_messages())
         def _fetched(messages):
@@ -114,5 +120,89 @@ class Transports(TwoNodeMixin, unittest.TestCase):
             self.failUnlessEqual(messages[0]["seqnum"], 1)
             self.failUnlessEqual(messages[0]["payload"], P1)
         d.addCallback(_fetched)
+        # bodies can also be left out, and loaded one at a time
+        d.addCallback(lambda _:
+                      nB.client.command_fetch_all_messages(bodies=False))
+        def _listed(messages):
+            self.failUnlessEqual(len(messages), 1)
+            self.failIfIn("payload", messages[0])
+            self.failUnlessEqual(messages[0]["size"], len(json.dumps(P1)))
+            return nB.client.command_fetch_message_body(messages[0]["id"])
+        d.addCallback(_listed)
+        d.addCallback(self.failUnlessEqual, P1)
+
+        # once archived, it is no longer listed, but can still be found
+        def _archive(_):
+            a = nB.client.archiver
+            a.clock = lambda: time.time() + a.archive_after + 1
+            return a.archive()
+        d.addCallback(_archive)
+        d.addCallback(self.failUnlessEqual, 1)
+        d.addCallback(lambda _:
+                      nB.client.command_fetch_all_messages(bodies=False))
+        d.addCallback(self.failUnlessEqual, [])
+        d.addCallback(lambda _:
+                      nB.client.command_search_archive(cid=entB["id"],
+                                                       text="world"))
+        def _found(messages):
+            self.failUnlessEqual(len(messages), 1)
+            self.failUnlessEqual(messages[0]["seqnum"], 1)
+            return nB.client.command_fetch_message_body(messages[0]["id"])
+        d.addCallback(_found)
+        d.addCallback(self.failUnlessEqual, P1)
+        d.addCallback(lambda _:
+                      nB.client.command_search_archive(text="nowhere"))
+        d.addCallback(self.failUnlessEqual, [])
+
+        return d
 
+    def test_store_with_seqnum(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        # a second copy of a message, arriving before the first is stored,
+        # is dropped by the writer thread
+        nB.client.payload_received(entB["id"], 1, json.dumps({"n": 1}))
+        nB.client.payload_received(entB["id"], 1, json.dumps({"n": 2}))
+        d = nB.adb.commit()
+        def _stored(_):
+            rows = nB.db.execute("SELECT * FROM inbound_messages").fetchall()
+            self.failUnlessEqual(len(rows), 1)
+            self.failUnlessEqual(rows[0]["seqnum"], 1)
+            c = nB.db.execute("SELECT highest_inbound_seqnum"
+                              " FROM addressbook WHERE id=?", (entB["id"],))
+            self.failUnlessEqual(c.fetchone()[0], 1)
+            return nB.client.command_fetch_message_body(rows[0]["id"])
+        d.addCallback(_stored)
+        d.addCallback(self.failUnlessEqual, {"n": 1})
+        return d
+
+    def test_message_event(self):
+        nA, nB, entA, entB = self.make_nodes(transport="local")
+        P1 = {"hi": "world"}
+        events = []
+        def _observe(notices):
+            events.extend([MessageEvents(nB.db, nB.client).render_event(n)
+                           for n in notices])
+        nB.client.subscribe("inbound_messages", _observe, batch=True)
+
+        d = nA.client.send_message(entA["id"], P1)
+        d.addCallback(lambda _: nB.adb.barrier())
+        d.addCallback(lambda _: flushEventualQueue())
+        def _sent(_):
+            # the event carries the narrow row, and the control page loads
+            # the body with fetch-message-body
+            self.failUnlessEqual(len(events), 1)
+            event = json.loads(json.dumps(events[0]))
+            self.failUnlessEqual(event["action"], "insert")
+            self.failUnlessEqual(event["id"], 1)
+            new_value = event["new_value"]
+            self.failUnlessEqual(new_value["cid"], entB["id"])
+            self.failUnlessEqual(new_value["seqnum"], 1)
+            self.failUnlessEqual(new_value["payload_size"],
+                                 len(json.dumps(P1)))
+            self.failIfIn("payload_json", new_value)
+            h = FetchMessageBody(nB.db, nB.client,
+                                 {"args": {"id": event["id"]}})
+            return h.handle(h.payload["args"])
+        d.addCallback(_sent)
+        d.addCallback(self.failUnlessEqual, {"ok": "ok", "payload": P1})
         return d
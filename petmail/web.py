@@ -1,6 +1,9 @@
-import os, json
+import os, json, tempfile
+from StringIO import StringIO
 from twisted.application import service, strports
+from twisted.internet import defer
 from twisted.web import server, static, resource, http
+from twisted.protocols import policies
 from twisted.python import log
 from .database import Notice
 from .util import make_nonce, equal
@@ -26,16 +29,26 @@ class DBEventsProtocol:
         # those panels are displayed). (or just deliver everything always).
         self.sendEvent(json.dumps(self.renderer(notice)))
 
+    def notify_batch(self, notices):
+        # a whole commit's worth of events goes out in a single write
+        self.request.write("".join([self.formatEvent(json.dumps(
+            self.renderer(notice))) for notice in notices]))
+
     def sendEvent(self, data, name=None, id=None, retry=None):
+        self.request.write(self.formatEvent(data, name, id, retry))
+
+    def formatEvent(self, data, name=None, id=None, retry=None):
+        lines = []
         if name:
-            self.request.write("event: %s\n" % name.encode("utf-8"))
+            lines.append("event: %s\n" % name.encode("utf-8"))
         if id:
-            self.request.write("id: %s\n" % id.encode("utf-8"))
+            lines.append("id: %s\n" % id.encode("utf-8"))
         if retry:
-            self.request.write("retry: %d\n" % retry) # milliseconds
+            lines.append("retry: %d\n" % retry) # milliseconds
         for line in data.splitlines():
-            self.request.write("data: %s\n" % line.encode("utf-8"))
-        self.request.write("\n")
+            lines.append("data: %s\n" % line.encode("utf-8"))
+        lines.append("\n")
+        return "".join(lines)
 
 class BaseEvents(resource.Resource):
     def __init__(self, db, client):
@@ -43,15 +56,30 @@ class BaseEvents(resource.Resource):
         self.db = db
         self.client = client
 
+    def get_where(self, request):
+        # subclasses can limit the stream to matching rows, like the 'where'
+        # of ObservableDatabase.subscribe()
+        return None
+
     def render_GET(self, request):
         request.setHeader("content-type", "text/event-stream")
         p = DBEventsProtocol(request, self.render_event)
-        c = self.db.execute("SELECT * FROM `%s`" % self.table)
-        for row in c.fetchall():
-            p.notify(Notice(self.table, "insert", row["id"], row))
-        self.client.subscribe(self.table, p.notify)
+        where = self.get_where(request)
+        clauses, values = [], []
+        for column, wanted in sorted((where or {}).items()):
+            clauses.append("`%s` IN (%s)"
+                           % (column, ",".join("?"*len(wanted))))
+            values.extend(wanted)
+        sql = "SELECT * FROM `%s`" % self.table
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        c = self.db.execute(sql, values)
+        p.notify_batch([Notice(self.table, "insert", row["id"], row)
+                        for row in c.fetchall()])
+        self.client.subscribe(self.table, p.notify_batch, batch=True,
+                              where=where)
         def _done(_):
-            self.client.unsubscribe(self.table, p.notify)
+            self.client.unsubscribe(self.table, p.notify_batch)
         request.notifyFinish().addErrback(_done)
         return server.NOT_DONE_YET
 
@@ -60,6 +88,12 @@ def serialize_row(row):
 
 class MessageEvents(BaseEvents):
     table = "inbound_messages"
+    def get_where(self, request):
+        # ?cid=1&cid=2 : only these channels' messages
+        if "cid" in request.args:
+            return {"cid": [int(cid) for cid in request.args["cid"]]}
+        return None
+
     def render_event(self, notice):
         return { "action": notice.action,
                  "id": notice.id,
@@ -87,18 +121,41 @@ class BaseHandler(resource.Resource):
         self.client = client
         self.payload = payload
     def render_POST(self, request):
-        err = None
         try:
             results = self.handle(self.payload.get("args", {}))
-            if isinstance(results, (str, unicode)):
-                results = {"ok": results}
         except CommandError, e:
             # this is the only way to signal a "known" error
-            err = unicode(e.msg)
-        if err:
-            request.setResponseCode(http.BAD_REQUEST, "command error")
-            request.setHeader("content-type", "text/plain; charset=utf-8")
-            return err.encode("utf-8")
+            return self.render_error(request, e)
+        if isinstance(results, defer.Deferred):
+            # e.g. handlers which query the database off the reactor thread
+            finished = []
+            request.notifyFinish().addBoth(finished.append)
+            def _failed(f):
+                if f.check(CommandError):
+                    return self.render_error(request, f.value)
+                log.err(f)
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                request.setHeader("content-type", "text/plain")
+                return "Please see node logs for details\n"
+            results.addCallbacks(self.render_results, _failed,
+                                 callbackArgs=(request,))
+            def _write(body):
+                if not finished: # the client might have gone away
+                    request.write(body)
+                    request.finish()
+            results.addCallback(_write)
+            results.addErrback(log.err)
+            return server.NOT_DONE_YET
+        return self.render_results(results, request)
+
+    def render_error(self, request, e):
+        request.setResponseCode(http.BAD_REQUEST, "command error")
+        request.setHeader("content-type", "text/plain; charset=utf-8")
+        return unicode(e.msg).encode("utf-8")
+
+    def render_results(self, results, request):
+        if isinstance(results, (str, unicode)):
+            results = {"ok": results}
         assert "ok" in results, (results, type(results))
         request.setResponseCode(http.OK, "OK")
         request.setHeader("content-type", "application/json; charset=utf-8")
@@ -132,9 +189,16 @@ class ListAddressbook(BaseHandler):
                 "addressbook": self.client.command_list_addressbook()}
 handlers["list-addressbook"] = ListAddressbook
 
+class SpoolStatus(BaseHandler):
+    def handle(self, payload):
+        return {"ok": "ok", "spool": self.client.command_spool_status()}
+handlers["spool-status"] = SpoolStatus
+
 class AddMailbox(BaseHandler):
     def handle(self, payload):
-        self.client.command_add_mailbox(str(payload["descriptor"]))
+        # the descriptor is the JSON printed by 'petmail add-transport'
+        desc = json.loads(payload["descriptor"])
+        self.client.command_add_mailbox(desc["sender"], desc["retrieval"])
         return {"ok": "ok"}
 handlers["add-mailbox"] = AddMailbox
 
@@ -153,10 +217,33 @@ handlers["send-basic"] = SendBasic
 
 class FetchMessages(BaseHandler):
     def handle(self, payload):
-        return {"ok": "ok",
-                "messages": self.client.command_fetch_all_messages()}
+        # set "bodies": false to list messages without loading their
+        # payloads, then use fetch-message-body for the ones you want
+        d = self.client.command_fetch_all_messages(payload.get("bodies",
+                                                               True))
+        d.addCallback(lambda messages: {"ok": "ok", "messages": messages})
+        return d
 handlers["fetch-messages"] = FetchMessages
 
+class FetchMessageBody(BaseHandler):
+    def handle(self, payload):
+        d = self.client.command_fetch_message_body(int(payload["id"]))
+        d.addCallback(lambda body: {"ok": "ok", "payload": body})
+        return d
+handlers["fetch-message-body"] = FetchMessageBody
+
+class SearchArchive(BaseHandler):
+    def handle(self, payload):
+        # all optional: "cid", "since" and "until" (seconds), "text"
+        d = self.client.command_search_archive(payload.get("cid"),
+                                               payload.get("since"),
+                                               payload.get("until"),
+                                               payload.get("text"),
+                                               payload.get("limit", 100))
+        d.addCallback(lambda messages: {"ok": "ok", "messages": messages})
+        return d
+handlers["search-archive"] = SearchArchive
+
 class API(resource.Resource):
     def __init__(self, access_token, db, client):
         resource.Resource.__init__(self)
@@ -228,7 +315,107 @@ class Root(resource.Resource):
         self.putChild("", static.Data("Hello\n", "text/plain"))
         self.putChild("media", static.File(MEDIA_DIRNAME))
 
+DEFAULT_MAX_BODY_SIZE = 2*1000*1000
+DEFAULT_SPOOL_THRESHOLD = 64*1000
+
+class _DiscardingContent:
+    def write(self, data):
+        pass
+    def seek(self, offset, whence=0):
+        pass
+    def tell(self):
+        return 0
+    def read(self, size=-1):
+        return ""
+    def close(self):
+        pass
+
+class BoundedRequest(server.Request):
+    """I refuse request bodies larger than my Site's max_body_size. When the
+    Content-Length header announces an oversized body, I answer 413 and drop
+    the connection before reading any of it. Bodies of unknown length are
+    cut off as soon as they grow too large. Bodies above the Site's
+    spool_threshold are spooled to a temporary file instead of memory."""
+    body_rejected = False
+
+    def gotLength(self, length):
+        site = self.channel.site
+        self.body_received = 0
+        if length is not None and length > site.max_body_size:
+            self.body_rejected = True
+            self.content = _DiscardingContent()
+            # we have no method or path yet, so we can't build a real
+            # response: write a minimal one by hand
+            t = self.channel.transport
+            t.write("HTTP/1.1 413 Request Entity Too Large\r\n"
+                    "Connection: close\r\n"
+                    "Content-Length: 0\r\n\r\n")
+            t.loseConnection()
+            return
+        if length is None or length > site.spool_threshold:
+            self.content = tempfile.TemporaryFile()
+        else:
+            self.content = StringIO()
+
+    def handleContentChunk(self, data):
+        if self.body_rejected:
+            return
+        self.body_received += len(data)
+        if self.body_received > self.channel.site.max_body_size:
+            self.body_rejected = True
+            self.content.close()
+            self.content = _DiscardingContent()
+            return
+        self.content.write(data)
+
+    def process(self):
+        if self.body_rejected:
+            if self.channel.transport.disconnecting:
+                return # already answered in gotLength
+            self.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE,
+                                 "request too large")
+            self.setHeader("content-type", "text/plain")
+            self.write("request too large\n")
+            self.finish()
+            return
+        server.Request.process(self)
+
+class BoundedSite(server.Site):
+    requestFactory = BoundedRequest
+    max_body_size = DEFAULT_MAX_BODY_SIZE
+    spool_threshold = DEFAULT_SPOOL_THRESHOLD
+    access_log = True
+
+    def log(self, request):
+        if self.access_log:
+            server.Site.log(self, request)
+
+class ConnectionLimiter(policies.WrappingFactory):
+    """I refuse new connections while 'max_connections' are open."""
+    def __init__(self, wrappedFactory, max_connections):
+        policies.WrappingFactory.__init__(self, wrappedFactory)
+        self.max_connections = max_connections
+        self.refused = 0
+
+    def buildProtocol(self, addr):
+        if len(self.protocols) >= self.max_connections:
+            self.refused += 1
+            return None
+        return policies.WrappingFactory.buildProtocol(self, addr)
+
+def make_mailbox_factory(site, max_connections, timeout):
+    # the separate mailbox listener (MailboxPort, or a worker serving its
+    # socket) gets its own limits
+    if timeout:
+        site.timeOut = timeout
+    if max_connections:
+        return ConnectionLimiter(site, max_connections)
+    return site
+
 class WebPort(service.MultiService):
+    # the node table column with our service descriptor
+    port_config = "webport"
+
     def __init__(self, basedir, node):
         service.MultiService.__init__(self)
         self.basedir = basedir
@@ -236,9 +423,12 @@ class WebPort(service.MultiService):
 
         self.root = root = Root()
 
-        site = server.Site(root)
-        webport = str(node.get_node_config("webport"))
-        self.port_service = strports.service(webport, site)
+        self.site = site = BoundedSite(root)
+        self.listen(site)
+
+    def listen(self, factory):
+        port = str(self.node.get_node_config(self.port_config))
+        self.port_service = strports.service(port, factory)
         self.port_service.setServiceParent(self)
 
     def enable_client(self, client, db):
@@ -270,7 +460,7 @@ class WebPort(service.MultiService):
         service.MultiService.startService(self)
 
         # now update the webport, if we started with port=0 . This is gross.
-        webport = str(self.node.get_node_config("webport"))
+        webport = str(self.node.get_node_config(self.port_config))
         pieces = webport.split(":")
         if pieces[0:2] == ["tcp", "0"]:
             d = self.port_service._waitingForPort
@@ -279,7 +469,8 @@ class WebPort(service.MultiService):
                     got_port = port.getHost().port
                     pieces[1] = str(got_port)
                     new_webport = ":".join(pieces)
-                    self.node.set_node_config("webport", new_webport)
+                    self.node.set_node_config(self.port_config,
+                                              new_webport)
                 except:
                     log.err()
                 return port
@@ -291,8 +482,26 @@ class WebPort(service.MultiService):
     def get_baseurl(self):
         webhost = str(self.node.get_node_config("webhost"))
         assert webhost
-        webport = str(self.node.get_node_config("webport"))
+        webport = str(self.node.get_node_config(self.port_config))
         pieces = webport.split(":")
         assert pieces[0] == "tcp"
         assert int(pieces[1]) != 0
         return "http://%s:%d/" % (webhost, int(pieces[1]))
+
+class MailboxPort(WebPort):
+    """I serve the mailbox (/mailbox and /retrieve) on a port of my own, so
+    heavy delivery traffic doesn't compete with the control panel, the API,
+    and the event streams on the WebPort. My connection limit and idle
+    timeout are set separately, in the node table."""
+    port_config = "mailbox_port"
+
+    def __init__(self, basedir, node):
+        service.MultiService.__init__(self)
+        self.basedir = basedir
+        self.node = node
+        self.root = resource.Resource()
+        self.site = BoundedSite(self.root)
+        self.factory = make_mailbox_factory(
+            self.site, node.get_node_config("mailbox_max_connections"),
+            node.get_node_config("mailbox_timeout"))
+        self.listen(self.factory)